@@ -1,9 +1,27 @@
 from ultralytics import YOLO
 import base64
+import threading
 import numpy as np
 from PIL import Image
 from io import BytesIO
-model = YOLO(r"cv_for_person_detect/yolov5n.pt")
+model = None
+_model_lock = threading.Lock()
+
+
+def _get_model() -> YOLO:
+    """Ленивая загрузка весов: при старте сервиса ее выполняет прогрев (warmup.py)"""
+    global model
+    if model is None:
+        with _model_lock:
+            if model is None:
+                model = YOLO(r"cv_for_person_detect/yolov5n.pt")
+    return model
+
+
+def warmup() -> None:
+    """Загрузка модели и пробный инференс на пустом кадре"""
+    _get_model()(np.zeros((640, 640, 3), dtype=np.uint8), classes=[0], save=False, verbose=False)
+
 
 def detect_person(image_base64: str, conf: float = 0.58) -> bool:
     image_data = base64.b64decode(image_base64)
@@ -11,7 +29,6 @@ def detect_person(image_base64: str, conf: float = 0.58) -> bool:
     if image.mode != 'RGB':
         image = image.convert('RGB')
     image_array = np.array(image)
-    results = model(image_array, classes=[0], conf=conf, save=False, verbose=False)
+    results = _get_model()(image_array, classes=[0], conf=conf, save=False, verbose=False)
     has_person = len(results[0].boxes) > 0
     return has_person
-
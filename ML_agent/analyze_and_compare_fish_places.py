@@ -1,19 +1,42 @@
 from typing import *
 import httpx
-from calculate_distance.map import get_route, geocode_name_to_coords
-from calculate_distance.encoder import create_semantic_embedding, calculate_semantic_similarity
+from calculate_distance.map import get_route, get_routes, geocode_name_to_coords
+from calculate_distance.geo import haversine_km, coords_to_array
+from calculate_distance.encoder import acreate_semantic_embedding, calculate_semantic_similarity
 from endpoints.endpoints_with_backend import get_all_places_by_id, fetch_best_fishing_places, fetch_places_by_location, get_all_places_by_type
 from model_provider import Model
-from calculate_distance.encoder import get_similarity, create_semantic_embedding
+import asyncio
+from calculate_distance.ranking import PlaceRanker, NAME_EMBEDDING, PREFERENCES_EMBEDDING, combined_metric_scores
+from calculate_distance.ann_index import PlaceIndexRegistry
 from relax_analyzer import RelaxAnalyzer, RelaxType
 from redis_bd import RedisManager
+from extraction_cache import extraction_cache
+from cache_utils import CacheStats, LRUCache, SingleFlight
+from calculate_distance.geocode_cache import normalize_query
+import copy
+import os
 import random
+import numpy as np
 from dotenv import load_dotenv
 
 load_dotenv()
+
+# Сколько лучших мест (по метрике с расстоянием по прямой) получают расчет расстояния по дорогам
+ROUTE_SHORTLIST = int(os.getenv("ROUTE_SHORTLIST", "30"))
+# Дальше этого радиуса (по прямой) маршрут через OSRM не запрашивается
+ROUTE_RADIUS_KM = float(os.getenv("ROUTE_RADIUS_KM", "100"))
+# osrm - расстояние по дорогам, straight - только по прямой (деградированный режим)
+ROUTING_MODE = os.getenv("ROUTING_MODE", "osrm")
+# Сколько секунд отдавать повтор того же запроса из кэша (0 - только объединение одновременных)
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", "30"))
+
 model = Model()
-analyzer = RelaxAnalyzer(model)
+analyzer = RelaxAnalyzer(model, cache=extraction_cache)
 redis_manager = RedisManager()
+ann_registry = PlaceIndexRegistry()
+search_cache = LRUCache(maxsize=int(os.getenv("SEARCH_CACHE_SIZE", "1000")), ttl=SEARCH_CACHE_TTL)
+search_inflight = SingleFlight()
+search_stats = CacheStats()
 
 async def get_redis_places_embeddings(type_of_relax: str) -> List[Dict]:
     """
@@ -27,6 +50,83 @@ async def get_redis_places_embeddings(type_of_relax: str) -> List[Dict]:
         return []
 
 
+async def get_redis_ranker(type_of_relax: str) -> PlaceRanker:
+    """
+    Получает PlaceRanker по местам из Redis (строится один раз на версию кэша).
+    """
+    try:
+        return redis_manager.get_ranker(type_of_relax)
+    except Exception as e:
+        print(f"Ошибка при получении данных из Redis: {e}")
+        return PlaceRanker.from_places([])
+
+
+async def get_route_distances(user_coords: Optional[list], places_coords: List[Optional[list]]) -> np.ndarray:
+    """
+    Считает расстояние по дорогам от пользователя до каждой точки (пачками через OSRM /table).
+    
+    Сначала считается расстояние по прямой: точки дальше ROUTE_RADIUS_KM в OSRM не
+    отправляются и получают расстояние по прямой (дорога не короче прямой, так что
+    за горизонтом calculate_combined_metric оценка расстояния все равно 0).
+    В режиме ROUTING_MODE=straight расстояние по прямой используется для всех точек.
+    
+    Returns:
+        Массив расстояний в км в порядке places_coords, NaN если расстояние неизвестно
+    """
+    distances = np.full(len(places_coords), np.nan)
+    if not user_coords:
+        return distances
+    
+    straight = haversine_km(user_coords, coords_to_array(places_coords))
+    if ROUTING_MODE == "straight":
+        return np.round(straight, 2)
+    
+    far = straight > ROUTE_RADIUS_KM
+    distances[far] = np.round(straight[far], 2)
+    to_route = [None if far[i] else coords for i, coords in enumerate(places_coords)]
+    
+    try:
+        routes = await get_routes(user_coords, to_route)
+    except Exception as e:
+        print(f"Ошибка при расчете маршрута: {e}")
+        return distances
+    
+    for i, route in enumerate(routes):
+        if route and route.get('distance_km') is not None:
+            distances[i] = route['distance_km']
+    return distances
+
+
+async def rank_redis_places(
+    ranker: PlaceRanker,
+    query_embedding: List[float],
+    kind: str,
+    user_coords: Optional[list],
+    k: int = 10
+) -> List[Dict]:
+    """
+    Выбирает k лучших мест по комбинированной метрике.
+    Расстояние по дорогам считается только для ROUTE_SHORTLIST мест, лучших
+    по той же метрике с расстоянием по прямой (дорога не короче прямой,
+    поэтому это оценка сверху), так что близкие места со средним сходством
+    не отсекаются до расчета маршрутов.
+    """
+    straight = None
+    if user_coords:
+        straight = haversine_km(user_coords, coords_to_array([place.get("coord_location") for place in ranker.places]))
+    shortlist = ranker.top_k(query_embedding, kind, k=max(k, ROUTE_SHORTLIST), distance_km=straight)
+    ranker = ranker.subset([item["id"] for item in shortlist])
+    
+    distances = await get_route_distances(
+        user_coords, [place.get("coord_location") for place in ranker.places]
+    )
+    top_places = ranker.top_k(query_embedding, kind, k=k, distance_km=distances)
+    for item in top_places:
+        distance_km = distances[item["index"]]
+        item["distance_km"] = None if np.isnan(distance_km) else float(distance_km)
+    return top_places
+
+
 async def calculate_combined_metric(
     similarity_score: float,
     distance_km: Optional[float],
@@ -47,11 +147,39 @@ async def calculate_combined_metric(
 
 
 async def compare_places(query_user: str) -> List[Dict]:
+    """
+    Поиск мест для телеграм-бота с объединением одинаковых запросов.
+
+    Одновременные запросы с одинаковым нормализованным текстом (в нем же
+    указано, откуда выезжает пользователь) ждут одного вычисления, а
+    повторы в течение SEARCH_CACHE_TTL секунд отдаются из кэша.
+    """
+    key = normalize_query(query_user)
+    cached = search_cache.get(key)
+    if cached is not None:
+        search_stats.incr("hits")
+        return copy.deepcopy(cached)
+
+    if key in search_inflight:
+        search_stats.incr("hits_coalesced")
+    else:
+        search_stats.incr("misses")
+
+    async def compute():
+        result = await _compare_places(query_user)
+        if SEARCH_CACHE_TTL > 0:
+            search_cache.set(key, result)
+        return result
+
+    result = await search_inflight.do(key, compute, detach=True)
+    return copy.deepcopy(result)
+
+
+async def _compare_places(query_user: str) -> List[Dict]:
     """
     Логика поиска мест с возвратом location_user и distance_km для телеграм-бота.
     """
-    relax_type = analyzer.determine_relax_type(query_user)
-    short_info = analyzer.analyze_user_query(query_user, relax_type)
+    relax_type, short_info = await analyzer.aanalyze_search_query(query_user)
     
     location_user = short_info.get("location_user")
     type_of_relax = short_info.get("type_of_relax")
@@ -63,9 +191,9 @@ async def compare_places(query_user: str) -> List[Dict]:
     
     # Создаем embedding пользовательских предпочтений
     if user_preferences:
-        user_prefs_emb = create_semantic_embedding(user_preferences)
+        user_prefs_emb = await acreate_semantic_embedding(user_preferences)
     else:
-        user_prefs_emb = create_semantic_embedding(query_user)
+        user_prefs_emb = await acreate_semantic_embedding(query_user)
     
     # Получаем координаты пользователя
     user_coords = None
@@ -84,39 +212,11 @@ async def compare_places(query_user: str) -> List[Dict]:
     if wish_locations:
         print("Режим: Поиск по wish_locations")
         
-        wish_locations_emb = create_semantic_embedding(wish_locations)
-        all_redis_places = await get_redis_places_embeddings(type_of_relax)
+        wish_locations_emb = await acreate_semantic_embedding(wish_locations)
+        ranker = await get_redis_ranker(type_of_relax)
+        ranker = ann_registry.candidates(type_of_relax, NAME_EMBEDDING, ranker, wish_locations_emb, user_coords)
+        top_places = await rank_redis_places(ranker, wish_locations_emb, NAME_EMBEDDING, user_coords)
         
-        places_with_metrics = []
-        
-        for place in all_redis_places:
-            name_similarity = calculate_semantic_similarity(
-                place["name_embedding"], 
-                wish_locations_emb
-            )
-            
-            distance_km = None
-            if user_coords and place.get("coord_location"):
-                try:
-                    route = await get_route(
-                        start_coord=user_coords, 
-                        end_coord=place["coord_location"]
-                    )
-                    distance_km = route.get('distance_km')
-                except Exception as e:
-                    print(f"Ошибка при расчете маршрута: {e}")
-            
-            combined_metric = await calculate_combined_metric(name_similarity, distance_km)
-            
-            places_with_metrics.append({
-                "id": place["location_id"],
-                "combined_metric": combined_metric,
-                "name_similarity": name_similarity,
-                "distance_km": distance_km
-            })
-        
-        places_with_metrics.sort(key=lambda x: x["combined_metric"], reverse=True)
-        top_places = places_with_metrics[:10]
         places_ids = [place["id"] for place in top_places]
         
         # Получаем полное описание мест с бэкенда
@@ -136,37 +236,10 @@ async def compare_places(query_user: str) -> List[Dict]:
     elif type_of_relax == RelaxType.CAMPING:
         print("Режим: Кемпинг - поиск по preferences из Redis")
         
-        all_redis_places = await get_redis_places_embeddings(type_of_relax)
-        places_with_metrics = []
-        
-        for place in all_redis_places:
-            prefs_similarity = calculate_semantic_similarity(
-                place["preferences_embedding"], 
-                user_prefs_emb
-            )
-            
-            distance_km = None
-            if user_coords and place.get("coord_location"):
-                try:
-                    route = await get_route(
-                        start_coord=user_coords, 
-                        end_coord=place["coord_location"]
-                    )
-                    distance_km = route.get('distance_km')
-                except Exception as e:
-                    print(f"Ошибка при расчете маршрута: {e}")
-            
-            combined_metric = await calculate_combined_metric(prefs_similarity, distance_km)
-            
-            places_with_metrics.append({
-                "id": place["location_id"],
-                "combined_metric": combined_metric,
-                "prefs_similarity": prefs_similarity,
-                "distance_km": distance_km
-            })
+        ranker = await get_redis_ranker(type_of_relax)
+        ranker = ann_registry.candidates(type_of_relax, PREFERENCES_EMBEDDING, ranker, user_prefs_emb, user_coords)
+        top_places = await rank_redis_places(ranker, user_prefs_emb, PREFERENCES_EMBEDDING, user_coords)
         
-        places_with_metrics.sort(key=lambda x: x["combined_metric"], reverse=True)
-        top_places = places_with_metrics[:10]
         places_ids = [place["id"] for place in top_places]
         
         # Получаем полное описание мест с бэкенда
@@ -194,25 +267,47 @@ async def compare_places(query_user: str) -> List[Dict]:
         if not fishing_places:
             return []
         
-        places_with_metrics = []
+        places_with_similarity = []
+        
+        # Недостающие embeddings считаем параллельно - они попадут в одну пачку
+        missing = [
+            place for place in fishing_places
+            if not place.get("preferences_embedding")
+            and (place.get("user_preferences") or place.get("description"))
+        ]
+        missing_embs = await asyncio.gather(*(
+            acreate_semantic_embedding(place.get("user_preferences") or place.get("description"))
+            for place in missing
+        ))
+        computed = {id(place): emb for place, emb in zip(missing, missing_embs)}
         
         for place in fishing_places:
-            place_prefs_emb = place.get("preferences_embedding")
-            
+            place_prefs_emb = place.get("preferences_embedding") or computed.get(id(place))
             if not place_prefs_emb:
-                place_prefs = place.get("user_preferences", [])
-                if place_prefs:
-                    place_prefs_emb = create_semantic_embedding(place_prefs)
-                else:
-                    description = place.get("description", "")
-                    if description:
-                        place_prefs_emb = create_semantic_embedding(description)
-                    else:
-                        continue
+                continue
             
             prefs_similarity = calculate_semantic_similarity(place_prefs_emb, user_prefs_emb)
-            
-            distance_km = None
+            places_with_similarity.append((place, prefs_similarity))
+        
+        # Маршруты считаем только для лучших мест по метрике с расстоянием по прямой
+        # (места без координат - с нейтральной оценкой расстояния, как в calculate_combined_metric)
+        if user_coords and places_with_similarity:
+            straight = haversine_km(user_coords, coords_to_array(
+                [place.get("place_coordinates") for place, _ in places_with_similarity]
+            ))
+            upper_bound = combined_metric_scores(
+                np.array([similarity for _, similarity in places_with_similarity]), straight
+            )
+            order = np.argsort(-upper_bound, kind="stable")
+            places_with_similarity = [places_with_similarity[i] for i in order]
+        else:
+            places_with_similarity.sort(key=lambda x: x[1], reverse=True)
+        # Маршруты только для первых ROUTE_SHORTLIST мест, но в ответе остаются все
+        shortlist = places_with_similarity[:ROUTE_SHORTLIST]
+        rest = places_with_similarity[ROUTE_SHORTLIST:]
+        
+        places_coords = []
+        for place, _ in shortlist:
             place_coords = place.get("place_coordinates") 
             if not place_coords:
                 place_name = place.get("name_place", [None]) if isinstance(place.get("name_place"), list) else place.get("name_place")
@@ -221,17 +316,13 @@ async def compare_places(query_user: str) -> List[Dict]:
                         place_coords = await geocode_name_to_coords(place_name)
                     except Exception:
                         pass
-            
-            if user_coords and place_coords:
-                try:
-                    route = await get_route(
-                        start_coord=user_coords,
-                        end_coord=place_coords
-                    )
-                    distance_km = route.get('distance_km')
-                except Exception as e:
-                    print(f"Ошибка при расчете маршрута: {e}")
-            
+            places_coords.append(place_coords)
+        
+        distances = await get_route_distances(user_coords, places_coords)
+        
+        places_with_metrics = []
+        for (place, prefs_similarity), distance_km in zip(shortlist, distances):
+            distance_km = None if np.isnan(distance_km) else float(distance_km)
             combined_metric = await calculate_combined_metric(prefs_similarity, distance_km)
             
             # Добавляем вычисленные поля
@@ -243,6 +334,17 @@ async def compare_places(query_user: str) -> List[Dict]:
         
         places_with_metrics.sort(key=lambda x: x["combined_metric"], reverse=True)
         
+        # Остальные места идут следом, без маршрута: distance_km неизвестно,
+        # combined_metric с нейтральной оценкой расстояния
+        rest_with_metrics = []
+        for place, prefs_similarity in rest:
+            place["location_user"] = user_coords
+            place["distance_km"] = None
+            place["combined_metric"] = await calculate_combined_metric(prefs_similarity, None)
+            rest_with_metrics.append(place)
+        rest_with_metrics.sort(key=lambda x: x["combined_metric"], reverse=True)
+        places_with_metrics.extend(rest_with_metrics)
+        
         return places_with_metrics
     
     # === СЛУЧАЙ 4: Нет нужных полей - рандомный выбор ===
@@ -257,21 +359,11 @@ async def compare_places(query_user: str) -> List[Dict]:
         full_places = await get_all_places_by_id(places_ids)
         
         # Добавляем location_user и distance_km
-        for place in full_places:
+        distances = await get_route_distances(
+            user_coords, [place.get("place_coordinates") for place in full_places]
+        )
+        for place, distance_km in zip(full_places, distances):
             place["location_user"] = user_coords  
-            place_coords = place.get("place_coordinates") 
-            
-            distance_km = None
-            if user_coords and place_coords:
-                try:
-                    route = await get_route(
-                        start_coord=user_coords,
-                        end_coord=place_coords
-                    )
-                    distance_km = route.get('distance_km')
-                except Exception:
-                    pass
-            
-            place["distance_km"] = distance_km
+            place["distance_km"] = None if np.isnan(distance_km) else float(distance_km)
         
         return full_places
\ No newline at end of file
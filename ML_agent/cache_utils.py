@@ -0,0 +1,177 @@
+"""
+Общие примитивы кэширования для ML сервиса.
+"""
+
+import asyncio
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Iterable, Optional, Tuple
+
+
+_MISSING = object()
+
+
+class CacheStats:
+    """Счетчики попаданий/промахов кэша"""
+
+    def __init__(self):
+        self._counters: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def incr(self, name: str, value: int = 1) -> None:
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def as_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            counters = dict(self._counters)
+        hits = sum(v for k, v in counters.items() if k.startswith("hits"))
+        total = hits + counters.get("misses", 0)
+        counters["hit_ratio"] = round(hits / total, 4) if total else 0.0
+        return counters
+
+
+class LRUCache:
+    """
+    Потокобезопасный LRU кэш с ограничением размера и временем жизни записей.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            item = self._data.get(key, _MISSING)
+            if item is _MISSING:
+                return default
+            value, expires_at = item
+            if expires_at is not None and expires_at < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key: Hashable) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+
+class OwnerCancelled(RuntimeError):
+    """Вычисление для ключа отменено вместе с вызвавшей его корутиной"""
+
+
+class SingleFlight:
+    """
+    Объединение одинаковых одновременных асинхронных вычислений:
+    пока для ключа идет вычисление, остальные вызовы ждут его результат.
+    """
+
+    def __init__(self):
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+        self._tasks = set()
+
+    def __len__(self) -> int:
+        return len(self._inflight)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._inflight
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable[Any]], detach: bool = False) -> Any:
+        """
+        Выполняет func один раз для всех одновременных вызовов с ключом key.
+
+        detach=True запускает вычисление отдельной задачей: отмена вызвавшей
+        корутины (например, клиент закрыл соединение) не отменяет результат
+        для остальных ожидающих.
+        """
+        future = self._inflight.get(key)
+        if future is not None:
+            try:
+                return await asyncio.shield(future)
+            except OwnerCancelled:
+                # Владелец отменен: вычисление перезапускает один из ожидающих
+                return await self.do(key, func, detach)
+
+        if detach:
+            mine, _ = self.claim([key])
+
+            async def run():
+                try:
+                    self.resolve(key, await func())
+                except BaseException as e:
+                    self.reject(key, e)
+
+            task = asyncio.create_task(run())
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+            return await asyncio.shield(mine[key])
+
+        self.claim([key])
+        try:
+            result = await func()
+        except BaseException as e:
+            self.reject(key, e)
+            raise
+        self.resolve(key, result)
+        return result
+
+    def claim(self, keys: Iterable[Hashable]) -> Tuple[Dict[Hashable, asyncio.Future], Dict[Hashable, asyncio.Future]]:
+        """
+        Разделяет ключи на свои (вызывающий обязан вызвать resolve/reject)
+        и уже вычисляемые другими корутинами.
+
+        Returns:
+            (свои ключи -> future, чужие ключи -> future для ожидания)
+        """
+        loop = asyncio.get_running_loop()
+        mine, waiting = {}, {}
+        for key in keys:
+            if key in mine:
+                continue
+            future = self._inflight.get(key)
+            if future is not None:
+                waiting[key] = future
+            else:
+                future = loop.create_future()
+                # Исключение может никто не ждать - не выводим предупреждение
+                future.add_done_callback(lambda f: f.cancelled() or f.exception())
+                self._inflight[key] = future
+                mine[key] = future
+        return mine, waiting
+
+    def resolve(self, key: Hashable, value: Any) -> None:
+        future = self._inflight.pop(key, None)
+        if future is not None and not future.done():
+            future.set_result(value)
+
+    def reject(self, key: Hashable, error: BaseException) -> None:
+        """
+        Завершает ожидание ключа ошибкой. Общий future никогда не отменяется:
+        отмена владельца передается ожидающим как OwnerCancelled (обычное
+        Exception), иначе CancelledError получили бы несвязанные запросы.
+        """
+        future = self._inflight.pop(key, None)
+        if future is not None and not future.done():
+            if not isinstance(error, Exception):
+                error = OwnerCancelled(f"Вычисление {key!r} отменено")
+            future.set_exception(error)
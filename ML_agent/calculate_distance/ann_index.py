@@ -0,0 +1,584 @@
+"""
+Приближенный поиск ближайших соседей (ANN) по embeddings мест.
+
+Используется в ветках wish_location и кемпинга compare_places, чтобы не
+сканировать все места: индекс отдает короткий список кандидатов, который
+затем точно ранжируется PlaceRanker с учетом расстояния.
+
+Компромисс по полноте: итоговая метрика наполовину состоит из расстояния, а
+индекс отбирает только по сходству. Поэтому к ANN_CANDIDATES кандидатам
+индекса добавляются ANN_GEO_CANDIDATES ближайших к пользователю мест (по
+прямой), и близкое место со средним сходством не теряется. Место, которое
+не входит ни в один из двух списков, может пропасть из выдачи, хотя полный
+перебор поставил бы его выше. Каталоги меньше ANN_MIN_PLACES индексом не
+сужаются вовсе, и ранжирование для них точное.
+
+Бэкенды (переменная окружения ANN_BACKEND):
+- exact: полный перебор, эталон для проверки полноты
+- ivf: инвертированный индекс по центроидам k-means, только numpy
+- hnsw: граф HNSW через hnswlib (если библиотека установлена)
+"""
+
+import asyncio
+import hashlib
+import os
+from abc import ABC, abstractmethod
+import threading
+import time
+import weakref
+import zlib
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from calculate_distance.geo import coords_to_array, haversine_km
+from calculate_distance.ranking import PlaceRanker, _normalize_rows
+
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+
+ANN_BACKEND = os.getenv("ANN_BACKEND", "ivf")
+ANN_INDEX_DIR = os.getenv("ANN_INDEX_DIR", "ann_index")
+# Меньше этого числа мест точный PlaceRanker быстрее любого индекса
+ANN_MIN_PLACES = int(os.getenv("ANN_MIN_PLACES", "5000"))
+# Сколько кандидатов индекс отдает на точное ранжирование
+ANN_CANDIDATES = int(os.getenv("ANN_CANDIDATES", "200"))
+# Сколько ближайших к пользователю мест добавляется к кандидатам индекса
+ANN_GEO_CANDIDATES = int(os.getenv("ANN_GEO_CANDIDATES", "200"))
+
+
+class ANNIndex(ABC):
+    """Базовый интерфейс индекса: id места -> нормализованный вектор"""
+
+    backend = "base"
+
+    def __init__(self, dim: int):
+        self.dim = dim
+
+    @abstractmethod
+    def __len__(self) -> int:
+        ...
+
+    @abstractmethod
+    def add(self, ids: Sequence[int], vectors: np.ndarray) -> None:
+        """Добавляет или обновляет векторы мест"""
+
+    @abstractmethod
+    def remove(self, ids: Sequence[int]) -> None:
+        ...
+
+    @abstractmethod
+    def search(self, query: np.ndarray, k: int) -> List[int]:
+        """Возвращает id до k ближайших мест по косинусному сходству"""
+
+    @abstractmethod
+    def save(self, path: str) -> None:
+        ...
+
+    @classmethod
+    @abstractmethod
+    def load(cls, path: str) -> "ANNIndex":
+        ...
+
+
+class _RowStorage:
+    """Растущая матрица векторов с переиспользованием освободившихся строк"""
+
+    def __init__(self, dim: int):
+        self.vectors = np.zeros((0, dim), dtype=np.float32)
+        self.ids: List[Optional[int]] = []
+        self.rows: Dict[int, int] = {}
+        self.free: List[int] = []
+
+    def put(self, place_id: int, vector: np.ndarray) -> Tuple[int, bool]:
+        """Возвращает (строка, была_ли_запись_раньше)"""
+        row = self.rows.get(place_id)
+        existed = row is not None
+        if row is None:
+            if self.free:
+                row = self.free.pop()
+            else:
+                row = len(self.ids)
+                self.ids.append(None)
+                if row >= self.vectors.shape[0]:
+                    grown = np.zeros((max(16, row * 2), self.vectors.shape[1]), dtype=np.float32)
+                    grown[:self.vectors.shape[0]] = self.vectors
+                    self.vectors = grown
+            self.rows[place_id] = row
+            self.ids[row] = place_id
+        self.vectors[row] = vector
+        return row, existed
+
+    def pop(self, place_id: int) -> Optional[int]:
+        row = self.rows.pop(place_id, None)
+        if row is not None:
+            self.ids[row] = None
+            self.vectors[row] = 0
+            self.free.append(row)
+        return row
+
+    def active_rows(self) -> np.ndarray:
+        return np.fromiter(self.rows.values(), dtype=np.int64, count=len(self.rows))
+
+
+class ExactIndex(ANNIndex):
+    """Полный перебор, тот же результат, что и PlaceRanker"""
+
+    backend = "exact"
+
+    def __init__(self, dim: int):
+        super().__init__(dim)
+        self._storage = _RowStorage(dim)
+
+    def __len__(self) -> int:
+        return len(self._storage.rows)
+
+    def add(self, ids, vectors):
+        for place_id, vector in zip(ids, vectors):
+            self._storage.put(int(place_id), vector)
+
+    def remove(self, ids):
+        for place_id in ids:
+            self._storage.pop(int(place_id))
+
+    def search(self, query, k):
+        rows = self._storage.active_rows()
+        if rows.shape[0] == 0:
+            return []
+        scores = self._storage.vectors[rows] @ query
+        top = np.argsort(-scores, kind="stable")[:k]
+        return [self._storage.ids[rows[i]] for i in top]
+
+    def save(self, path):
+        rows = self._storage.active_rows()
+        np.savez(path, ids=np.asarray([self._storage.ids[r] for r in rows], dtype=np.int64),
+                 vectors=self._storage.vectors[rows])
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        index = cls(data["vectors"].shape[1])
+        index.add(data["ids"], data["vectors"])
+        return index
+
+
+class IVFIndex(ANNIndex):
+    """
+    Инвертированный индекс (IVF-Flat) на numpy.
+
+    Векторы разбиваются на nlist кластеров сферическим k-means, запрос
+    просматривает только nprobe ближайших кластеров. Новые векторы
+    приписываются к ближайшему центроиду без переобучения.
+    """
+
+    backend = "ivf"
+
+    def __init__(self, dim: int, nprobe: int = 8, kmeans_iterations: int = 10):
+        super().__init__(dim)
+        self.nprobe = nprobe
+        self.kmeans_iterations = kmeans_iterations
+        self.centroids = np.zeros((0, dim), dtype=np.float32)
+        self._lists: List[List[int]] = []
+        self._assignment: Dict[int, int] = {}
+        self._storage = _RowStorage(dim)
+
+    def __len__(self) -> int:
+        return len(self._storage.rows)
+
+    def train(self, vectors: np.ndarray, nlist: Optional[int] = None, seed: int = 0) -> None:
+        """Обучает центроиды по выборке векторов и переназначает все строки"""
+        n = vectors.shape[0]
+        if n == 0:
+            return
+        if nlist is None:
+            nlist = int(np.clip(np.sqrt(n), 1, 1024))
+        nlist = max(1, min(nlist, n))
+
+        rng = np.random.default_rng(seed)
+        sample = vectors[rng.choice(n, size=min(n, nlist * 64), replace=False)]
+        centroids = sample[rng.choice(sample.shape[0], size=nlist, replace=False)].copy()
+        for _ in range(self.kmeans_iterations):
+            labels = np.argmax(sample @ centroids.T, axis=1)
+            for c in range(nlist):
+                members = sample[labels == c]
+                if members.shape[0]:
+                    centroids[c] = members.sum(axis=0)
+            centroids = _normalize_rows(centroids)
+
+        self.centroids = centroids.astype(np.float32)
+        self._lists = [[] for _ in range(nlist)]
+        self._assignment = {}
+        rows = self._storage.active_rows()
+        if rows.shape[0]:
+            labels = np.argmax(self._storage.vectors[rows] @ self.centroids.T, axis=1)
+            for row, label in zip(rows, labels):
+                self._lists[label].append(int(row))
+                self._assignment[int(row)] = int(label)
+
+    def add(self, ids, vectors):
+        if self.centroids.shape[0] == 0:
+            self.centroids = np.zeros((1, self.dim), dtype=np.float32)
+            self._lists = [[]]
+        labels = np.argmax(np.asarray(vectors, dtype=np.float32) @ self.centroids.T, axis=1)
+        for place_id, vector, label in zip(ids, vectors, labels):
+            row, existed = self._storage.put(int(place_id), vector)
+            if existed:
+                self._lists[self._assignment[row]].remove(row)
+            self._lists[label].append(row)
+            self._assignment[row] = int(label)
+
+    def remove(self, ids):
+        for place_id in ids:
+            row = self._storage.pop(int(place_id))
+            if row is not None:
+                self._lists[self._assignment.pop(row)].remove(row)
+
+    def search(self, query, k):
+        if len(self) == 0:
+            return []
+        nprobe = min(self.nprobe, self.centroids.shape[0])
+        probe = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+        rows = np.fromiter(
+            (row for c in probe for row in self._lists[c]), dtype=np.int64
+        )
+        if rows.shape[0] == 0:
+            return []
+        scores = self._storage.vectors[rows] @ query
+        k = min(k, rows.shape[0])
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [self._storage.ids[rows[i]] for i in top]
+
+    def save(self, path):
+        rows = self._storage.active_rows()
+        np.savez(
+            path,
+            ids=np.asarray([self._storage.ids[r] for r in rows], dtype=np.int64),
+            vectors=self._storage.vectors[rows],
+            centroids=self.centroids,
+            nprobe=np.asarray(self.nprobe),
+        )
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        index = cls(data["vectors"].shape[1], nprobe=int(data["nprobe"]))
+        index.centroids = data["centroids"]
+        index._lists = [[] for _ in range(index.centroids.shape[0])]
+        index.add(data["ids"], data["vectors"])
+        return index
+
+
+class HNSWIndex(ANNIndex):
+    """Граф HNSW через hnswlib (опциональная зависимость)"""
+
+    backend = "hnsw"
+
+    def __init__(self, dim: int, max_elements: int = 1024, ef: int = 64, m: int = 16):
+        super().__init__(dim)
+        if hnswlib is None:
+            raise RuntimeError("hnswlib не установлен, используйте ANN_BACKEND=ivf")
+        self._index = hnswlib.Index(space="ip", dim=dim)
+        self._index.init_index(max_elements=max_elements, ef_construction=200, M=m, allow_replace_deleted=True)
+        self._index.set_ef(ef)
+        self._ids = set()
+        self._deleted = set()
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def add(self, ids, vectors):
+        ids = [int(i) for i in ids]
+        if not ids:
+            return
+        needed = len(self._ids | set(ids))
+        if needed > self._index.get_max_elements():
+            self._index.resize_index(max(needed, self._index.get_max_elements() * 2))
+        # Обновленное место: старую точку помечаем удаленной и добавляем заново.
+        # unmark_deleted не используется - метку мог уже занять replace_deleted
+        for place_id in ids:
+            if place_id in self._ids:
+                self._index.mark_deleted(place_id)
+        self._index.add_items(np.asarray(vectors, dtype=np.float32), ids, replace_deleted=True)
+        self._ids.update(ids)
+        self._deleted.difference_update(ids)
+
+    def remove(self, ids):
+        for place_id in ids:
+            place_id = int(place_id)
+            if place_id in self._ids:
+                self._index.mark_deleted(place_id)
+                self._ids.discard(place_id)
+                self._deleted.add(place_id)
+
+    def search(self, query, k):
+        k = min(k, len(self._ids))
+        if k == 0:
+            return []
+        self._index.set_ef(max(k, self._index.ef))
+        labels, _ = self._index.knn_query(query.reshape(1, -1), k=k)
+        return [int(label) for label in labels[0]]
+
+    def save(self, path):
+        self._index.save_index(path)
+        np.savez(
+            path + ".meta.npz",
+            ids=np.asarray(sorted(self._ids), dtype=np.int64),
+            deleted=np.asarray(sorted(self._deleted), dtype=np.int64),
+            dim=np.asarray(self.dim),
+        )
+
+    @classmethod
+    def load(cls, path):
+        meta = np.load(path + ".meta.npz")
+        index = cls.__new__(cls)
+        ANNIndex.__init__(index, int(meta["dim"]))
+        index._index = hnswlib.Index(space="ip", dim=index.dim)
+        index._index.load_index(path, allow_replace_deleted=True)
+        index._ids = set(int(i) for i in meta["ids"])
+        index._deleted = set(int(i) for i in meta["deleted"])
+        return index
+
+
+_BACKENDS = {
+    ExactIndex.backend: ExactIndex,
+    IVFIndex.backend: IVFIndex,
+    HNSWIndex.backend: HNSWIndex,
+}
+
+
+def create_index(dim: int, backend: str = ANN_BACKEND) -> ANNIndex:
+    if backend not in _BACKENDS:
+        raise ValueError(f"Неизвестный ANN_BACKEND: {backend}")
+    return _BACKENDS[backend](dim)
+
+
+class PlaceIndexRegistry:
+    """
+    Индексы по (type_of_relax, вид embedding), синхронизируемые с кэшем мест.
+
+    Индекс сохраняется на диск и при смене версии кэша обновляется
+    инкрементально: добавляются новые и измененные места, удаляются пропавшие.
+    Из event loop обновление (и обучение IVF) идет в фоне через
+    asyncio.to_thread, а пока индекс не готов, запросы ранжируются точно.
+    """
+
+    def __init__(self, backend: str = ANN_BACKEND, index_dir: str = ANN_INDEX_DIR):
+        self.backend = backend
+        self.index_dir = index_dir
+        self._indexes: Dict[Tuple[str, str], ANNIndex] = {}
+        self._checksums: Dict[Tuple[str, str], Dict[int, int]] = {}
+        self._synced: Dict[Tuple[str, str], weakref.ref] = {}
+        self._building: Dict[Tuple[str, str], asyncio.Future] = {}
+        # Координаты мест ranker для отбора ближайших (один раз на объект ranker)
+        self._coords: "weakref.WeakKeyDictionary[PlaceRanker, np.ndarray]" = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def _path(self, type_of_relax: str, kind: str) -> str:
+        name = hashlib.md5(f"{type_of_relax}:{kind}".encode("utf-8")).hexdigest()
+        return os.path.join(self.index_dir, f"{self.backend}_{name}")
+
+    def _load(self, key: Tuple[str, str]) -> Optional[ANNIndex]:
+        path = self._path(*key)
+        file_path = path + ".npz" if self.backend != HNSWIndex.backend else path
+        if not os.path.exists(file_path):
+            return None
+        try:
+            index = _BACKENDS[self.backend].load(file_path)
+            checksums = np.load(path + ".crc.npy")
+            self._checksums[key] = {int(i): int(c) for i, c in checksums}
+            return index
+        except Exception as e:
+            print(f"Не удалось загрузить ANN индекс {file_path}: {e}")
+            return None
+
+    def _save(self, key: Tuple[str, str], index: ANNIndex) -> None:
+        try:
+            os.makedirs(self.index_dir, exist_ok=True)
+            path = self._path(*key)
+            index.save(path)
+            checksums = np.asarray(list(self._checksums[key].items()), dtype=np.int64).reshape(-1, 2)
+            np.save(path + ".crc.npy", checksums)
+        except Exception as e:
+            print(f"Не удалось сохранить ANN индекс: {e}")
+
+    def _ready(self, key: Tuple[str, str], ranker: PlaceRanker) -> Optional[ANNIndex]:
+        """Индекс, уже синхронизированный с этим ranker, или None"""
+        with self._lock:
+            index = self._indexes.get(key)
+            synced = self._synced.get(key)
+            if index is not None and synced is not None and synced() is ranker:
+                return index
+        return None
+
+    def _schedule_sync(self, type_of_relax: str, kind: str, ranker: PlaceRanker) -> None:
+        """Запускает sync в отдельном потоке, если для ключа он еще не идет"""
+        key = (type_of_relax, kind)
+        if key in self._building:
+            return
+        with self._lock:
+            # До конца обновления индекс не используется: его меняет другой поток
+            self._synced.pop(key, None)
+        task = asyncio.ensure_future(asyncio.to_thread(self.sync, type_of_relax, kind, ranker))
+        self._building[key] = task
+
+        def done(task: asyncio.Future) -> None:
+            self._building.pop(key, None)
+            if not task.cancelled() and task.exception() is not None:
+                print(f"Ошибка обновления ANN индекса {key}: {task.exception()}")
+
+        task.add_done_callback(done)
+
+    def sync(self, type_of_relax: str, kind: str, ranker: PlaceRanker) -> ANNIndex:
+        """Приводит индекс в соответствие с местами ranker (один раз на объект ranker)"""
+        key = (type_of_relax, kind)
+        with self._lock:
+            index = self._indexes.get(key)
+            synced = self._synced.get(key)
+            if index is not None and synced is not None and synced() is ranker:
+                return index
+
+            matrix = ranker._matrices[kind]
+            valid = ranker._valid[kind]
+            if index is None:
+                index = self._load(key)
+            if index is None:
+                index = create_index(matrix.shape[1] or 1, self.backend)
+                self._checksums[key] = {}
+            checksums = self._checksums[key]
+
+            current = {}
+            changed_ids, changed_rows = [], []
+            for row, place_id in enumerate(ranker.ids):
+                if place_id is None or not valid[row]:
+                    continue
+                crc = zlib.crc32(matrix[row].tobytes())
+                current[int(place_id)] = crc
+                if checksums.get(int(place_id)) != crc:
+                    changed_ids.append(int(place_id))
+                    changed_rows.append(row)
+            removed = [place_id for place_id in checksums if place_id not in current]
+
+            if removed:
+                index.remove(removed)
+            if changed_ids:
+                index.add(changed_ids, matrix[changed_rows])
+            if isinstance(index, IVFIndex) and len(index) >= 4 * max(1, index.centroids.shape[0]) ** 2:
+                # Индекс сильно вырос относительно обученных центроидов
+                index.train(index._storage.vectors[index._storage.active_rows()])
+
+            self._checksums[key] = current
+            self._indexes[key] = index
+            self._synced[key] = weakref.ref(ranker)
+            if removed or changed_ids:
+                self._save(key, index)
+            return index
+
+    def candidates(
+        self,
+        type_of_relax: str,
+        kind: str,
+        ranker: PlaceRanker,
+        query_embedding: List[float],
+        user_coords: Optional[list] = None,
+        k: int = ANN_CANDIDATES,
+        geo_k: int = ANN_GEO_CANDIDATES
+    ) -> PlaceRanker:
+        """
+        Сужает ranker до k кандидатов по ANN индексу плюс geo_k ближайших
+        к user_coords мест. Для небольших каталогов, а также пока индекс
+        обновляется в фоне, возвращает ranker без изменений.
+        """
+        if len(ranker) < ANN_MIN_PLACES:
+            return ranker
+        try:
+            index = self._ready((type_of_relax, kind), ranker)
+            if index is None:
+                try:
+                    asyncio.get_running_loop()
+                except RuntimeError:
+                    # Вне event loop (скрипты, бенчмарк) строим индекс сразу
+                    index = self.sync(type_of_relax, kind, ranker)
+                else:
+                    self._schedule_sync(type_of_relax, kind, ranker)
+                    return ranker
+            query = np.asarray(query_embedding, dtype=np.float32)
+            norm = np.linalg.norm(query)
+            if norm == 0 or query.shape[0] != index.dim:
+                return ranker
+            ids = index.search(query / norm, k)
+            if user_coords and geo_k > 0:
+                ids = list(ids) + self._nearest(ranker, user_coords, geo_k)
+            return ranker.subset(set(ids))
+        except Exception as e:
+            print(f"Ошибка ANN поиска, используем полный перебор: {e}")
+            return ranker
+
+
+    def _nearest(self, ranker: PlaceRanker, user_coords: list, k: int) -> List[int]:
+        """id k ближайших к пользователю мест по прямой (места без координат не участвуют)"""
+        with self._lock:
+            points = self._coords.get(ranker)
+            if points is None:
+                points = coords_to_array([place.get("coord_location") for place in ranker.places])
+                self._coords[ranker] = points
+        distances = haversine_km(user_coords, points)
+        distances = np.where(np.isnan(distances), np.inf, distances)
+        k = min(k, len(distances))
+        rows = np.argpartition(distances, k - 1)[:k] if k else []
+        return [ranker.ids[row] for row in rows if np.isfinite(distances[row])]
+
+
+def _benchmark(sizes=(10_000, 100_000), dim: int = 384, queries: int = 50, k: int = 10):
+    """Recall@10 и задержка ANN бэкендов относительно точного перебора."""
+    rng = np.random.default_rng(0)
+    for n in sizes:
+        # Кластеризованные данные ближе к реальным embeddings, чем равномерный шум
+        centers = rng.standard_normal((64, dim))
+        vectors = _normalize_rows(
+            (centers[rng.integers(0, 64, n)] + 0.6 * rng.standard_normal((n, dim))).astype(np.float32)
+        )
+        ids = np.arange(n)
+        test = _normalize_rows(
+            (centers[rng.integers(0, 64, queries)] + 0.6 * rng.standard_normal((queries, dim))).astype(np.float32)
+        )
+
+        exact = ExactIndex(dim)
+        exact.add(ids, vectors)
+        truth = [set(exact.search(q, k)) for q in test]
+
+        start = time.perf_counter()
+        for q in test:
+            exact.search(q, k)
+        exact_ms = (time.perf_counter() - start) * 1000 / queries
+        print(f"n={n:>7} exact: {exact_ms:7.2f} мс/запрос")
+
+        candidates = [("ivf", nprobe) for nprobe in (4, 8, 16, 32)]
+        if hnswlib is not None:
+            candidates += [("hnsw", ef) for ef in (32, 64, 128)]
+        for backend, param in candidates:
+            start = time.perf_counter()
+            if backend == "ivf":
+                index = IVFIndex(dim, nprobe=param)
+                index.add(ids, vectors)
+                index.train(vectors)
+            else:
+                index = HNSWIndex(dim, max_elements=n, ef=param)
+                index.add(ids, vectors)
+            build_s = time.perf_counter() - start
+
+            start = time.perf_counter()
+            results = [index.search(q, k) for q in test]
+            search_ms = (time.perf_counter() - start) * 1000 / queries
+            recall = np.mean([len(truth[i] & set(r)) / k for i, r in enumerate(results)])
+            print(
+                f"n={n:>7} {backend}({param:>3}): recall@{k} {recall:.3f} | "
+                f"{search_ms:7.2f} мс/запрос | построение {build_s:6.1f} с"
+            )
+
+
+if __name__ == "__main__":
+    _benchmark()
@@ -0,0 +1,121 @@
+"""
+Объединение запросов на embeddings от параллельных обработчиков в пачки.
+
+Каждый вызов encode кладет тексты в очередь и ждет future. Фоновая корутина
+забирает из очереди до EMBED_MAX_BATCH текстов (ожидая остальные не дольше
+EMBED_MAX_WAIT_MS) и считает их одним вызовом SentenceTransformer.encode
+в отдельном потоке, поэтому инференс не блокирует event loop FastAPI.
+"""
+
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional
+
+import numpy as np
+
+from cache_utils import CacheStats
+from calculate_distance.embedding_cache import EmbeddingCache
+
+
+EMBED_MAX_BATCH = int(os.getenv("EMBED_MAX_BATCH", "32"))
+EMBED_MAX_WAIT_MS = float(os.getenv("EMBED_MAX_WAIT_MS", "5"))
+
+# Один поток на все модели: torch сам распараллеливает вычисления внутри пачки
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="embedding")
+
+
+class EmbeddingBatcher:
+    """Очередь запросов к одной модели SentenceTransformer с пакетной обработкой"""
+
+    def __init__(
+        self,
+        get_model: Callable,
+        model_id: Optional[str] = None,
+        cache: Optional[EmbeddingCache] = None,
+        max_batch: int = EMBED_MAX_BATCH,
+        max_wait_ms: float = EMBED_MAX_WAIT_MS,
+        executor: ThreadPoolExecutor = _executor
+    ):
+        self.get_model = get_model
+        self.model_id = model_id
+        # Кэш по содержимому: в очередь попадают только тексты, которых нет в кэше
+        self.cache = cache if model_id else None
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.executor = executor
+        self.stats = CacheStats()
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._loop = None
+
+    async def encode(self, texts: List[str]) -> np.ndarray:
+        """Embeddings для списка текстов, массив (len(texts), dim)"""
+        self.stats.incr("requests")
+        found = await self.cache.aget_many(self.model_id, texts) if self.cache is not None else {}
+        missing = list(dict.fromkeys(text for text in texts if text not in found))
+        if missing:
+            self._ensure_worker()
+            loop = asyncio.get_running_loop()
+            futures = []
+            for text in missing:
+                future = loop.create_future()
+                self._queue.put_nowait((text, future))
+                futures.append(future)
+            found.update(zip(missing, await asyncio.gather(*futures)))
+        return np.stack([found[text] for text in texts])
+
+    async def encode_one(self, text: str) -> np.ndarray:
+        return (await self.encode([text]))[0]
+
+    def _ensure_worker(self) -> None:
+        loop = asyncio.get_running_loop()
+        if self._worker is None or self._worker.done() or self._loop is not loop:
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            self._worker = loop.create_task(self._run())
+
+    def _encode_batch(self, texts: List[str]) -> np.ndarray:
+        model = self.get_model()
+        vectors = model.encode(texts, batch_size=len(texts), convert_to_numpy=True)
+        if self.cache is not None:
+            self.cache.set_many(self.model_id, dict(zip(texts, vectors)))
+        return vectors
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            # Короткое ожидание, чтобы собрать запросы соседних обработчиков
+            if self._queue.qsize() < self.max_batch - 1 and self.max_wait > 0:
+                await asyncio.sleep(self.max_wait)
+            while len(batch) < self.max_batch and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+
+            batch = [(text, future) for text, future in batch if not future.done()]
+            if not batch:
+                continue
+
+            unique = list(dict.fromkeys(text for text, _ in batch))
+            try:
+                vectors = await loop.run_in_executor(self.executor, self._encode_batch, unique)
+            except Exception as e:
+                print(f"Ошибка при создании embeddings пачкой: {e}")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            self.stats.incr("batches")
+            self.stats.incr("texts", len(batch))
+            by_text = dict(zip(unique, vectors))
+            for text, future in batch:
+                if not future.done():
+                    future.set_result(by_text[text])
+
+    def get_stats(self) -> dict:
+        stats = self.stats.as_dict()
+        stats.pop("hit_ratio", None)
+        batches = stats.get("batches", 0)
+        stats["avg_batch_size"] = round(stats.get("texts", 0) / batches, 2) if batches else 0.0
+        return stats
@@ -0,0 +1,174 @@
+"""
+Кэш embeddings по содержимому: (модель, нормализованный текст) -> float32 вектор.
+
+1. LRU в памяти процесса
+2. SQLite файл с векторами в BLOB (чтение через mmap), переживающий
+   перезапуски сервиса, поэтому после рестарта ничего не пересчитывается
+
+Из event loop используется aget_many: SQLite читается в отдельном потоке.
+
+Нормализация текста только по пробелам: регистр и пунктуация влияют на
+embedding мультиязычной модели, поэтому такие тексты считаются разными.
+"""
+
+import asyncio
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from cache_utils import CacheStats, LRUCache
+
+
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "embedding_cache.sqlite3")
+EMBEDDING_MEMORY_SIZE = int(os.getenv("EMBEDDING_MEMORY_SIZE", "50000"))
+EMBEDDING_MMAP_SIZE = int(os.getenv("EMBEDDING_MMAP_SIZE", str(256 * 1024 * 1024)))
+
+
+def normalize_text(text: str) -> str:
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def text_key(text: str) -> str:
+    return hashlib.sha1(normalize_text(text).encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """Кэш embeddings с LRU в памяти и SQLite на диске"""
+
+    def __init__(
+        self,
+        path: str = EMBEDDING_CACHE_PATH,
+        memory_size: int = EMBEDDING_MEMORY_SIZE
+    ):
+        self.path = path
+        self.memory = LRUCache(maxsize=memory_size)
+        self.stats = CacheStats()
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_lock = threading.Lock()
+
+    def _connection(self) -> Optional[sqlite3.Connection]:
+        if self._db is None and self.path:
+            try:
+                db = sqlite3.connect(self.path, check_same_thread=False)
+                db.execute(f"PRAGMA mmap_size = {EMBEDDING_MMAP_SIZE}")
+                db.execute("PRAGMA journal_mode = WAL")
+                db.execute(
+                    "CREATE TABLE IF NOT EXISTS embeddings ("
+                    "model TEXT NOT NULL, key TEXT NOT NULL, vector BLOB NOT NULL, "
+                    "PRIMARY KEY (model, key)) WITHOUT ROWID"
+                )
+                db.commit()
+                self._db = db
+            except sqlite3.Error as e:
+                print(f"Кэш embeddings на диске недоступен: {e}")
+                self.path = None
+        return self._db
+
+    def _get_memory(self, model_id: str, texts: List[str]) -> Tuple[Dict[str, np.ndarray], Dict[str, List[str]]]:
+        """Найденные в памяти тексты и ключ -> тексты для остальных"""
+        found: Dict[str, np.ndarray] = {}
+        missing: Dict[str, List[str]] = {}
+        for text in texts:
+            key = text_key(text)
+            vector = self.memory.get((model_id, key))
+            if vector is not None:
+                found[text] = vector
+                self.stats.incr("hits_memory")
+            else:
+                missing.setdefault(key, []).append(text)
+        return found, missing
+
+    def _get_disk(self, model_id: str, missing: Dict[str, List[str]]) -> Dict[str, np.ndarray]:
+        """Ищет тексты из missing в SQLite, найденные ключи удаляются из missing"""
+        found: Dict[str, np.ndarray] = {}
+        rows = []
+        with self._db_lock:
+            db = self._connection()
+            if db is not None:
+                try:
+                    keys = list(missing)
+                    # Ограничение SQLite на число параметров запроса
+                    for i in range(0, len(keys), 500):
+                        chunk = keys[i:i + 500]
+                        rows += db.execute(
+                            f"SELECT key, vector FROM embeddings WHERE model = ? "
+                            f"AND key IN ({','.join('?' * len(chunk))})",
+                            (model_id, *chunk)
+                        ).fetchall()
+                except sqlite3.Error as e:
+                    print(f"Ошибка чтения кэша embeddings: {e}")
+
+        for key, blob in rows:
+            vector = np.frombuffer(blob, dtype=np.float32)
+            self.memory.set((model_id, key), vector)
+            for text in missing.pop(key):
+                found[text] = vector
+                self.stats.incr("hits_disk")
+        return found
+
+    def _count_misses(self, missing: Dict[str, List[str]]) -> None:
+        for texts_for_key in missing.values():
+            self.stats.incr("misses", len(texts_for_key))
+
+    def get_many(self, model_id: str, texts: List[str]) -> Dict[str, np.ndarray]:
+        """
+        Returns:
+            Словарь текст -> вектор для найденных в кэше текстов
+        """
+        found, missing = self._get_memory(model_id, texts)
+        if missing:
+            found.update(self._get_disk(model_id, missing))
+        self._count_misses(missing)
+        return found
+
+    async def aget_many(self, model_id: str, texts: List[str]) -> Dict[str, np.ndarray]:
+        """
+        get_many для event loop: память проверяется сразу, SQLite читается
+        в отдельном потоке, чтобы запрос к диску не блокировал loop.
+        """
+        found, missing = self._get_memory(model_id, texts)
+        if missing:
+            found.update(await asyncio.to_thread(self._get_disk, model_id, missing))
+        self._count_misses(missing)
+        return found
+
+    def set_many(self, model_id: str, vectors: Dict[str, np.ndarray]) -> None:
+        rows = []
+        for text, vector in vectors.items():
+            key = text_key(text)
+            vector = np.ascontiguousarray(vector, dtype=np.float32)
+            self.memory.set((model_id, key), vector)
+            rows.append((model_id, key, vector.tobytes()))
+
+        with self._db_lock:
+            db = self._connection()
+            if db is None:
+                return
+            try:
+                db.executemany(
+                    "INSERT OR REPLACE INTO embeddings (model, key, vector) VALUES (?, ?, ?)", rows
+                )
+                db.commit()
+            except sqlite3.Error as e:
+                print(f"Ошибка записи кэша embeddings: {e}")
+
+    def encode(self, model_id: str, encode_func, texts: List[str]) -> np.ndarray:
+        """
+        Embeddings для texts: найденные берутся из кэша, остальные считаются
+        одним вызовом encode_func(список текстов) и сохраняются.
+        """
+        found = self.get_many(model_id, texts)
+        missing = list(dict.fromkeys(t for t in texts if t not in found))
+        if missing:
+            computed = dict(zip(missing, np.asarray(encode_func(missing), dtype=np.float32)))
+            self.set_many(model_id, computed)
+            found.update(computed)
+        return np.stack([found[text] for text in texts])
+
+
+embedding_cache = EmbeddingCache()
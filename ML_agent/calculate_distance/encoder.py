@@ -3,12 +3,52 @@ Unified encoding service for text similarity and semantic embeddings.
 Использует разные модели для разных задач:
 - all-MiniLM-L6-v2: для быстрого сравнения названий мест
 - paraphrase-multilingual-MiniLM-L12-v2: для семантического поиска по предпочтениям
+
+ENCODER_BACKEND=onnx запускает обе модели через ONNX Runtime с int8
+квантованием (см. onnx_backend), по умолчанию используется PyTorch.
+
+Синхронные функции (get_similarity, create_semantic_embedding, ...) для
+скриптов и потоков; из event loop они бросают RuntimeError, там используются
+асинхронные версии с пакетной обработкой и чтением кэша вне loop.
 """
 
+import asyncio
+import functools
+import os
+import threading
 from sentence_transformers import SentenceTransformer
 import numpy as np
 from sklearn.metrics.pairwise import cosine_similarity
 from typing import List, Union, Optional
+from calculate_distance.embedding_batcher import EmbeddingBatcher
+from calculate_distance.embedding_cache import embedding_cache
+
+
+NAME_MODEL_ID = 'all-MiniLM-L6-v2'
+SEMANTIC_MODEL_ID = 'paraphrase-multilingual-MiniLM-L12-v2'
+
+# torch или onnx
+ENCODER_BACKEND = os.getenv("ENCODER_BACKEND", "torch")
+if ENCODER_BACKEND == "onnx":
+    # Включенный в конфиге ONNX без зависимостей - ошибка развертывания, а не повод молча взять PyTorch
+    from calculate_distance.onnx_backend import require_onnx
+    require_onnx()
+
+
+def _load_model(model_id: str) -> SentenceTransformer:
+    """Загружает модель в выбранном бэкенде"""
+    if ENCODER_BACKEND == "onnx":
+        from calculate_distance.onnx_backend import load_onnx_model
+        return load_onnx_model(model_id)
+    return SentenceTransformer(model_id)
+
+
+def _cache_id(model_id: str) -> str:
+    """Векторы квантованной модели немного отличаются, поэтому кэшируются отдельно"""
+    if ENCODER_BACKEND == "onnx":
+        from calculate_distance.onnx_backend import ONNX_QUANTIZATION
+        return f"{model_id}:onnx-{ONNX_QUANTIZATION}"
+    return model_id
 
 
 # Модель для сравнения названий (быстрая, для коротких текстов)
@@ -17,12 +57,18 @@ _name_model = None
 # Модель для семантического поиска (мультиязычная, для описаний)
 _semantic_model = None
 
+# Прогрев при старте и первые запросы могут загружать модель из разных потоков
+_name_lock = threading.Lock()
+_semantic_lock = threading.Lock()
+
 
 def _get_name_model() -> SentenceTransformer:
     """Ленивая инициализация модели для сравнения названий."""
     global _name_model
     if _name_model is None:
-        _name_model = SentenceTransformer('all-MiniLM-L6-v2')
+        with _name_lock:
+            if _name_model is None:
+                _name_model = _load_model(NAME_MODEL_ID)
     return _name_model
 
 
@@ -30,12 +76,71 @@ def _get_semantic_model() -> SentenceTransformer:
     """Ленивая инициализация модели для семантического поиска."""
     global _semantic_model
     if _semantic_model is None:
-        _semantic_model = SentenceTransformer('paraphrase-multilingual-MiniLM-L12-v2')
+        with _semantic_lock:
+            if _semantic_model is None:
+                _semantic_model = _load_model(SEMANTIC_MODEL_ID)
     return _semantic_model
 
 
+def _check_onnx_parity(model_id: str, model: SentenceTransformer) -> None:
+    """При ONNX бэкенде сверяет векторы с PyTorch версией, расхождение роняет прогрев"""
+    if ENCODER_BACKEND == "onnx":
+        from calculate_distance.onnx_backend import ONNX_PARITY_CHECK, check_parity
+        if ONNX_PARITY_CHECK:
+            print(f"ONNX {model_id}: cos min {check_parity(model_id, model):.4f}")
+
+
+def warmup_name_model() -> None:
+    """Загрузка и пробный инференс модели названий (минуя embedding_cache)"""
+    _get_name_model().encode(["Озеро Вуокса"], convert_to_numpy=True)
+    _check_onnx_parity(NAME_MODEL_ID, _get_name_model())
+
+
+def warmup_semantic_model() -> None:
+    """Загрузка и пробный инференс семантической модели (минуя embedding_cache)"""
+    _get_semantic_model().encode(["тихое место с пирсом"], convert_to_numpy=True)
+    _check_onnx_parity(SEMANTIC_MODEL_ID, _get_semantic_model())
+
+
+def _encode_names(texts: List[str]) -> np.ndarray:
+    """Embeddings названий с учетом embedding_cache"""
+    return embedding_cache.encode(
+        _cache_id(NAME_MODEL_ID), lambda missing: _get_name_model().encode(missing, convert_to_numpy=True), texts
+    )
+
+
+def _encode_semantic(texts: List[str]) -> np.ndarray:
+    """Семантические embeddings с учетом embedding_cache"""
+    return embedding_cache.encode(
+        _cache_id(SEMANTIC_MODEL_ID), lambda missing: _get_semantic_model().encode(missing, convert_to_numpy=True), texts
+    )
+
+
+def _blocking(async_name: str):
+    """
+    Синхронные функции читают SQLite кэш и запускают модель в вызывающем
+    потоке, поэтому из event loop вызов запрещен: там нужна асинхронная версия.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            try:
+                asyncio.get_running_loop()
+            except RuntimeError:
+                return func(*args, **kwargs)
+            raise RuntimeError(f"{func.__name__} блокирует event loop, используйте {async_name}")
+        return wrapper
+    return decorator
+
+
+# Асинхронные обработчики отправляют тексты в общие очереди с пакетной обработкой
+name_batcher = EmbeddingBatcher(_get_name_model, _cache_id(NAME_MODEL_ID), embedding_cache)
+semantic_batcher = EmbeddingBatcher(_get_semantic_model, _cache_id(SEMANTIC_MODEL_ID), embedding_cache)
+
+
 # ==================== ФУНКЦИИ ДЛЯ СРАВНЕНИЯ НАЗВАНИЙ ====================
 
+@_blocking("aget_similarity")
 def get_similarity(name1: str, name2: str, threshold: float = 0.94) -> bool:
     """
     Сравнивает два названия мест и определяет, являются ли они одним и тем же местом.
@@ -54,23 +159,23 @@ def get_similarity(name1: str, name2: str, threshold: float = 0.94) -> bool:
         True
     """
     try:
-        model = _get_name_model()
-        embeddings = model.encode([name1, name2])
+        embeddings = _encode_names([name1, name2])
         similarity = cosine_similarity([embeddings[0]], [embeddings[1]])[0][0]
         return similarity >= threshold
     except Exception as e:
         print(f"Ошибка при сравнении имен: {e}")
         return False
 
+@_blocking("aget_one_name_embedding")
 def get_one_name_embedding(name1: str) -> list[float]:
     try:
-        model = _get_name_model()
-        embeddings = model.encode(name1)
+        embeddings = _encode_names([name1])[0]
         # Явно конвертируем каждый элемент в float
         return [float(x) for x in embeddings]
     except Exception as e:
         print(f"Ошибка при вычислении сходства: {e}")
         return []
+@_blocking("aget_name_similarity_scores")
 def get_name_similarity_score(name1: str, name2: str) -> float:
     """
     Возвращает числовое значение сходства между названиями (от 0 до 1).
@@ -83,8 +188,7 @@ def get_name_similarity_score(name1: str, name2: str) -> float:
         Значение сходства от 0 до 1
     """
     try:
-        model = _get_name_model()
-        embeddings = model.encode([name1, name2])
+        embeddings = _encode_names([name1, name2])
         similarity = cosine_similarity([embeddings[0]], [embeddings[1]])[0][0]
         return float(similarity)
     except Exception as e:
@@ -92,8 +196,47 @@ def get_name_similarity_score(name1: str, name2: str) -> float:
         return 0.0
 
 
+async def aget_one_name_embedding(name1: str) -> list[float]:
+    """Асинхронная версия get_one_name_embedding (пакетно, вне event loop)"""
+    try:
+        embedding = await name_batcher.encode_one(name1)
+        return [float(x) for x in embedding]
+    except Exception as e:
+        print(f"Ошибка при вычислении сходства: {e}")
+        return []
+
+
+async def aget_name_similarity_scores(name: str, names: List[Optional[str]]) -> np.ndarray:
+    """
+    Сходство названия name с каждым из names одним пакетом (от -1 до 1).
+    Для пустых названий возвращается -1.
+    
+    Example:
+        >>> scores = await aget_name_similarity_scores("бухта Тихая", ["Тихая бухта", None])
+        >>> scores >= 0.94
+        array([ True, False])
+    """
+    scores = np.full(len(names), -1.0)
+    valid = [i for i, other in enumerate(names) if isinstance(other, str) and other]
+    if not valid:
+        return scores
+    try:
+        embeddings = await name_batcher.encode([name] + [names[i] for i in valid])
+        scores[valid] = cosine_similarity(embeddings[:1], embeddings[1:])[0]
+    except Exception as e:
+        print(f"Ошибка при сравнении имен: {e}")
+    return scores
+
+
+async def aget_similarity(name1: str, name2: str, threshold: float = 0.94) -> bool:
+    """Асинхронная версия get_similarity"""
+    scores = await aget_name_similarity_scores(name1, [name2])
+    return bool(scores[0] >= threshold)
+
+
 # ==================== ФУНКЦИИ ДЛЯ СЕМАНТИЧЕСКОГО ПОИСКА ====================
 
+@_blocking("acreate_semantic_embedding")
 def create_semantic_embedding(text: Union[str, List[str]]) -> List[float]:
     """
     Создает векторное представление для семантического поиска.
@@ -112,14 +255,12 @@ def create_semantic_embedding(text: Union[str, List[str]]) -> List[float]:
         384
     """
     try:
-        model = _get_semantic_model()
-        
         # Если список строк - объединяем в один текст
         if isinstance(text, list):
             text = ". ".join(text)
         
-        # Создаем embedding
-        embedding = model.encode(text, convert_to_numpy=True)
+        # Создаем embedding (или берем из кэша)
+        embedding = _encode_semantic([text])[0]
         
         # Преобразуем numpy array в list для JSON
         return embedding.tolist()
@@ -128,6 +269,18 @@ def create_semantic_embedding(text: Union[str, List[str]]) -> List[float]:
         return [0.0] * 384  # Возвращаем нулевой вектор в случае ошибки
 
 
+async def acreate_semantic_embedding(text: Union[str, List[str]]) -> List[float]:
+    """Асинхронная версия create_semantic_embedding (пакетно, вне event loop)"""
+    try:
+        if isinstance(text, list):
+            text = ". ".join(text)
+        embedding = await semantic_batcher.encode_one(text)
+        return embedding.tolist()
+    except Exception as e:
+        print(f"Ошибка при создании embedding: {e}")
+        return [0.0] * 384
+
+
 def calculate_semantic_similarity(embedding1: List[float], embedding2: List[float]) -> float:
     """
     Вычисляет косинусное сходство между двумя векторами.
@@ -202,6 +355,7 @@ def find_most_similar_places(
     return results[:top_k]
 
 
+@_blocking("acreate_semantic_embedding")
 def compare_preferences(
     user_preferences: List[str], 
     place_preferences: List[str]
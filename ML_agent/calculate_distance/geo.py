@@ -0,0 +1,44 @@
+"""
+Расстояния по прямой (по дуге большого круга) без обращения к внешним сервисам.
+"""
+
+from typing import List, Optional, Sequence
+
+import numpy as np
+
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+def coords_to_array(coords: Sequence[Optional[list]]) -> np.ndarray:
+    """
+    Преобразует список координат [lat, lon] в массив (n, 2).
+    Отсутствующие координаты становятся NaN.
+    """
+    array = np.full((len(coords), 2), np.nan)
+    for i, point in enumerate(coords):
+        if point and len(point) >= 2:
+            array[i] = (float(point[0]), float(point[1]))
+    return array
+
+
+def haversine_km(origin: List[float], points: np.ndarray) -> np.ndarray:
+    """
+    Расстояние по прямой от origin до каждой точки.
+
+    Args:
+        origin: [lat, lon] в градусах
+        points: Массив (n, 2) из [lat, lon] в градусах, NaN - нет координат
+
+    Returns:
+        Массив расстояний в км (NaN для точек без координат)
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    lat1, lon1 = np.radians(float(origin[0])), np.radians(float(origin[1]))
+    lat2, lon2 = np.radians(points[:, 0]), np.radians(points[:, 1])
+
+    a = (
+        np.sin((lat2 - lat1) / 2) ** 2
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
@@ -0,0 +1,222 @@
+"""
+Двухуровневый кэш геокодирования для geocode_name_to_coords.
+
+1. LRU в памяти процесса
+2. SQLite файл, переживающий перезапуски сервиса
+
+Неудачные запросы ("место не найдено") тоже кэшируются, но на меньший срок.
+Из event loop используются aget/aset: SQLite работает в отдельном потоке.
+Все обращения к Nominatim проходят через общий ограничитель частоты,
+так как публичный сервис допускает не больше одного запроса в секунду.
+"""
+
+import asyncio
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from cache_utils import CacheStats, LRUCache
+
+
+GEOCODE_CACHE_PATH = os.getenv("GEOCODE_CACHE_PATH", "geocode_cache.sqlite3")
+GEOCODE_TTL = float(os.getenv("GEOCODE_TTL", str(30 * 24 * 3600)))
+GEOCODE_NEGATIVE_TTL = float(os.getenv("GEOCODE_NEGATIVE_TTL", str(24 * 3600)))
+GEOCODE_MEMORY_SIZE = int(os.getenv("GEOCODE_MEMORY_SIZE", "10000"))
+NOMINATIM_MIN_INTERVAL = float(os.getenv("NOMINATIM_MIN_INTERVAL", "1.0"))
+
+# Запись в кэше: координаты или None для "место не найдено"
+CachedCoords = Optional[List[float]]
+
+
+def normalize_query(name: str) -> str:
+    """Приводит запрос к ключу кэша: регистр, ё, пробелы и пунктуация по краям"""
+    key = name.lower().replace("ё", "е")
+    key = re.sub(r"\s+", " ", key)
+    return key.strip(" .,;:!?\"'«»")
+
+
+class RateLimiter:
+    """Глобальный ограничитель: не чаще одного запроса в min_interval секунд"""
+
+    def __init__(self, min_interval: float):
+        self.min_interval = min_interval
+        self._lock = asyncio.Lock()
+        self._last_call = 0.0
+
+    async def wait(self) -> None:
+        async with self._lock:
+            delay = self._last_call + self.min_interval - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._last_call = time.monotonic()
+
+
+class GeocodeCache:
+    """Кэш name -> [lat, lon] с LRU в памяти и SQLite на диске"""
+
+    def __init__(
+        self,
+        path: str = GEOCODE_CACHE_PATH,
+        ttl: float = GEOCODE_TTL,
+        negative_ttl: float = GEOCODE_NEGATIVE_TTL,
+        memory_size: int = GEOCODE_MEMORY_SIZE
+    ):
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.memory = LRUCache(maxsize=memory_size)
+        self.stats = CacheStats()
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_lock = threading.Lock()
+
+    def _connection(self) -> Optional[sqlite3.Connection]:
+        if self._db is None and self.path:
+            try:
+                db = sqlite3.connect(self.path, check_same_thread=False)
+                db.execute(
+                    "CREATE TABLE IF NOT EXISTS geocode ("
+                    "key TEXT PRIMARY KEY, lat REAL, lon REAL, expires_at REAL NOT NULL)"
+                )
+                db.commit()
+                self._db = db
+            except sqlite3.Error as e:
+                print(f"Кэш геокодирования на диске недоступен: {e}")
+                self.path = None
+        return self._db
+
+    def _get_memory(self, key: str):
+        """Запись из памяти или False, если ее там нет"""
+        entry = self.memory.get(key, default=False)
+        if entry is not False:
+            self.stats.incr("hits_memory" if entry else "hits_negative")
+        return entry
+
+    def _get_disk(self, key: str) -> Tuple[bool, CachedCoords]:
+        with self._db_lock:
+            db = self._connection()
+            row = None
+            if db is not None:
+                try:
+                    row = db.execute(
+                        "SELECT lat, lon, expires_at FROM geocode WHERE key = ?", (key,)
+                    ).fetchone()
+                except sqlite3.Error as e:
+                    print(f"Ошибка чтения кэша геокодирования: {e}")
+
+        if row is not None and row[2] > time.time():
+            coords = [row[0], row[1]] if row[0] is not None else None
+            self.memory.set(key, coords, ttl=row[2] - time.time())
+            self.stats.incr("hits_disk" if coords else "hits_negative")
+            return True, coords
+
+        self.stats.incr("misses")
+        return False, None
+
+    def get(self, name: str) -> Tuple[bool, CachedCoords]:
+        """
+        Returns:
+            (найдено_в_кэше, координаты или None для отрицательной записи)
+        """
+        key = normalize_query(name)
+        entry = self._get_memory(key)
+        if entry is not False:
+            return True, entry
+        return self._get_disk(key)
+
+    async def aget(self, name: str) -> Tuple[bool, CachedCoords]:
+        """get для event loop: SQLite читается в отдельном потоке"""
+        key = normalize_query(name)
+        entry = self._get_memory(key)
+        if entry is not False:
+            return True, entry
+        return await asyncio.to_thread(self._get_disk, key)
+
+    def _get_disk_many(self, keys: List[str]) -> Dict[str, Tuple[bool, CachedCoords]]:
+        """_get_disk для многих ключей одним SELECT ... IN (...)"""
+        rows = []
+        with self._db_lock:
+            db = self._connection()
+            if db is not None:
+                try:
+                    # Ограничение SQLite на число параметров запроса
+                    for i in range(0, len(keys), 500):
+                        chunk = keys[i:i + 500]
+                        rows += db.execute(
+                            f"SELECT key, lat, lon, expires_at FROM geocode "
+                            f"WHERE key IN ({','.join('?' * len(chunk))})",
+                            chunk
+                        ).fetchall()
+                except sqlite3.Error as e:
+                    print(f"Ошибка чтения кэша геокодирования: {e}")
+
+        now = time.time()
+        results: Dict[str, Tuple[bool, CachedCoords]] = {}
+        for key, lat, lon, expires_at in rows:
+            if expires_at > now:
+                coords = [lat, lon] if lat is not None else None
+                self.memory.set(key, coords, ttl=expires_at - now)
+                self.stats.incr("hits_disk" if coords else "hits_negative")
+                results[key] = (True, coords)
+        for key in keys:
+            if key not in results:
+                self.stats.incr("misses")
+                results[key] = (False, None)
+        return results
+
+    async def aget_many(self, names: List[str]) -> Dict[str, Tuple[bool, CachedCoords]]:
+        """
+        aget для списка названий: память проверяется сразу, все остальные
+        ключи читаются из SQLite одним запросом в одном потоке.
+
+        Returns:
+            Словарь название -> (найдено_в_кэше, координаты или None)
+        """
+        results: Dict[str, Tuple[bool, CachedCoords]] = {}
+        missing: Dict[str, List[str]] = {}
+        for name in dict.fromkeys(names):
+            key = normalize_query(name)
+            entry = self._get_memory(key)
+            if entry is not False:
+                results[name] = (True, entry)
+            else:
+                missing.setdefault(key, []).append(name)
+
+        if missing:
+            found = await asyncio.to_thread(self._get_disk_many, list(missing))
+            for key, names_for_key in missing.items():
+                for name in names_for_key:
+                    results[name] = found[key]
+        return results
+
+    def _set_disk(self, key: str, coords: CachedCoords, ttl: float) -> None:
+        with self._db_lock:
+            db = self._connection()
+            if db is None:
+                return
+            try:
+                db.execute(
+                    "INSERT OR REPLACE INTO geocode (key, lat, lon, expires_at) VALUES (?, ?, ?, ?)",
+                    (key, coords[0] if coords else None, coords[1] if coords else None, time.time() + ttl)
+                )
+                db.commit()
+            except sqlite3.Error as e:
+                print(f"Ошибка записи кэша геокодирования: {e}")
+
+    def set(self, name: str, coords: CachedCoords) -> None:
+        key = normalize_query(name)
+        ttl = self.ttl if coords else self.negative_ttl
+        self.memory.set(key, coords, ttl=ttl)
+        self._set_disk(key, coords, ttl)
+
+    async def aset(self, name: str, coords: CachedCoords) -> None:
+        """set для event loop: память обновляется сразу, SQLite в отдельном потоке"""
+        key = normalize_query(name)
+        ttl = self.ttl if coords else self.negative_ttl
+        self.memory.set(key, coords, ttl=ttl)
+        await asyncio.to_thread(self._set_disk, key, coords, ttl)
+
+geocode_cache = GeocodeCache()
+nominatim_limiter = RateLimiter(NOMINATIM_MIN_INTERVAL)
@@ -1,41 +1,180 @@
+import asyncio
+import os
+import time
 import httpx
 import requests
+from typing import Dict, List, Optional
+from endpoints.http_clients import get_client, OSRM, NOMINATIM
+from calculate_distance.geocode_cache import geocode_cache, nominatim_limiter
+from calculate_distance.route_cache import route_cache
+
+OSRM_URL = os.getenv("OSRM_URL", "http://router.project-osrm.org")
+# Публичный OSRM ограничивает размер таблицы 100 координатами
+OSRM_TABLE_BATCH = int(os.getenv("OSRM_TABLE_BATCH", "50"))
+# Сколько одновременных /route запросов допускается при откате с /table
+OSRM_ROUTE_CONCURRENCY = int(os.getenv("OSRM_ROUTE_CONCURRENCY", "8"))
+
+
+def _route_result(distance_m: float, duration_s: float) -> dict:
+    return {
+        'success': True,
+        'distance_km': round(distance_m / 1000, 2),
+        'duration_minutes': round(duration_s / 60, 0),
+        'message': (
+            f"Расстояние: {distance_m / 1000:.1f} км, "
+            f"время в пути: {duration_s / 60:.0f} мин"
+        )
+    }
 
 
 async def get_route(start_coord: list, end_coord: list) -> dict:
     """
     Асинхронная функция для расчёта маршрута до рыбацкого места через OSRM.
+    Успешные маршруты кэшируются в route_cache по квантованным координатам.
     """
-    osrm_url = "http://router.project-osrm.org"
+    key = route_cache.key(start_coord, end_coord)
+    cached = await route_cache.get(key)
+    if cached is not None:
+        return cached
+
+    async def fetch():
+        started = time.perf_counter()
+        route = await _fetch_route(start_coord, end_coord)
+        route_cache.set(key, route, (time.perf_counter() - started) * 1000)
+        return route
+
+    return await route_cache.inflight.do(key, fetch)
+
+
+async def _fetch_route(start_coord: list, end_coord: list) -> dict:
+    """Запрос маршрута к OSRM /route/v1 без кэша"""
+    osrm_url = OSRM_URL
     start_str = f"{start_coord[1]},{start_coord[0]}"
     end_str   = f"{end_coord[1]},{end_coord[0]}"
     url       = f"{osrm_url}/route/v1/driving/{start_str};{end_str}"
     params    = {'overview': 'false'}
 
-    async with httpx.AsyncClient(timeout=5.0) as client:
+    client = get_client(OSRM)
+    try:
+        resp = await client.get(url, params=params)
+        resp.raise_for_status()
+        data = resp.json()
+        if data.get('code') == 'Ok' and data.get('routes'):
+            route = data['routes'][0]
+            return _route_result(route['distance'], route['duration'])
+    except httpx.RequestError as e:
+        # ошибка сети, таймаут и т.п.
+        return {'success': False, 'message': f"Ошибка запроса: {e}"}
+    except httpx.HTTPStatusError as e:
+        # не-2xx ответ
+        return {'success': False, 'message': f"HTTP ошибка: {e.response.status_code}"}
+    except Exception:
+        return {'success': False, 'message': "Функция расчёта маршрута временно недоступна"}
+
+
+async def _get_table(start_coord: list, end_coords: List[list]) -> List[dict]:
+    """
+    Один запрос к OSRM /table/v1 от start_coord до всех end_coords.
+    Бросает исключение, если сервис недоступен или ответ некорректен.
+    """
+    coords = ";".join(f"{c[1]},{c[0]}" for c in [start_coord] + end_coords)
+    url = f"{OSRM_URL}/table/v1/driving/{coords}"
+    params = {
+        'sources': '0',
+        'destinations': ";".join(str(i) for i in range(1, len(end_coords) + 1)),
+        'annotations': 'distance,duration',
+    }
+    client = get_client(OSRM)
+    resp = await client.get(url, params=params)
+    resp.raise_for_status()
+    data = resp.json()
+    if data.get('code') != 'Ok':
+        raise ValueError(f"OSRM table: {data.get('code')}")
+    if len(data['distances'][0]) != len(end_coords) or len(data['durations'][0]) != len(end_coords):
+        raise ValueError("OSRM table: число маршрутов не совпадает с числом точек")
+
+    results = []
+    for distance_m, duration_s in zip(data['distances'][0], data['durations'][0]):
+        if distance_m is None or duration_s is None:
+            results.append({'success': False, 'message': "Маршрут не найден"})
+        else:
+            results.append(_route_result(distance_m, duration_s))
+    return results
+
+
+async def get_routes(start_coord: list, end_coords: List[Optional[list]]) -> List[Optional[dict]]:
+    """
+    Считает маршруты от start_coord до каждой точки end_coords.
+
+    Точки отправляются в OSRM /table пачками по OSRM_TABLE_BATCH. Если /table
+    недоступен, пачка считается параллельными /route запросами (не более
+    OSRM_ROUTE_CONCURRENCY одновременно).
+
+    Returns:
+        Список в порядке end_coords: словарь как у get_route или None для точек без координат
+    """
+    results: List[Optional[dict]] = [None] * len(end_coords)
+    semaphore = asyncio.Semaphore(OSRM_ROUTE_CONCURRENCY)
+
+    # Сначала кэш; одинаковые квантованные точки считаются один раз
+    pending: Dict[tuple, List[int]] = {}
+    for i, coords in enumerate(end_coords):
+        if not coords:
+            continue
+        key = route_cache.key(start_coord, coords)
+        cached = await route_cache.get(key)
+        if cached is not None:
+            results[i] = cached
+        else:
+            pending.setdefault(key, []).append(i)
+
+    # Пары, которые уже считает другой запрос, просто ждем
+    mine, waiting = route_cache.inflight.claim(pending)
+    routes: Dict[tuple, Optional[dict]] = {}
+
+    async def route_one(key: tuple):
+        async with semaphore:
+            return await _fetch_route(start_coord, end_coords[pending[key][0]])
+
+    async def route_batch(keys: List[tuple]):
+        started = time.perf_counter()
+        error: BaseException = ValueError("OSRM: маршрут не получен")
+        try:
+            try:
+                table = await _get_table(start_coord, [end_coords[pending[key][0]] for key in keys])
+            except Exception as e:
+                print(f"OSRM table недоступен, считаем маршруты по одному: {e}")
+                table = await asyncio.gather(*(route_one(key) for key in keys))
+
+            latency_ms = (time.perf_counter() - started) * 1000 / len(keys)
+            for key, route in zip(keys, table):
+                routes[key] = route
+                route_cache.set(key, route, latency_ms)
+                route_cache.inflight.resolve(key, route)
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            # Каждый захваченный ключ должен завершиться, иначе следующий
+            # запрос этого маршрута будет ждать его вечно
+            for key in keys:
+                if key not in routes:
+                    route_cache.inflight.reject(key, error)
+
+    indexes = list(mine)
+    batches = [indexes[i:i + OSRM_TABLE_BATCH] for i in range(0, len(indexes), OSRM_TABLE_BATCH)]
+    await asyncio.gather(*(route_batch(batch) for batch in batches))
+
+    for key, future in waiting.items():
         try:
-            resp = await client.get(url, params=params)
-            resp.raise_for_status()
-            data = resp.json()
-            if data.get('code') == 'Ok' and data.get('routes'):
-                route = data['routes'][0]
-                return {
-                    'success': True,
-                    'distance_km': round(route['distance'] / 1000, 2),
-                    'duration_minutes': round(route['duration'] / 60, 0),
-                    'message': (
-                        f"Расстояние: {route['distance'] / 1000:.1f} км, "
-                        f"время в пути: {route['duration'] / 60:.0f} мин"
-                    )
-                }
-        except httpx.RequestError as e:
-            # ошибка сети, таймаут и т.п.
-            return {'success': False, 'message': f"Ошибка запроса: {e}"}
-        except httpx.HTTPStatusError as e:
-            # не-2xx ответ
-            return {'success': False, 'message': f"HTTP ошибка: {e.response.status_code}"}
+            routes[key] = await asyncio.shield(future)
         except Exception:
-            return {'success': False, 'message': "Функция расчёта маршрута временно недоступна"}
+            routes[key] = None
+
+    for key, positions in pending.items():
+        for i in positions:
+            results[i] = routes.get(key)
+    return results
 
     
                 
@@ -43,23 +182,46 @@ async def get_route(start_coord: list, end_coord: list) -> dict:
 async def geocode_name_to_coords(name: str) -> list:
     """
     Функция геокодирования названия места в координаты (широта, долгота)
-    Использует Nominatim OpenStreetMap API
+    Использует Nominatim OpenStreetMap API, результаты (в том числе
+    "место не найдено") кэшируются в geocode_cache.
     """
+    found, coords = await geocode_cache.aget(name)
+    if found:
+        if coords is None:
+            raise ValueError(f"Не удалось геокодировать место: {name}")
+        return coords
+
+    try:
+        coords = await _fetch_coords(name)
+    except ValueError:
+        await geocode_cache.aset(name, None)
+        raise
+    except Exception:
+        geocode_cache.stats.incr("errors")
+        raise
+
+    await geocode_cache.aset(name, coords)
+    return coords
+
+
+async def _fetch_coords(name: str) -> list:
+    """Запрос к Nominatim с учетом глобального ограничения частоты"""
+    await nominatim_limiter.wait()
     url = 'https://nominatim.openstreetmap.org/search'
     params = {
         'q': name,
         'format': 'json',
         'limit': 1,
     }
-    async with httpx.AsyncClient(timeout=10) as client:
-        resp = await client.get(url, params=params)
-        resp.raise_for_status()
-        results = resp.json()
-        if not results:
-            raise ValueError(f"Не удалось геокодировать место: {name}")
-        lat = float(results[0]['lat'])
-        lon = float(results[0]['lon'])
-        return [lat, lon]
+    client = get_client(NOMINATIM)
+    resp = await client.get(url, params=params)
+    resp.raise_for_status()
+    results = resp.json()
+    if not results:
+        raise ValueError(f"Не удалось геокодировать место: {name}")
+    lat = float(results[0]['lat'])
+    lon = float(results[0]['lon'])
+    return [lat, lon]
 
 # async def check_similarity_places_by_coordinates(distance1, distance2):
 #     if abs(distance1-distance2) < 10:
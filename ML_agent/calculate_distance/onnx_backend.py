@@ -0,0 +1,169 @@
+"""
+ONNX Runtime бэкенд для моделей sentence-transformers (ENCODER_BACKEND=onnx).
+
+При первом запуске модель экспортируется в ONNX, квантуется динамически
+в int8 (ONNX_QUANTIZATION) и сохраняется в ONNX_MODEL_DIR, дальше
+загружается уже готовый файл. Модули пулинга те же, что у PyTorch версии,
+поэтому размерность и нормализация векторов не меняются.
+
+Требует optimum[onnxruntime] (requirements-onnx.txt, в Docker: --build-arg
+ENCODER_EXTRAS=onnx). Если ENCODER_BACKEND=onnx, а зависимостей нет, сервис
+не стартует, а не откатывается молча на PyTorch. При прогреве (ONNX_PARITY_CHECK=1)
+векторы сверяются с PyTorch версией, расхождение роняет шаг прогрева.
+
+Проверка точности (код выхода 1 при расхождении) и скорости:
+    python -m calculate_distance.onnx_backend --check
+    python -m calculate_distance.onnx_backend
+"""
+
+import importlib.util
+import os
+import sys
+import time
+from typing import List, Optional
+
+import numpy as np
+from sentence_transformers import SentenceTransformer
+
+
+ONNX_MODEL_DIR = os.getenv("ONNX_MODEL_DIR", "onnx_models")
+# avx2, avx512, avx512_vnni, arm64 или none (ONNX без квантования)
+ONNX_QUANTIZATION = os.getenv("ONNX_QUANTIZATION", "avx2")
+# Сверять векторы ONNX и PyTorch версий при прогреве
+ONNX_PARITY_CHECK = os.getenv("ONNX_PARITY_CHECK", "1") == "1"
+
+# Минимальное косинусное сходство с PyTorch версией на контрольном корпусе
+PARITY_THRESHOLD = 0.99
+
+PARITY_CORPUS = [
+    "Озеро Вуокса",
+    "Река Нева у моста",
+    "Выборгский залив, бухта Тихая",
+    "тихая бухта, залив Выборгский",
+    "Кемпинг Ласковый берег",
+    "Станция метро Автово",
+    "хочу тихое место с пирсом",
+    "нужна парковка и можно с ночевкой",
+    "есть душ и туалеты, хороший подход к воде",
+    "оборудованные костровища, парковка для авто",
+    "песчаное дно, защищено от ветра, есть беседка",
+    "хочу поймать щуку и окуня на спиннинг",
+    "место для семьи с детьми, есть пляж",
+    "глубокое место с корягами, клюет судак",
+    "Карельский перешеек, у озера Суходольское",
+    "Lake with a pier and quiet camping spots",
+]
+
+
+def require_onnx() -> None:
+    """Бросает RuntimeError, если optimum[onnxruntime] не установлен"""
+    missing = [name for name in ("optimum", "onnxruntime") if importlib.util.find_spec(name) is None]
+    if missing:
+        raise RuntimeError(
+            f"ENCODER_BACKEND=onnx, но не установлены {', '.join(missing)}: "
+            f"pip install -r requirements-onnx.txt или ENCODER_BACKEND=torch"
+        )
+
+
+def _local_dir(model_id: str) -> str:
+    return os.path.join(ONNX_MODEL_DIR, model_id.replace("/", "__"))
+
+
+def _file_name(quantization: str) -> str:
+    if quantization == "none":
+        return "onnx/model.onnx"
+    return f"onnx/model_{quantization}.onnx"
+
+
+def load_onnx_model(model_id: str, quantization: str = ONNX_QUANTIZATION) -> SentenceTransformer:
+    """Загружает (при необходимости экспортирует и квантует) ONNX версию модели"""
+    local_dir = _local_dir(model_id)
+    file_name = _file_name(quantization)
+
+    if not os.path.exists(os.path.join(local_dir, file_name)):
+        print(f"Экспорт {model_id} в ONNX ({quantization}) в {local_dir}")
+        model = SentenceTransformer(model_id, backend="onnx")
+        model.save(local_dir)
+        if quantization != "none":
+            from sentence_transformers import export_dynamic_quantized_onnx_model
+            export_dynamic_quantized_onnx_model(
+                model,
+                quantization_config=quantization,
+                model_name_or_path=local_dir,
+                file_suffix=quantization
+            )
+
+    return SentenceTransformer(local_dir, backend="onnx", model_kwargs={"file_name": file_name})
+
+
+def parity(
+    model_id: str,
+    candidate: Optional[SentenceTransformer] = None,
+    corpus: List[str] = PARITY_CORPUS
+) -> float:
+    """Минимальное косинусное сходство векторов ONNX и PyTorch версий на корпусе"""
+    reference = SentenceTransformer(model_id, device="cpu").encode(corpus, convert_to_numpy=True)
+    candidate = candidate if candidate is not None else load_onnx_model(model_id)
+    vectors = candidate.encode(corpus, convert_to_numpy=True)
+    if reference.shape != vectors.shape:
+        raise RuntimeError(f"Размерность ONNX {model_id}: {vectors.shape} вместо {reference.shape}")
+    cosine = np.sum(reference * vectors, axis=1) / (
+        np.linalg.norm(reference, axis=1) * np.linalg.norm(vectors, axis=1)
+    )
+    return float(cosine.min())
+
+
+def check_parity(model_id: str, candidate: Optional[SentenceTransformer] = None) -> float:
+    """parity с проверкой порога: RuntimeError, если ONNX версия расходится с PyTorch"""
+    min_cosine = parity(model_id, candidate)
+    if min_cosine < PARITY_THRESHOLD:
+        raise RuntimeError(
+            f"Точность ONNX {model_id} ({ONNX_QUANTIZATION}) ниже порога: "
+            f"cos min {min_cosine:.4f} < {PARITY_THRESHOLD}"
+        )
+    return min_cosine
+
+
+def throughput(model: SentenceTransformer, corpus: List[str] = PARITY_CORPUS, repeats: int = 20) -> float:
+    """Текстов в секунду на CPU при пачках по размеру корпуса"""
+    model.encode(corpus)
+    started = time.perf_counter()
+    for _ in range(repeats):
+        model.encode(corpus, batch_size=len(corpus))
+    return repeats * len(corpus) / (time.perf_counter() - started)
+
+
+def _check() -> None:
+    """Только проверка точности обеих моделей, для CI и сборки образа"""
+    from calculate_distance.encoder import NAME_MODEL_ID, SEMANTIC_MODEL_ID
+
+    require_onnx()
+    for model_id in (NAME_MODEL_ID, SEMANTIC_MODEL_ID):
+        print(f"{model_id}: cos min {check_parity(model_id):.4f} OK")
+
+
+def _benchmark() -> None:
+    from calculate_distance.encoder import NAME_MODEL_ID, SEMANTIC_MODEL_ID
+
+    require_onnx()
+    failed = False
+    for model_id in (NAME_MODEL_ID, SEMANTIC_MODEL_ID):
+        min_cosine = parity(model_id)
+        ok = min_cosine >= PARITY_THRESHOLD
+        failed |= not ok
+        torch_speed = throughput(SentenceTransformer(model_id, device="cpu"))
+        onnx_speed = throughput(load_onnx_model(model_id))
+        print(
+            f"{model_id}: cos min {min_cosine:.4f} ({'OK' if ok else 'FAIL'}), "
+            f"torch {torch_speed:.0f} текст/с, onnx {ONNX_QUANTIZATION} {onnx_speed:.0f} текст/с "
+            f"(x{onnx_speed / torch_speed:.2f})"
+        )
+    if failed:
+        raise SystemExit(f"Точность ONNX ниже {PARITY_THRESHOLD}")
+
+
+if __name__ == "__main__":
+    try:
+        _check() if "--check" in sys.argv else _benchmark()
+    except RuntimeError as e:
+        raise SystemExit(str(e))
@@ -0,0 +1,238 @@
+"""
+Поиск уже существующего места для /compare_location.
+
+Раньше каждое место типа отдыха проверялось по очереди: сравнение названий
+моделью, геокодирование и маршрут OSRM. Теперь в два этапа:
+
+1. Пространственный: расстояние по прямой до всех мест одним вызовом
+   haversine_km, дальше рассматриваются только места внутри DEDUP_RADIUS_KM
+   и места без координат.
+2. Названия оставшихся кандидатов сравниваются одной пачкой по векторам
+   из embedding_cache. Повторный анализ LLM делает вызывающий код для
+   единственного найденного места.
+
+Место совпадает, если до него меньше DEDUP_RADIUS_KM, или если совпадает
+название, а расстояние посчитать нельзя. Возвращается первое подходящее место
+в порядке списка, с координатами, полученными геокодированием, если в
+каталоге их нет (как и раньше).
+
+Места без координат и без записи в geocode_cache геокодируются через
+Nominatim, если у сообщения есть координаты, чтобы совпадение по расстоянию
+проверялось и для них. За запрос геокодируется не больше DEDUP_GEOCODE_LIMIT
+таких мест: результат (и "не найдено") попадает в geocode_cache, так что
+каждое название запрашивается один раз. Места сверх лимита в этом запросе
+сравниваются только по названию и проверяются по расстоянию в следующих.
+
+Расстояние (DEDUP_DISTANCE):
+- haversine: по прямой, без сетевых запросов. Для проверки "то же место"
+  это и нужно: маршрут OSRM для автомобиля через залив или озеро намного
+  длиннее прямой, и одно место на разных берегах считалось разными.
+- road: прежняя проверка по дороге через OSRM (для сравнения решений).
+
+Сравнение режимов на текущем каталоге и замер скорости:
+    python -m calculate_distance.place_dedup [тип отдыха] [число мест]
+"""
+
+import asyncio
+import os
+import sys
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from calculate_distance.encoder import aget_name_similarity_scores
+from calculate_distance.geo import coords_to_array, haversine_km
+from calculate_distance.geocode_cache import geocode_cache
+from calculate_distance.map import geocode_name_to_coords, get_routes
+
+
+DEDUP_RADIUS_KM = float(os.getenv("DEDUP_RADIUS_KM", "2"))
+DEDUP_NAME_THRESHOLD = float(os.getenv("DEDUP_NAME_THRESHOLD", "0.94"))
+# haversine или road
+DEDUP_DISTANCE = os.getenv("DEDUP_DISTANCE", "haversine")
+DEDUP_GEOCODE_LIMIT = int(os.getenv("DEDUP_GEOCODE_LIMIT", "20"))
+
+
+async def _known_coords(places: List[Dict]) -> List[Tuple[Optional[list], bool]]:
+    """
+    Returns:
+        Для каждого места (координаты или None, известен ли ответ без запроса к Nominatim)
+    """
+    names = [
+        place.get("name_place") for place in places
+        if not place.get("place_coordinates")
+        and isinstance(place.get("name_place"), str) and place.get("name_place")
+    ]
+    # Все названия без координат - одним чтением geocode_cache
+    cached = await geocode_cache.aget_many(names) if names else {}
+
+    resolved = []
+    for place in places:
+        coords = place.get("place_coordinates")
+        name = place.get("name_place")
+        if coords:
+            resolved.append((coords, True))
+        elif not isinstance(name, str) or not name:
+            resolved.append((None, True))
+        else:
+            found, coords = cached[name]
+            resolved.append((coords, found))
+    return resolved
+
+
+async def _geocode(name: str) -> Optional[list]:
+    try:
+        return await geocode_name_to_coords(name)
+    except ValueError:
+        return None
+    except Exception as e:
+        print(f"Ошибка геокодирования места {name}: {e}")
+        return None
+
+
+async def _close_enough(
+    target_coords: list,
+    points: List[list],
+    distances: np.ndarray,
+    mode: str
+) -> List[bool]:
+    """Ближе ли DEDUP_RADIUS_KM каждая из точек (distances - уже посчитанные расстояния по прямой)"""
+    near = [bool(d < DEDUP_RADIUS_KM) for d in distances]
+    if mode != "road":
+        return near
+
+    # Дорога не короче прямой: маршрут нужен только для точек внутри радиуса
+    indexes = [i for i, ok in enumerate(near) if ok]
+    routes = await get_routes(target_coords, [points[i] for i in indexes])
+    for i, route in zip(indexes, routes):
+        near[i] = bool(route) and route.get("distance_km", float("inf")) < DEDUP_RADIUS_KM
+    return near
+
+
+async def find_existing_place(
+    target_name: str,
+    target_coords: Optional[list],
+    places: List[Dict],
+    mode: str = DEDUP_DISTANCE
+) -> Optional[Tuple[Dict, Optional[list]]]:
+    """
+    Ищет среди places то же место, что и target_name / target_coords.
+
+    Returns:
+        (место, его координаты или None) или None, если место новое
+    """
+    if not places:
+        return None
+
+    resolved = await _known_coords(places)
+
+    if target_coords:
+        # Места без координат, которых нет и в geocode_cache: иначе расстояние до них неизвестно
+        unknown = [i for i, (coords, known) in enumerate(resolved) if not known][:DEDUP_GEOCODE_LIMIT]
+        geocoded = await asyncio.gather(*(_geocode(places[i].get("name_place")) for i in unknown))
+        for i, coords in zip(unknown, geocoded):
+            resolved[i] = (coords, True)
+
+    points = coords_to_array([coords for coords, _ in resolved])
+
+    if target_coords:
+        distances = haversine_km(target_coords, points)
+        candidates = np.flatnonzero(~(distances >= DEDUP_RADIUS_KM))
+    else:
+        distances = np.full(len(places), np.nan)
+        candidates = np.arange(len(places))
+    if candidates.size == 0:
+        return None
+
+    name_scores = await aget_name_similarity_scores(
+        target_name, [places[i].get("name_place") for i in candidates]
+    )
+    name_match = dict(zip(candidates.tolist(), (name_scores >= DEDUP_NAME_THRESHOLD).tolist()))
+
+    close: Dict[int, bool] = {}
+    if target_coords:
+        with_coords = [int(i) for i in candidates if not np.isnan(distances[i])]
+        flags = await _close_enough(
+            target_coords, [resolved[i][0] for i in with_coords], distances[with_coords], mode
+        )
+        close = dict(zip(with_coords, flags))
+
+    for i in candidates.tolist():
+        place = places[i]
+        coords, known = resolved[i]
+
+        if target_coords and coords:
+            if close.get(i):
+                return place, coords
+            continue
+
+        if not name_match[i]:
+            continue
+
+        if not known:
+            # Координаты сообщения нет (или лимит геокодирования исчерпан):
+            # место совпало по названию, координаты нужны для ответа
+            coords = await _geocode(place.get("name_place"))
+            if coords and target_coords:
+                distance = haversine_km(target_coords, coords_to_array([coords]))
+                if not (await _close_enough(target_coords, [coords], distance, mode))[0]:
+                    continue
+        return place, coords
+
+    return None
+
+
+def _benchmark_haversine(sizes=(1_000, 10_000, 100_000), repeats: int = 20) -> None:
+    """Время отбора кандидатов по прямой на синтетических координатах"""
+    rng = np.random.default_rng(0)
+    origin = [60.0, 30.0]
+    for n in sizes:
+        points = np.column_stack([rng.uniform(59, 61, n), rng.uniform(28, 32, n)])
+        started = time.perf_counter()
+        for _ in range(repeats):
+            np.flatnonzero(~(haversine_km(origin, points) >= DEDUP_RADIUS_KM))
+        print(f"n={n:>7}: haversine {(time.perf_counter() - started) * 1000 / repeats:7.3f} мс")
+
+
+async def _compare_modes(relax_type: str, limit: int) -> None:
+    """
+    Каждое место каталога (с координатами) ищется среди остальных в обоих
+    режимах: считаем, сколько решений "то же место / новое" меняется.
+    """
+    from endpoints.endpoints_with_backend import get_all_places_by_type
+    from endpoints.http_clients import http_clients
+
+    try:
+        places = await get_all_places_by_type(relax_type)
+    finally:
+        await http_clients.aclose()
+    sample = [i for i, place in enumerate(places) if place.get("place_coordinates")][:limit]
+
+    timings = {"haversine": 0.0, "road": 0.0}
+    changed = []
+    for i in sample:
+        place = places[i]
+        others = places[:i] + places[i + 1:]
+        decisions = {}
+        for mode in timings:
+            started = time.perf_counter()
+            match = await find_existing_place(place.get("name_place"), place["place_coordinates"], others, mode)
+            timings[mode] += time.perf_counter() - started
+            decisions[mode] = match[0].get("name_place") if match else None
+        if decisions["haversine"] != decisions["road"]:
+            changed.append((place.get("name_place"), decisions["road"], decisions["haversine"]))
+
+    print(f"{relax_type}: {len(sample)} мест из {len(places)}, изменилось решений: {len(changed)}")
+    for mode, total in timings.items():
+        print(f"  {mode}: {total * 1000 / max(len(sample), 1):.1f} мс на сообщение")
+    for name, road, straight in changed:
+        print(f"  {name}: road -> {road}, haversine -> {straight}")
+
+
+if __name__ == "__main__":
+    _benchmark_haversine()
+    asyncio.run(_compare_modes(
+        sys.argv[1] if len(sys.argv) > 1 else "рыбалка",
+        int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    ))
@@ -0,0 +1,234 @@
+"""
+Векторизованное ранжирование мест по embeddings.
+
+Хранит name_embedding / preferences_embedding всех мест одного type_of_relax
+в виде заранее нормализованных float32 матриц. Запрос оценивается одним
+умножением матрицы на вектор, топ-k выбирается через argpartition.
+Результат совпадает по порядку с calculate_semantic_similarity +
+calculate_combined_metric из analyze_and_compare_fish_places.
+"""
+
+import time
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+
+NAME_EMBEDDING = "name_embedding"
+PREFERENCES_EMBEDDING = "preferences_embedding"
+
+# Бэкенд (CacheService.PlaceWithEmbeddings) пишет ключ с опечаткой,
+# поэтому читаем оба варианта
+_EMBEDDING_KEYS = {
+    NAME_EMBEDDING: (NAME_EMBEDDING,),
+    PREFERENCES_EMBEDDING: (PREFERENCES_EMBEDDING, "preferences_ebbedding"),
+}
+
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """Нормализует строки матрицы к единичной длине (нулевые строки остаются нулевыми)."""
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def _top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """
+    Индексы k наибольших значений по убыванию.
+
+    При равных значениях порядок такой же, как у стабильной сортировки
+    list.sort(reverse=True): раньше идет место с меньшим индексом.
+    """
+    n = scores.shape[0]
+    if k <= 0 or n == 0:
+        return np.empty(0, dtype=np.int64)
+    if k < n:
+        kth = np.partition(scores, n - k)[n - k]
+        above = np.flatnonzero(scores > kth)
+        ties = np.flatnonzero(scores == kth)[:k - above.shape[0]]
+        candidates = np.concatenate([above, ties])
+    else:
+        candidates = np.arange(n)
+    order = np.lexsort((candidates, -scores[candidates]))
+    return candidates[order]
+
+
+def combined_metric_scores(
+    similarity: np.ndarray,
+    distance_km: Optional[np.ndarray] = None,
+    similarity_weight: float = 0.5,
+    distance_weight: float = 0.5,
+    max_distance: float = 100.0
+) -> np.ndarray:
+    """
+    Векторная версия calculate_combined_metric.
+
+    Args:
+        similarity: Массив similarity (0..1)
+        distance_km: Массив расстояний, NaN означает "расстояние неизвестно"
+
+    Returns:
+        Массив комбинированных метрик
+    """
+    if distance_km is None:
+        distance_score = np.full(similarity.shape, 0.5)
+    else:
+        distance_km = np.asarray(distance_km, dtype=np.float64)
+        distance_score = np.where(
+            np.isnan(distance_km),
+            0.5,
+            np.maximum(0.0, 1.0 - distance_km / max_distance)
+        )
+    return similarity_weight * similarity + distance_weight * distance_score
+
+
+class PlaceRanker:
+    """Индекс embeddings мест одного типа отдыха для быстрого скоринга запросов"""
+
+    def __init__(
+        self,
+        places: Sequence[Dict],
+        matrices: Dict[str, np.ndarray],
+        valid: Dict[str, np.ndarray]
+    ):
+        self.places = list(places)
+        self.ids = [place.get("location_id") for place in self.places]
+        self._positions = {place_id: i for i, place_id in enumerate(self.ids)}
+        self._matrices = matrices
+        self._valid = valid
+
+    @classmethod
+    def from_places(cls, places: Sequence[Dict]) -> "PlaceRanker":
+        """
+        Строит матрицы из списка мест в формате Redis-кэша all_places.
+
+        Args:
+            places: Места с полями location_id, coord_location и embeddings
+        """
+        matrices = {}
+        valid = {}
+        for kind, keys in _EMBEDDING_KEYS.items():
+            vectors = []
+            for place in places:
+                vector = None
+                for key in keys:
+                    vector = place.get(key)
+                    # Векторы бывают и списками (JSON), и np.ndarray (places_binary)
+                    if vector is not None and len(vector):
+                        break
+                vectors.append(vector)
+
+            dim = next((len(v) for v in vectors if v is not None and len(v)), 0)
+            mask = np.array([v is not None and len(v) > 0 and len(v) == dim for v in vectors], dtype=bool)
+            matrix = np.zeros((len(vectors), dim), dtype=np.float32)
+            if mask.any():
+                matrix[mask] = np.asarray(
+                    [v for v, ok in zip(vectors, mask) if ok], dtype=np.float32
+                )
+            matrices[kind] = _normalize_rows(matrix)
+            valid[kind] = mask
+
+        return cls(places, matrices, valid)
+
+    def __len__(self) -> int:
+        return len(self.places)
+
+    def subset(self, ids: Sequence) -> "PlaceRanker":
+        """Новый ranker только по указанным id мест (в порядке self.places)"""
+        rows = sorted(self._positions[i] for i in ids if i in self._positions)
+        return PlaceRanker(
+            [self.places[row] for row in rows],
+            {kind: matrix[rows] for kind, matrix in self._matrices.items()},
+            {kind: mask[rows] for kind, mask in self._valid.items()},
+        )
+
+    def similarities(self, query_embedding: List[float], kind: str) -> np.ndarray:
+        """
+        Similarity запроса со всеми местами, в том же диапазоне [0, 1],
+        что и calculate_semantic_similarity. Места без embedding получают 0.
+        """
+        matrix = self._matrices[kind]
+        if len(self.places) == 0:
+            return np.empty(0, dtype=np.float64)
+
+        query = np.asarray(query_embedding, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if norm == 0 or query.shape[0] != matrix.shape[1]:
+            return np.zeros(len(self.places), dtype=np.float64)
+
+        cosine = matrix @ (query / norm)
+        scores = (cosine.astype(np.float64) + 1.0) / 2.0
+        scores[~self._valid[kind]] = 0.0
+        return scores
+
+    def top_k(
+        self,
+        query_embedding: List[float],
+        kind: str,
+        k: int = 10,
+        distance_km: Optional[np.ndarray] = None
+    ) -> List[Dict]:
+        """
+        Возвращает k лучших мест по комбинированной метрике.
+
+        Args:
+            query_embedding: Вектор запроса
+            kind: NAME_EMBEDDING или PREFERENCES_EMBEDDING
+            k: Количество результатов
+            distance_km: Расстояния до мест (NaN - неизвестно), в порядке self.places
+
+        Returns:
+            Список словарей {"index", "id", "similarity", "combined_metric"}
+            по убыванию combined_metric
+        """
+        similarity = self.similarities(query_embedding, kind)
+        combined = combined_metric_scores(similarity, distance_km)
+        return [
+            {
+                "index": int(i),
+                "id": self.ids[i],
+                "similarity": float(similarity[i]),
+                "combined_metric": float(combined[i]),
+            }
+            for i in _top_k_indices(combined, k)
+        ]
+
+
+def _benchmark(sizes=(1_000, 10_000, 100_000), dim: int = 384, repeats: int = 20):
+    """Сравнение поэлементного цикла и PlaceRanker на синтетических данных."""
+    from calculate_distance.encoder import calculate_semantic_similarity
+
+    rng = np.random.default_rng(0)
+    for n in sizes:
+        vectors = rng.standard_normal((n, dim)).astype(np.float32)
+        places = [
+            {"location_id": i, PREFERENCES_EMBEDDING: vectors[i].tolist()}
+            for i in range(n)
+        ]
+        query = rng.standard_normal(dim).tolist()
+
+        start = time.perf_counter()
+        loop_scores = [
+            calculate_semantic_similarity(p[PREFERENCES_EMBEDDING], query) for p in places
+        ]
+        loop_top = sorted(range(n), key=lambda i: loop_scores[i], reverse=True)[:10]
+        loop_ms = (time.perf_counter() - start) * 1000
+
+        start = time.perf_counter()
+        ranker = PlaceRanker.from_places(places)
+        build_ms = (time.perf_counter() - start) * 1000
+
+        start = time.perf_counter()
+        for _ in range(repeats):
+            top = ranker.top_k(query, PREFERENCES_EMBEDDING, k=10)
+        query_ms = (time.perf_counter() - start) * 1000 / repeats
+
+        same = [item["index"] for item in top] == loop_top
+        print(
+            f"n={n:>7}: цикл {loop_ms:9.1f} мс | построение {build_ms:8.1f} мс | "
+            f"запрос {query_ms:7.2f} мс | порядок совпадает: {same}"
+        )
+
+
+if __name__ == "__main__":
+    _benchmark()
@@ -0,0 +1,125 @@
+"""
+Кэш маршрутов OSRM по квантованным парам координат.
+
+Координаты округляются до ROUTE_CACHE_PRECISION градуса (~100 м), поэтому
+запросы от одной станции метро к одному месту попадают в одну запись.
+Первый уровень - LRU в памяти, второй (опционально) - Redis, запись в
+который выполняется в фоне. Одновременные запросы одной пары ждут
+одного обращения к OSRM (SingleFlight).
+"""
+
+import asyncio
+import json
+import os
+from typing import Dict, Optional, Tuple
+
+from cache_utils import CacheStats, LRUCache, SingleFlight
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:
+    aioredis = None
+
+
+ROUTE_CACHE_PRECISION = float(os.getenv("ROUTE_CACHE_PRECISION", "0.001"))
+ROUTE_CACHE_SIZE = int(os.getenv("ROUTE_CACHE_SIZE", "50000"))
+ROUTE_CACHE_TTL = float(os.getenv("ROUTE_CACHE_TTL", str(7 * 24 * 3600)))
+ROUTE_CACHE_REDIS = os.getenv("ROUTE_CACHE_REDIS", "0") == "1"
+
+RouteKey = Tuple[int, int, int, int]
+
+
+class RouteCache:
+    """Кэш результатов get_route: LRU в памяти + опциональный Redis"""
+
+    def __init__(
+        self,
+        precision: float = ROUTE_CACHE_PRECISION,
+        maxsize: int = ROUTE_CACHE_SIZE,
+        ttl: float = ROUTE_CACHE_TTL,
+        use_redis: bool = ROUTE_CACHE_REDIS
+    ):
+        self.precision = precision
+        self.ttl = ttl
+        self.memory = LRUCache(maxsize=maxsize, ttl=ttl)
+        self.inflight = SingleFlight()
+        self.stats = CacheStats()
+        self._redis = None
+        self._use_redis = use_redis and aioredis is not None
+        self._pending_writes = set()
+
+    def key(self, start_coord: list, end_coord: list) -> RouteKey:
+        q = self.precision
+        return (
+            round(float(start_coord[0]) / q), round(float(start_coord[1]) / q),
+            round(float(end_coord[0]) / q), round(float(end_coord[1]) / q),
+        )
+
+    def _redis_client(self):
+        if self._redis is None:
+            self._redis = aioredis.Redis(
+                host="redis",
+                port=int(os.getenv('REDIS_PORT', '6379')),
+                password=os.getenv('REDIS_PASSWORD', '1lomalsteklo'),
+                decode_responses=True
+            )
+        return self._redis
+
+    @staticmethod
+    def _redis_key(key: RouteKey) -> str:
+        return "route:" + ":".join(str(part) for part in key)
+
+    async def get(self, key: RouteKey) -> Optional[dict]:
+        entry = self.memory.get(key)
+        if entry is not None:
+            self.stats.incr("hits_memory")
+            self.stats.incr("saved_ms", entry["latency_ms"])
+            return entry["route"]
+
+        if self._use_redis:
+            try:
+                raw = await self._redis_client().get(self._redis_key(key))
+                if raw:
+                    entry = json.loads(raw)
+                    self.memory.set(key, entry)
+                    self.stats.incr("hits_redis")
+                    self.stats.incr("saved_ms", entry["latency_ms"])
+                    return entry["route"]
+            except Exception as e:
+                print(f"Ошибка чтения кэша маршрутов из Redis: {e}")
+
+        self.stats.incr("misses")
+        return None
+
+    def set(self, key: RouteKey, route: dict, latency_ms: int) -> None:
+        """Сохраняет только успешные маршруты; Redis обновляется в фоне"""
+        if not route or not route.get("success"):
+            return
+        entry = {"route": route, "latency_ms": int(latency_ms)}
+        self.memory.set(key, entry)
+        if self._use_redis:
+            task = asyncio.create_task(self._write_redis(key, entry))
+            self._pending_writes.add(task)
+            task.add_done_callback(self._pending_writes.discard)
+
+    async def _write_redis(self, key: RouteKey, entry: dict) -> None:
+        try:
+            await self._redis_client().set(self._redis_key(key), json.dumps(entry), ex=int(self.ttl))
+        except Exception as e:
+            print(f"Ошибка записи кэша маршрутов в Redis: {e}")
+
+    def get_stats(self) -> Dict:
+        stats = self.stats.as_dict()
+        stats["size"] = len(self.memory)
+        stats["inflight"] = len(self.inflight)
+        return stats
+
+    async def aclose(self) -> None:
+        if self._pending_writes:
+            await asyncio.gather(*self._pending_writes, return_exceptions=True)
+        if self._redis is not None:
+            await self._redis.aclose()
+            self._redis = None
+
+
+route_cache = RouteCache()
@@ -29,6 +29,10 @@ class CompareLocationRequest(BaseModel):
     message: str
     relax_type: str  # "рыбалка", "кемпинг" 
 
+class CompareLocationBatchRequest(BaseModel):
+    """Пачка сообщений для /compare_location/batch, результаты идут в том же порядке"""
+    items: List[CompareLocationRequest]
+
 class TelegramSearchRequest(BaseModel):
     user_id: int
     query: str
@@ -1,4 +1,5 @@
 import httpx
+from endpoints.http_clients import get_client, BACKEND, BOT_BACKEND
 
 BACKEND_URL = "http://parsing_service:8002/api/Places"
 #BOT_BACKEND_URL = "http://localhost:8003/api"
@@ -25,21 +26,28 @@ async def get_all_places_by_type(
     payload = {
         "type_relax": type_relax
     }
-    async with httpx.AsyncClient(timeout=10.0) as client:
-        resp = await client.post(BACKEND_URL, json=payload)
-        resp.raise_for_status()
-        return resp.json()
+    client = get_client(BACKEND)
+    resp = await client.post(BACKEND_URL, json=payload)
+    resp.raise_for_status()
+    return resp.json()
     
+async def update_place_enrichment(payload: dict) -> None:
+    """Записывает в БД результат фонового пересчета места (см. place_enrichment)"""
+    client = get_client(BACKEND)
+    resp = await client.post(f"{BACKEND_URL}/enrichment", json=payload)
+    resp.raise_for_status()
+
+
 async def get_all_places_by_id(
     places_ids: list[int]
 ) -> list[dict]:
     payload = {
         "idPlaces": places_ids
     }
-    async with httpx.AsyncClient(timeout=10.0) as client:
-        resp = await client.post(f"{BOT_BACKEND_URL}/BotApi/by-id", json=payload)
-        resp.raise_for_status()
-        return resp.json()
+    client = get_client(BOT_BACKEND)
+    resp = await client.post(f"{BOT_BACKEND_URL}/BotApi/by-id", json=payload)
+    resp.raise_for_status()
+    return resp.json()
 
 async def fetch_best_fishing_places(
     target_fish: list[str],
@@ -59,10 +67,10 @@ async def fetch_best_fishing_places(
         "fishType": target_fish,
         "waterType": water_space,
     }
-    async with httpx.AsyncClient(timeout=10.0) as client:
-        resp = await client.post(f"{BOT_BACKEND_URL}/BotApi/by-type", json=payload)
-        resp.raise_for_status()
-        return resp.json()
+    client = get_client(BOT_BACKEND)
+    resp = await client.post(f"{BOT_BACKEND_URL}/BotApi/by-type", json=payload)
+    resp.raise_for_status()
+    return resp.json()
 
 
 async def fetch_places_by_location(locations: list[str]) -> list[dict]:
@@ -78,7 +86,7 @@ async def fetch_places_by_location(locations: list[str]) -> list[dict]:
     payload = {
         "locations": locations
     }
-    async with httpx.AsyncClient(timeout=10.0) as client:
-        resp = await client.post(f"{BACKEND_URL}/by_location", json=payload)
-        resp.raise_for_status()
-        return resp.json()
\ No newline at end of file
+    client = get_client(BACKEND)
+    resp = await client.post(f"{BACKEND_URL}/by_location", json=payload)
+    resp.raise_for_status()
+    return resp.json()
\ No newline at end of file
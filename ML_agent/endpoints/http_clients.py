@@ -0,0 +1,84 @@
+"""
+Общие HTTP клиенты для внешних сервисов.
+
+На каждый upstream (бэкенды, OSRM, Nominatim) создается один
+httpx.AsyncClient с пулом keep-alive соединений, который живет
+всё время работы приложения и закрывается в lifespan FastAPI.
+"""
+
+import os
+from typing import Dict
+
+import httpx
+
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+
+BACKEND = "backend"
+BOT_BACKEND = "bot_backend"
+OSRM = "osrm"
+NOMINATIM = "nominatim"
+
+# Таймауты по умолчанию совпадают с прежними значениями в вызовах
+_UPSTREAMS = {
+    BACKEND: {"timeout": 10.0, "http2": False},
+    BOT_BACKEND: {"timeout": 10.0, "http2": False},
+    OSRM: {"timeout": 5.0, "http2": False},
+    NOMINATIM: {"timeout": 10.0, "http2": True},
+}
+
+
+def _env_float(name: str, default: float) -> float:
+    return float(os.getenv(name, default))
+
+
+class HttpClientRegistry:
+    """Реестр пулов соединений: один клиент на upstream"""
+
+    def __init__(self):
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+
+    def _create(self, name: str) -> httpx.AsyncClient:
+        config = _UPSTREAMS[name]
+        prefix = f"HTTP_{name.upper()}"
+        limits = httpx.Limits(
+            max_connections=int(os.getenv(f"{prefix}_MAX_CONNECTIONS", os.getenv("HTTP_MAX_CONNECTIONS", "50"))),
+            max_keepalive_connections=int(os.getenv(f"{prefix}_MAX_KEEPALIVE", os.getenv("HTTP_MAX_KEEPALIVE", "20"))),
+            keepalive_expiry=_env_float("HTTP_KEEPALIVE_EXPIRY", 30.0),
+        )
+        timeout = httpx.Timeout(
+            _env_float(f"{prefix}_TIMEOUT", config["timeout"]),
+            connect=_env_float("HTTP_CONNECT_TIMEOUT", 5.0),
+        )
+        return httpx.AsyncClient(
+            limits=limits,
+            timeout=timeout,
+            http2=config["http2"] and HTTP2_AVAILABLE,
+            # Nominatim требует осмысленный User-Agent
+            headers={"User-Agent": os.getenv("HTTP_USER_AGENT", "FishAgent-ML/1.0")},
+        )
+
+    def get(self, name: str) -> httpx.AsyncClient:
+        """Возвращает клиент для upstream, создавая его при первом обращении"""
+        client = self._clients.get(name)
+        if client is None or client.is_closed:
+            client = self._create(name)
+            self._clients[name] = client
+        return client
+
+    async def aclose(self) -> None:
+        """Закрывает все клиенты (вызывается при остановке приложения)"""
+        clients, self._clients = self._clients, {}
+        for client in clients.values():
+            await client.aclose()
+
+
+http_clients = HttpClientRegistry()
+
+
+def get_client(name: str) -> httpx.AsyncClient:
+    return http_clients.get(name)
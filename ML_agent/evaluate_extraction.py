@@ -0,0 +1,117 @@
+"""
+Офлайн сравнение совмещенного и двухшагового извлечения запроса пользователя.
+
+Прогоняет записанный набор запросов через оба пути RelaxAnalyzer
+(_aanalyze_search_query_combined и _aanalyze_search_query_two_step)
+и печатает согласованность полей и задержки.
+
+Запуск:
+    python evaluate_extraction.py queries.txt [--output results.jsonl]
+
+Файл запросов: по одному запросу в строке либо JSONL с полем "query".
+"""
+
+import argparse
+import asyncio
+import json
+import time
+from typing import Dict, List
+
+import numpy as np
+from dotenv import load_dotenv
+
+from model_provider import Model
+from relax_analyzer import RelaxAnalyzer
+
+LIST_FIELDS = ("wish_location", "user_preferences", "caught_fishes", "water_space")
+SCALAR_FIELDS = ("type_of_relax", "location_user", "wish_price")
+
+
+def load_queries(path: str) -> List[str]:
+    queries = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith("{"):
+                line = json.loads(line)["query"]
+            queries.append(line)
+    return queries
+
+
+def _normalize(value):
+    if isinstance(value, list):
+        return {str(v).lower().strip() for v in value if v}
+    if isinstance(value, str):
+        return value.lower().strip()
+    return value
+
+
+def compare_fields(combined: Dict, two_step: Dict) -> Dict[str, float]:
+    """Согласованность по полям: 1/0 для скаляров, Жаккар для списков"""
+    scores = {}
+    for field in SCALAR_FIELDS:
+        scores[field] = float(_normalize(combined.get(field)) == _normalize(two_step.get(field)))
+    for field in LIST_FIELDS:
+        a, b = _normalize(combined.get(field) or []), _normalize(two_step.get(field) or [])
+        scores[field] = len(a & b) / len(a | b) if a | b else 1.0
+    return scores
+
+
+async def _timed(coro):
+    start = time.perf_counter()
+    try:
+        _, result = await coro
+        error = None
+    except Exception as e:
+        result, error = None, str(e)
+    return result, (time.perf_counter() - start) * 1000, error
+
+
+async def evaluate(queries: List[str], output: str = None) -> None:
+    analyzer = RelaxAnalyzer(Model())
+    records = []
+    for query in queries:
+        combined, combined_ms, combined_error = await _timed(analyzer._aanalyze_search_query_combined(query))
+        two_step, two_step_ms, two_step_error = await _timed(analyzer._aanalyze_search_query_two_step(query))
+        record = {
+            "query": query,
+            "combined": combined,
+            "two_step": two_step,
+            "combined_ms": combined_ms,
+            "two_step_ms": two_step_ms,
+            "errors": [e for e in (combined_error, two_step_error) if e],
+        }
+        if combined and two_step:
+            record["agreement"] = compare_fields(combined, two_step)
+        records.append(record)
+        print(f"{combined_ms:7.0f} мс / {two_step_ms:7.0f} мс  {query[:60]}")
+
+    if output:
+        with open(output, "w", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    compared = [r["agreement"] for r in records if "agreement" in r]
+    print(f"\nЗапросов: {len(records)}, сравнимых: {len(compared)}")
+    for field in SCALAR_FIELDS + LIST_FIELDS:
+        if compared:
+            print(f"  {field:<18} согласованность {np.mean([c[field] for c in compared]):.3f}")
+    for name in ("combined", "two_step"):
+        latencies = [r[f"{name}_ms"] for r in records if r[name] is not None]
+        if latencies:
+            print(
+                f"  {name:<10} p50 {np.percentile(latencies, 50):7.0f} мс | "
+                f"p90 {np.percentile(latencies, 90):7.0f} мс | "
+                f"ошибок {sum(1 for r in records if r[name] is None)}"
+            )
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("queries", help="Файл с записанными запросами")
+    parser.add_argument("--output", help="Куда сохранить результаты по каждому запросу (JSONL)")
+    args = parser.parse_args()
+    asyncio.run(evaluate(load_queries(args.queries), args.output))
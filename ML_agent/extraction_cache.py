@@ -0,0 +1,398 @@
+"""
+Кэш результатов извлечения информации LLM (RelaxAnalyzer).
+
+Два уровня поиска:
+1. Точное совпадение нормализованного сообщения (LRU в памяти + Redis)
+2. Семантический: берется ранее извлеченный результат, если embedding
+   сообщения ближе EXTRACT_SEMANTIC_THRESHOLD к уже обработанному
+   и результат "подтверждается" новым текстом (см. _is_grounded): совпадают
+   числа и отрицания ("без пирса" / "с пирсом"), а места, рыбы, водоемы и
+   предпочтения упоминаются в новом сообщении
+
+Записи разделены по области (тип отдыха + тип запроса), поэтому ответ для
+кемпинга не будет переиспользован для рыбалки. Redis общий для всех
+ML воркеров: записи живут EXTRACT_CACHE_TTL, а число записей в области
+ограничено EXTRACT_CACHE_SIZE (вытесняются давно не использованные).
+Векторы истекших записей удаляются из Redis при обновлении индекса по
+времени записи (KEY_PREFIX:written:<область>).
+"""
+
+import asyncio
+import copy
+import hashlib
+import json
+import os
+import re
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from cache_utils import CacheStats, LRUCache
+from calculate_distance.geocode_cache import normalize_query
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:
+    aioredis = None
+
+
+EXTRACT_CACHE_ENABLED = os.getenv("EXTRACT_CACHE", "1") == "1"
+EXTRACT_CACHE_REDIS = os.getenv("EXTRACT_CACHE_REDIS", "1") == "1"
+EXTRACT_CACHE_TTL = float(os.getenv("EXTRACT_CACHE_TTL", str(24 * 3600)))
+EXTRACT_CACHE_SIZE = int(os.getenv("EXTRACT_CACHE_SIZE", "5000"))
+EXTRACT_SEMANTIC_THRESHOLD = float(os.getenv("EXTRACT_SEMANTIC_THRESHOLD", "0.95"))
+# Для описаний мест семантическое совпадение слишком рискованно:
+# разные места часто описывают почти одинаковыми словами
+EXTRACT_SEMANTIC_REQUEST_TYPES = set(
+    os.getenv("EXTRACT_SEMANTIC_REQUEST_TYPES", "query_users").split(",")
+)
+# Как часто воркер перечитывает из Redis векторы, добавленные другими воркерами
+EXTRACT_SEMANTIC_REFRESH = float(os.getenv("EXTRACT_SEMANTIC_REFRESH", "10"))
+
+KEY_PREFIX = "extract"
+
+# Поля результата, значения которых должны встречаться в новом сообщении
+_GROUNDED_FIELDS = ("wish_location", "location_user", "name_location", "caught_fishes", "water_space")
+# Предпочтения формулирует LLM, поэтому достаточно совпадения начала слова
+_PREFERENCE_FIELDS = ("user_preferences",)
+_PREFIX_LEN = 4
+_NEGATIONS = {"не", "без", "нет", "кроме", "нельзя"}
+_WORD_RE = re.compile(r"[a-zа-я0-9]+")
+
+
+def _words(text: str) -> List[str]:
+    return _WORD_RE.findall(text.lower().replace("ё", "е"))
+
+
+def _stems(text: str) -> set:
+    """Грубая основа слова: без последней буквы и не длиннее 5 (щука/щуку -> щук)"""
+    return {word[:-1][:5] if len(word) > 3 else word for word in _words(text) if len(word) >= 3}
+
+
+def _numbers(text: str) -> set:
+    return set(re.findall(r"\d+", text))
+
+
+def _prefixes(text: str) -> set:
+    return {word[:_PREFIX_LEN] for word in _words(text) if len(word) >= _PREFIX_LEN}
+
+
+def _negated(text: str) -> set:
+    """Пары (отрицание, начало следующего слова): "без пирса" -> {("без", "пирс")}"""
+    words = _words(text)
+    return {
+        (word, words[i + 1][:_PREFIX_LEN])
+        for i, word in enumerate(words[:-1]) if word in _NEGATIONS
+    }
+
+
+def _is_grounded(result: Dict[str, Any], message: str, cached_message: str) -> bool:
+    """
+    Проверяет, что чужой результат применим к новому сообщению:
+    числа (цена, координаты) и отрицания совпадают, все извлеченные места,
+    рыбы и водоемы упоминаются в новом тексте, а у каждого предпочтения
+    хотя бы одно слово начинается так же, как слово нового текста.
+    """
+    if _numbers(message) != _numbers(cached_message):
+        return False
+    if _negated(message) != _negated(cached_message):
+        return False
+    prefixes = _prefixes(message)
+    for field in _PREFERENCE_FIELDS:
+        for item in result.get(field) or []:
+            item_prefixes = _prefixes(str(item))
+            if item_prefixes and not item_prefixes & prefixes:
+                return False
+    stems = _stems(message)
+    for field in _GROUNDED_FIELDS:
+        value = result.get(field)
+        values = value if isinstance(value, list) else [value]
+        for item in values:
+            if item and not _stems(str(item)) <= stems:
+                return False
+    return True
+
+
+async def _default_embed(text: str) -> List[float]:
+    from calculate_distance.encoder import acreate_semantic_embedding
+    return await acreate_semantic_embedding(text)
+
+
+class _SemanticIndex:
+    """Векторы сообщений одной области: digest -> нормированный float32 вектор"""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.vectors: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self.refreshed_at = 0.0
+        self._matrix: Optional[np.ndarray] = None
+        self._digests: List[str] = []
+
+    def add(self, digest: str, vector: np.ndarray) -> None:
+        self.vectors[digest] = vector
+        self.vectors.move_to_end(digest)
+        while len(self.vectors) > self.maxsize:
+            self.vectors.popitem(last=False)
+        self._matrix = None
+
+    def remove(self, digest: str) -> None:
+        if self.vectors.pop(digest, None) is not None:
+            self._matrix = None
+
+    def replace(self, vectors: Dict[str, np.ndarray]) -> None:
+        self.vectors = OrderedDict(vectors)
+        self._matrix = None
+        self.refreshed_at = time.monotonic()
+
+    def nearest(self, vector: np.ndarray) -> Tuple[Optional[str], float]:
+        if not self.vectors:
+            return None, 0.0
+        if self._matrix is None:
+            self._digests = list(self.vectors)
+            self._matrix = np.stack([self.vectors[d] for d in self._digests])
+        scores = self._matrix @ vector
+        best = int(np.argmax(scores))
+        return self._digests[best], float(scores[best])
+
+
+class ExtractionCache:
+    """Двухуровневый (точный + семантический) кэш ответов RelaxAnalyzer"""
+
+    def __init__(
+        self,
+        ttl: float = EXTRACT_CACHE_TTL,
+        maxsize: int = EXTRACT_CACHE_SIZE,
+        threshold: float = EXTRACT_SEMANTIC_THRESHOLD,
+        use_redis: bool = EXTRACT_CACHE_REDIS,
+        embed: Callable = _default_embed,
+    ):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.threshold = threshold
+        self.embed = embed
+        self.memory = LRUCache(maxsize=maxsize, ttl=ttl)
+        self.stats = CacheStats()
+        self._semantic: Dict[str, _SemanticIndex] = {}
+        self._recent_vectors = LRUCache(maxsize=256, ttl=60)
+        self._redis = None
+        self._use_redis = use_redis and aioredis is not None
+
+    @staticmethod
+    def scope(relax_type: Optional[Any], request_type: Any) -> str:
+        """Область кэша; relax_type=None - тип отдыха еще не определен"""
+        relax = relax_type.value if relax_type is not None else "any"
+        return f"{relax}|{request_type.value}"
+
+    @staticmethod
+    def digest(message: str) -> str:
+        return hashlib.sha1(normalize_query(message).encode("utf-8")).hexdigest()
+
+    def _redis_client(self):
+        if self._redis is None:
+            self._redis = aioredis.Redis(
+                host="redis",
+                port=int(os.getenv('REDIS_PORT', '6379')),
+                password=os.getenv('REDIS_PASSWORD', '1lomalsteklo'),
+            )
+        return self._redis
+
+    @staticmethod
+    def _entry_key(scope: str, digest: str) -> str:
+        return f"{KEY_PREFIX}:{scope}:{digest}"
+
+    @staticmethod
+    def _vectors_key(scope: str) -> str:
+        return f"{KEY_PREFIX}:vectors:{scope}"
+
+    @staticmethod
+    def _lru_key(scope: str) -> str:
+        return f"{KEY_PREFIX}:lru:{scope}"
+
+    @staticmethod
+    def _written_key(scope: str) -> str:
+        return f"{KEY_PREFIX}:written:{scope}"
+
+    def _semantic_enabled(self, scope: str) -> bool:
+        return scope.rsplit("|", 1)[-1] in EXTRACT_SEMANTIC_REQUEST_TYPES
+
+    async def get(self, message: str, relax_type: Optional[Any], request_type: Any) -> Optional[Dict]:
+        """Возвращает сохраненный результат извлечения (словарь) или None"""
+        if not EXTRACT_CACHE_ENABLED:
+            return None
+        scope = self.scope(relax_type, request_type)
+        digest = self.digest(message)
+
+        entry = await self._get_entry(scope, digest)
+        if entry is not None:
+            self.stats.incr("hits_exact")
+            return copy.deepcopy(entry["value"])
+
+        if self._semantic_enabled(scope):
+            value = await self._get_semantic(scope, message)
+            if value is not None:
+                self.stats.incr("hits_semantic")
+                return copy.deepcopy(value)
+
+        self.stats.incr("misses")
+        return None
+
+    async def set(self, message: str, relax_type: Optional[Any], request_type: Any, value: Dict) -> None:
+        if not EXTRACT_CACHE_ENABLED:
+            return
+        scope = self.scope(relax_type, request_type)
+        digest = self.digest(message)
+        entry = {"message": message, "value": copy.deepcopy(value)}
+        self.memory.set((scope, digest), entry)
+
+        vector = None
+        if self._semantic_enabled(scope):
+            vector = await self._embed(message)
+            if vector is not None:
+                self._index(scope).add(digest, vector)
+
+        if self._use_redis:
+            try:
+                await self._write_redis(scope, digest, entry, vector)
+            except Exception as e:
+                self.stats.incr("errors")
+                print(f"Ошибка записи кэша извлечения в Redis: {e}")
+
+    async def _get_entry(self, scope: str, digest: str) -> Optional[Dict]:
+        entry = self.memory.get((scope, digest))
+        if entry is not None or not self._use_redis:
+            return entry
+        try:
+            client = self._redis_client()
+            raw = await client.get(self._entry_key(scope, digest))
+            if raw is None:
+                return None
+            await client.zadd(self._lru_key(scope), {digest: time.time()})
+            entry = json.loads(raw)
+            self.memory.set((scope, digest), entry)
+            return entry
+        except Exception as e:
+            self.stats.incr("errors")
+            print(f"Ошибка чтения кэша извлечения из Redis: {e}")
+            return None
+
+    async def _get_semantic(self, scope: str, message: str) -> Optional[Dict]:
+        vector = await self._embed(message)
+        if vector is None:
+            return None
+        index = self._index(scope)
+        if self._use_redis and time.monotonic() - index.refreshed_at > EXTRACT_SEMANTIC_REFRESH:
+            await self._refresh_index(scope, index)
+
+        digest, score = index.nearest(vector)
+        if digest is None or score < self.threshold:
+            return None
+
+        entry = await self._get_entry(scope, digest)
+        if entry is None:
+            # Запись истекла по TTL, вектор больше не нужен
+            index.remove(digest)
+            if self._use_redis:
+                await self._forget_redis(scope, [digest])
+            return None
+        if not _is_grounded(entry["value"], message, entry["message"]):
+            self.stats.incr("rejected_semantic")
+            return None
+        return entry["value"]
+
+    async def _embed(self, message: str) -> Optional[np.ndarray]:
+        """Embedding сообщения; при промахе get и следующем set считается один раз"""
+        key = self.digest(message)
+        vector = self._recent_vectors.get(key)
+        if vector is not None:
+            return vector
+        try:
+            if asyncio.iscoroutinefunction(self.embed):
+                vector = await self.embed(message)
+            else:
+                vector = await asyncio.to_thread(self.embed, message)
+            vector = np.asarray(vector, dtype=np.float32)
+        except Exception as e:
+            print(f"Ошибка при создании embedding для кэша извлечения: {e}")
+            return None
+        norm = np.linalg.norm(vector)
+        if norm == 0:
+            return None
+        vector = vector / norm
+        self._recent_vectors.set(key, vector)
+        return vector
+
+    def _index(self, scope: str) -> _SemanticIndex:
+        index = self._semantic.get(scope)
+        if index is None:
+            index = self._semantic[scope] = _SemanticIndex(self.maxsize)
+        return index
+
+    async def _refresh_index(self, scope: str, index: _SemanticIndex) -> None:
+        """Подтягивает векторы, сохраненные другими воркерами, и удаляет векторы истекших записей"""
+        try:
+            client = self._redis_client()
+            expired = await client.zrangebyscore(self._written_key(scope), 0, time.time() - self.ttl)
+            if expired:
+                await self._forget_redis(scope, [d.decode() for d in expired])
+            raw = await client.hgetall(self._vectors_key(scope))
+            index.replace({
+                digest.decode(): np.frombuffer(data, dtype=np.float32)
+                for digest, data in raw.items()
+            })
+        except Exception as e:
+            self.stats.incr("errors")
+            index.refreshed_at = time.monotonic()
+            print(f"Ошибка чтения векторов кэша извлечения из Redis: {e}")
+
+    async def _forget_redis(self, scope: str, digests: List[str]) -> None:
+        """Удаляет из Redis вектор и служебные записи истекших записей кэша"""
+        try:
+            pipe = self._redis_client().pipeline(transaction=False)
+            pipe.hdel(self._vectors_key(scope), *digests)
+            pipe.zrem(self._lru_key(scope), *digests)
+            pipe.zrem(self._written_key(scope), *digests)
+            await pipe.execute()
+            self.stats.incr("expired_vectors", len(digests))
+        except Exception as e:
+            self.stats.incr("errors")
+            print(f"Ошибка удаления векторов кэша извлечения из Redis: {e}")
+
+    async def _write_redis(self, scope: str, digest: str, entry: Dict, vector: Optional[np.ndarray]) -> None:
+        client = self._redis_client()
+        lru_key = self._lru_key(scope)
+        pipe = client.pipeline(transaction=False)
+        pipe.set(self._entry_key(scope, digest), json.dumps(entry, ensure_ascii=False), ex=int(self.ttl))
+        pipe.zadd(lru_key, {digest: time.time()})
+        pipe.zadd(self._written_key(scope), {digest: time.time()})
+        if vector is not None:
+            pipe.hset(self._vectors_key(scope), digest, vector.tobytes())
+        pipe.zcard(lru_key)
+        size = (await pipe.execute())[-1]
+
+        # Вытесняем давно не использованные записи сверх лимита области
+        if size > self.maxsize:
+            evicted = await client.zpopmin(lru_key, size - self.maxsize)
+            digests = [d for d, _ in evicted]
+            if digests:
+                pipe = client.pipeline(transaction=False)
+                pipe.delete(*(self._entry_key(scope, d.decode()) for d in digests))
+                pipe.hdel(self._vectors_key(scope), *digests)
+                pipe.zrem(self._written_key(scope), *digests)
+                await pipe.execute()
+                self.stats.incr("evicted", len(digests))
+
+    def get_stats(self) -> Dict:
+        stats = self.stats.as_dict()
+        stats["size"] = len(self.memory)
+        stats["semantic_vectors"] = sum(len(index.vectors) for index in self._semantic.values())
+        return stats
+
+    async def aclose(self) -> None:
+        if self._redis is not None:
+            await self._redis.aclose()
+            self._redis = None
+
+
+extraction_cache = ExtractionCache()
@@ -1,20 +1,57 @@
 from fastapi import FastAPI, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from endpoints.classes_for_endpoint import ImageRequest, MessageRequest, TelegramSearchRequest, TelegramSearchResponse, BestPlacesRequest, Spot, CompareLocationRequest
-from endpoints.endpoints_with_backend import get_all_places_by_type, fetch_best_fishing_places
-from model_provider import Model
-from relax_analyzer import RelaxAnalyzer, RelaxType
-from calculate_distance.encoder import get_similarity, create_semantic_embedding, get_one_name_embedding
-from calculate_distance.map import get_route, geocode_name_to_coords
-from analyze_and_compare_fish_places import compare_places
+from endpoints.classes_for_endpoint import ImageRequest, MessageRequest, TelegramSearchRequest, TelegramSearchResponse, BestPlacesRequest, Spot, CompareLocationRequest, CompareLocationBatchRequest
+from endpoints.endpoints_with_backend import get_all_places_by_type, fetch_best_fishing_places, update_place_enrichment
+from provider_health import stop_all_probes
+from relax_analyzer import RelaxType
+from calculate_distance.encoder import acreate_semantic_embedding, aget_one_name_embedding, name_batcher, semantic_batcher
+from calculate_distance.place_dedup import find_existing_place
+from calculate_distance.geocode_cache import geocode_cache
+from calculate_distance.route_cache import route_cache
+from calculate_distance.embedding_cache import embedding_cache
+from extraction_cache import extraction_cache
+from relax_type_rules import relax_type_rules
+# Один экземпляр Model/RelaxAnalyzer на сервис: общие пулы, кэши и статистика провайдеров
+from analyze_and_compare_fish_places import compare_places, search_stats, model, analyzer
+from warmup import model_warmup
+from place_enrichment import PLACE_ENRICHMENT, PlaceEnricher
+from place_description import (
+    PlaceDescription, add_review, afold_description, aupdate_description, display_text,
+    merge_place_state, new_reviews, review_digest
+)
+import asyncio
+import json
+import os
 import uvicorn
 import httpx
+from typing import Dict, List, Optional, Tuple
+from contextlib import asynccontextmanager
+from endpoints.http_clients import http_clients
 from CV_for_person_detect.YOLO_predict import detect_person
 
-app = FastAPI(title="Person Detection API", version="1.0.0")
-model = Model() 
-analyzer = RelaxAnalyzer(model)
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Фоновые проверки LLM провайдеров: задержки известны до первого запроса
+    model.health.ensure_started()
+    # Модели грузятся в фоне, /health сообщает о готовности после прогрева
+    model_warmup.start()
+    place_enricher.start()
+    yield
+    await model_warmup.stop()
+    await place_enricher.stop()
+    await stop_all_probes()
+    # Дожидаемся фоновой записи кэша маршрутов и закрываем пулы соединений
+    await route_cache.aclose()
+    await extraction_cache.aclose()
+    await http_clients.aclose()
+
+
+# Сколько сообщений пачки /compare_location/batch одновременно анализирует LLM
+COMPARE_BATCH_CONCURRENCY = int(os.getenv("COMPARE_BATCH_CONCURRENCY", "4"))
+
+
+app = FastAPI(title="Person Detection API", version="1.0.0", lifespan=lifespan)
          
 @app.get("/")
 async def root():
@@ -22,7 +59,36 @@ async def root():
 
 @app.get("/health")
 async def health_check():
-    return {"status": "healthy", "service": "FishAgent ML"}
+    """
+    200 только когда все модели загружены и прогреты, до этого 503.
+    В теле: "warming_up" - первая попытка прогрева не завершена, "degraded" -
+    часть шагов упала и повторяется в фоне (см. warmup.py).
+    """
+    status = model_warmup.get_status()
+    if not status["ready"]:
+        return JSONResponse(
+            status_code=503,
+            content={"status": status["state"], "service": "FishAgent ML", "models": status}
+        )
+    return {"status": "healthy", "service": "FishAgent ML", "models": status}
+
+@app.get("/cache_stats")
+async def cache_stats():
+    """Счетчики попаданий в кэши сервиса"""
+    return {
+        "geocode": geocode_cache.stats.as_dict(),
+        "routes": route_cache.get_stats(),
+        "extraction": extraction_cache.get_stats(),
+        "search": search_stats.as_dict(),
+        "embeddings": {
+            "names": name_batcher.get_stats(),
+            "semantic": semantic_batcher.get_stats(),
+            "cache": embedding_cache.stats.as_dict(),
+        },
+        "relax_type_rules": relax_type_rules.stats.as_dict(),
+        "llm_hedging": model.get_hedging_stats(),
+        "place_enrichment": place_enricher.get_stats(),
+    }
 
 @app.post("/detect-person")
 async def detect_person_endpoint(request: ImageRequest):
@@ -65,6 +131,156 @@ async def get_best_fishing_places(request: BestPlacesRequest):
         )
     
 
+def _catalogue_state(place: dict, relax_type: RelaxType) -> dict:
+    """Известное бэкенду состояние места (предпочтения, рыба, водоемы)"""
+    state = {"user_preferences": place.get("user_preferences") or []}
+    if relax_type in (RelaxType.FISHING, RelaxType.FISHING_AND_CAMPING):
+        state["caught_fishes"] = place.get("caught_fishes") or []
+        state["water_space"] = place.get("water_space") or []
+    return state
+
+
+async def _enrich_place(job: dict, current: Optional[dict]) -> dict:
+    """
+    Фоновый пересчет существующего места (см. place_enrichment): LLM
+    получает только отзывы описания, еще не учтенные в состоянии места,
+    затем старые отзывы сворачиваются в сводку (см. place_description).
+    """
+    relax_type = RelaxType(job["relax_type"])
+    state = dict(current or job.get("base") or _catalogue_state({}, relax_type))
+    reviews = new_reviews(job["description"], state.get("review_digests", []))
+    if reviews:
+        short = await analyzer.aanalyze_existing_place("\n".join(reviews), relax_type)
+        state = merge_place_state(state, short)
+    state["description"] = await afold_description(analyzer, relax_type, job["description"])
+    state["review_digests"] = [
+        review_digest(review) for review in PlaceDescription.parse(state["description"]).reviews
+    ]
+    state["preferences_embedding"] = await acreate_semantic_embedding(state.get("user_preferences", []))
+    return state
+
+
+async def _write_back_place(job: dict, state: dict) -> None:
+    """Сохраняет пересчитанное состояние места в БД через бэкенд"""
+    payload = {
+        "name_location": job["name"],
+        "type_of_relax": job["relax_type"],
+        "user_preferences": state.get("user_preferences", []),
+        "preferences_embedding": state.get("preferences_embedding"),
+        # Бэкенд применит пересчет, только если описание в БД все еще равно previous_description,
+        # иначе ответит 409. Повтор в PlaceEnricher._write_back покрывает случай, когда ответ
+        # /compare_location с этим описанием еще не сохранен; более новое задание делает повтор лишним
+        "description": state["description"],
+        "previous_description": job["description"],
+    }
+    for field in ("caught_fishes", "water_space"):
+        if field in state:
+            payload[field] = state[field]
+    await update_place_enrichment(payload)
+
+
+place_enricher = PlaceEnricher(_enrich_place, write_back=_write_back_place)
+
+
+async def _analyze_location_message(message: str, relax_type: RelaxType) -> dict:
+    """Извлекает место из сообщения, без названия сравнивать нечего"""
+    short_message = await analyzer.aanalyze_existing_place(message, relax_type)
+    if not short_message.get("name_location"):
+        raise HTTPException(status_code=400, detail="Не указано название места")
+    return short_message
+
+
+async def _resolve_location(
+    message: str,
+    relax_type: RelaxType,
+    short_message: dict,
+    places: List[dict]
+) -> Tuple[dict, Optional[int]]:
+    """
+    Сравнивает извлеченное место с places и собирает ответ.
+
+    Returns:
+        (данные ответа, индекс совпавшего места в places или None для нового места)
+    """
+    target_name = short_message.get("name_location")
+    target_coords = short_message.get("place_coordinates")
+    if not target_coords:
+        target_coords = None
+
+    # Кандидаты по расстоянию, затем названия пачкой, маршруты только внутри радиуса
+    match = await find_existing_place(target_name, target_coords, places)
+    
+    if match:
+        place, coords = match
+        name = place.get("name_place", [None])
+        # Сводка + последние отзывы: размер описания и промптов не растет с числом сообщений
+        if PLACE_ENRICHMENT:
+            # Ответ по последнему известному состоянию места, LLM пересчитает его
+            # и свернет описание в фоне
+            updated_description = add_review(place.get("description"), message)
+            base = _catalogue_state(place, relax_type)
+            updated_short = await place_enricher.latest(relax_type.value, name) or base
+            await place_enricher.submit(relax_type.value, name, updated_description, base)
+        else:
+            updated_description = await aupdate_description(
+                analyzer, relax_type, place.get("description"), message
+            )
+            # Новый отзыв уже разобран в short_message: объединяем с известным состоянием
+            updated_short = merge_place_state(_catalogue_state(place, relax_type), short_message)
+        
+        user_prefs = updated_short.get("user_preferences", [])
+        name_old_embedding = await aget_one_name_embedding(name)
+        preferences_embedding = (
+            updated_short.get("preferences_embedding") or await acreate_semantic_embedding(user_prefs)
+        )
+        
+        response_data = {
+            "new_place": False,
+            "name_location": name,
+            "name_embedding": name_old_embedding,
+            "type_of_relax": relax_type.value,
+            "user_preferences": user_prefs,
+            "preferences_embedding": preferences_embedding,
+            "place_coordinates": coords,
+            "description": updated_description
+        }
+        
+        if relax_type in (RelaxType.FISHING, RelaxType.FISHING_AND_CAMPING):
+            response_data["caught_fishes"] = updated_short.get("caught_fishes", [])
+            response_data["water_space"] = updated_short.get("water_space", [])
+        
+        if updated_short.get("wish_price"):
+            response_data["wish_price"] = updated_short.get("wish_price")
+        
+        matched = next(i for i, other in enumerate(places) if other is place)
+        return response_data, matched
+
+    # Если ничего не найдено - создаём новое место
+    user_prefs = short_message.get("user_preferences", [])
+    name_embedding = await aget_one_name_embedding(target_name)
+    preferences_embedding = await acreate_semantic_embedding(user_prefs)
+    
+    response_data = {
+        "new_place": True,
+        "name_location": target_name,
+        "name_embedding": name_embedding,
+        "type_of_relax": relax_type.value,
+        "user_preferences": user_prefs,
+        "preferences_embedding": preferences_embedding,
+        "place_coordinates": target_coords,
+        "description": message
+    }
+    
+    if relax_type in (RelaxType.FISHING, RelaxType.FISHING_AND_CAMPING):
+        response_data["caught_fishes"] = short_message.get("caught_fishes", [])
+        response_data["water_space"] = short_message.get("water_space", [])
+    
+    if short_message.get("wish_price"):
+        response_data["wish_price"] = short_message.get("wish_price")
+    
+    return response_data, None
+
+
 @app.post("/compare_location")
 async def compare_location(request: CompareLocationRequest):
     """
@@ -77,6 +293,9 @@ async def compare_location(request: CompareLocationRequest):
     2. Если названия совпадают НО расстояние >= 2км → продолжаем поиск
     3. Если названия НЕ совпадают НО расстояние < 2км → существующее место (возврат)
     4. Если названия НЕ совпадают И расстояние >= 2км → продолжаем поиск
+    Кандидаты отбираются сначала по расстоянию (см. calculate_distance.place_dedup).
+    Для существующего места предпочтения пересчитываются в фоне (см. place_enrichment),
+    а описание хранится как сводка + последние отзывы (см. place_description).
     
     Args:
         request: CompareLocationRequest с полями message и relax_type
@@ -89,131 +308,12 @@ async def compare_location(request: CompareLocationRequest):
         relax_type = RelaxType(request.relax_type)
         
         # Анализируем сообщение пользователя
-        short_message = analyzer.analyze_existing_place(request.message, relax_type)
-        
-        target_name = short_message.get("name_location")
-        if not target_name:
-            raise HTTPException(status_code=400, detail="Не указано название места")
-        name_embedding = get_one_name_embedding(target_name)
-        target_coords = short_message.get("place_coordinates")
-        if not target_coords:
-            target_coords = None
+        short_message = await _analyze_location_message(request.message, relax_type)
 
         # Получаем все места из базы
         places_by_type = await get_all_places_by_type(relax_type.value)
         
-        # Проверяем каждое место
-        for place in places_by_type:
-            name = place.get("name_place", [None])
-            
-            # Получаем координаты существующего места
-            coords = place.get("place_coordinates", [])
-            if not coords:
-                try:
-                    coords = await geocode_name_to_coords(name)
-                except ValueError:
-                    coords = None
-            
-            # Проверяем совпадение по названию
-            name_match = get_similarity(target_name, name)
-            
-            if name_match:
-                # Названия совпадают - проверяем расстояние
-                if coords and target_coords:
-                    route = await get_route(start_coord=coords, end_coord=target_coords)
-                    distance = route.get('distance_km', float('inf'))
-                    
-                    if distance >= 2:
-                        # Названия совпадают НО расстояние >= 2км → это разные места
-                        continue
-                
-                # Названия совпадают И (расстояние < 2км ИЛИ нет координат) → существующее место
-                # Сразу возвращаем результат
-                updated_description = place.get("description", "") + " " + request.message
-                updated_short = analyzer.analyze_existing_place(updated_description, relax_type)
-                
-                user_prefs = updated_short.get("user_preferences", [])
-                name_old_embedding = get_one_name_embedding(name)
-                preferences_embedding = create_semantic_embedding(user_prefs)
-                
-                response_data = {
-                    "new_place": False,
-                    "name_location": name,
-                    "name_embedding": name_old_embedding,
-                    "type_of_relax": relax_type.value,
-                    "user_preferences": user_prefs,
-                    "preferences_embedding": preferences_embedding,
-                    "place_coordinates": coords,
-                    "description": updated_description
-                }
-                
-                if relax_type in (RelaxType.FISHING, RelaxType.FISHING_AND_CAMPING):
-                    response_data["caught_fishes"] = updated_short.get("caught_fishes", [])
-                    response_data["water_space"] = updated_short.get("water_space", [])
-                
-                if updated_short.get("wish_price"):
-                    response_data["wish_price"] = updated_short.get("wish_price")
-                
-                return JSONResponse(content=response_data)
-            
-            else:
-                # Названия НЕ совпадают - проверяем расстояние
-                if coords and target_coords:
-                    route = await get_route(start_coord=coords, end_coord=target_coords)
-                    distance = route.get('distance_km', float('inf'))
-                    
-                    if distance < 2:
-                        # Названия НЕ совпадают НО расстояние < 2км → существующее место
-                        # Сразу возвращаем результат
-                        updated_description = place.get("description", "") + " " + request.message
-                        updated_short = analyzer.analyze_existing_place(updated_description, relax_type)
-                        
-                        user_prefs = updated_short.get("user_preferences", [])
-                        name_old_embedding = get_one_name_embedding(name)
-                        preferences_embedding = create_semantic_embedding(user_prefs)
-                        
-                        response_data = {
-                            "new_place": False,
-                            "name_location": name,
-                            "name_embedding": name_old_embedding,
-                            "type_of_relax": relax_type.value,
-                            "user_preferences": user_prefs,
-                            "preferences_embedding": preferences_embedding,
-                            "place_coordinates": coords,
-                            "description": updated_description
-                        }
-                        
-                        if relax_type in (RelaxType.FISHING, RelaxType.FISHING_AND_CAMPING):
-                            response_data["caught_fishes"] = updated_short.get("caught_fishes", [])
-                            response_data["water_space"] = updated_short.get("water_space", [])
-                        
-                        if updated_short.get("wish_price"):
-                            response_data["wish_price"] = updated_short.get("wish_price")
-                        
-                        return JSONResponse(content=response_data)
-
-        # Если ничего не найдено - создаём новое место
-        user_prefs = short_message.get("user_preferences", [])
-        preferences_embedding = create_semantic_embedding(user_prefs)
-        
-        response_data = {
-            "new_place": True,
-            "name_location": target_name,
-            "name_embedding": name_embedding,
-            "type_of_relax": relax_type.value,
-            "user_preferences": user_prefs,
-            "preferences_embedding": preferences_embedding,
-            "place_coordinates": target_coords,
-            "description": request.message
-        }
-        
-        if relax_type in (RelaxType.FISHING, RelaxType.FISHING_AND_CAMPING):
-            response_data["caught_fishes"] = short_message.get("caught_fishes", [])
-            response_data["water_space"] = short_message.get("water_space", [])
-        
-        if short_message.get("wish_price"):
-            response_data["wish_price"] = short_message.get("wish_price")
-        
+        response_data, _ = await _resolve_location(request.message, relax_type, short_message, places_by_type)
         return JSONResponse(content=response_data)
 
     except HTTPException:
@@ -221,6 +321,76 @@ async def compare_location(request: CompareLocationRequest):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Comparison failed: {str(e)}")
 
+
+def _upsert_batch_place(places: List[dict], matched: Optional[int], response_data: dict) -> None:
+    """
+    Бэкенд сохраняет ответы по порядку, поэтому следующие сообщения пачки
+    сравниваются с каталогом, в который уже внесен этот результат.
+    """
+    record = {
+        "name_place": response_data["name_location"],
+        "place_coordinates": response_data["place_coordinates"] or [],
+        "description": response_data["description"],
+        "user_preferences": response_data["user_preferences"],
+    }
+    for field in ("caught_fishes", "water_space"):
+        if field in response_data:
+            record[field] = response_data[field]
+    if matched is None:
+        places.append(record)
+    else:
+        places[matched] = {**places[matched], **record}
+
+
+@app.post("/compare_location/batch")
+async def compare_location_batch(request: CompareLocationBatchRequest):
+    """
+    Пакетная версия /compare_location для загрузки истории каналов.
+
+    Каталог мест каждого типа отдыха загружается один раз на пачку, сообщения
+    сравниваются и с базой, и с местами из предыдущих сообщений пачки.
+    Извлечение мест LLM идет параллельно (COMPARE_BATCH_CONCURRENCY),
+    сравнение - строго по порядку.
+
+    Returns:
+        NDJSON в порядке items: {"index", "result"} с тем же содержимым, что
+        у /compare_location, или {"index", "error", "status_code"}
+    """
+    semaphore = asyncio.Semaphore(COMPARE_BATCH_CONCURRENCY)
+
+    async def analyze(item: CompareLocationRequest) -> Tuple[RelaxType, dict]:
+        relax_type = RelaxType(item.relax_type)
+        async with semaphore:
+            return relax_type, await _analyze_location_message(item.message, relax_type)
+
+    async def stream():
+        tasks = [asyncio.ensure_future(analyze(item)) for item in request.items]
+        catalogues: Dict[str, List[dict]] = {}
+        try:
+            for index, (item, task) in enumerate(zip(request.items, tasks)):
+                try:
+                    relax_type, short_message = await task
+                    if relax_type.value not in catalogues:
+                        catalogues[relax_type.value] = list(await get_all_places_by_type(relax_type.value))
+                    places = catalogues[relax_type.value]
+
+                    response_data, matched = await _resolve_location(item.message, relax_type, short_message, places)
+                    _upsert_batch_place(places, matched, response_data)
+                    line = {"index": index, "result": response_data}
+                except HTTPException as e:
+                    line = {"index": index, "error": e.detail, "status_code": e.status_code}
+                except Exception as e:
+                    print(f"Ошибка сравнения сообщения {index} в пачке: {e}")
+                    line = {"index": index, "error": f"Comparison failed: {str(e)}", "status_code": 500}
+                yield json.dumps(line, ensure_ascii=False) + "\n"
+        finally:
+            # Клиент мог отключиться: незавершенные вызовы LLM больше не нужны
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
     
 @app.post("/telegram/search", response_model=TelegramSearchResponse)
 async def search_fishing_spots_for_telegram(request: TelegramSearchRequest):
@@ -245,7 +415,7 @@ async def search_fishing_spots_for_telegram(request: TelegramSearchRequest):
         for place in places_ranked:
             raw_coords = place.get("place_coordinates", [])
             raw_user_loc = place.get("location_user", [])
-            description_full = place.get("description", "")
+            description_full = display_text(place.get("description", ""))
             url_photos= place.get("url_photos", [])
             
             
@@ -1,20 +1,44 @@
 from langchain_openai import ChatOpenAI
 from langchain.schema import HumanMessage, SystemMessage
+import asyncio
 import os
 import logging
+import time
 from dotenv import load_dotenv
+from provider_health import ProviderHealthManager
+from cache_utils import CacheStats
 
 load_dotenv()
 
+# Хеджирование: если основной провайдер не ответил за бюджет задержки,
+# тот же запрос отправляется следующему и берется первый ответ
+LLM_HEDGING = os.getenv("LLM_HEDGING", "0") == "1"
+# Бюджет = этот квантиль задержки основного провайдера
+LLM_HEDGE_QUANTILE = float(os.getenv("LLM_HEDGE_QUANTILE", "0.9"))
+LLM_HEDGE_MIN_DELAY = float(os.getenv("LLM_HEDGE_MIN_DELAY", "1.0"))
+LLM_HEDGE_DEFAULT_DELAY = float(os.getenv("LLM_HEDGE_DEFAULT_DELAY", "5.0"))
+# Ограничение расходов: не больше такой доли дополнительных запросов
+LLM_HEDGE_MAX_RATIO = float(os.getenv("LLM_HEDGE_MAX_RATIO", "0.1"))
+LLM_HEDGE_BURST = float(os.getenv("LLM_HEDGE_BURST", "3"))
+
 
 class ModelProvider:
-    def __init__(self, name: str, llm_instance, priority: int = 0):
+    def __init__(self, name: str, llm_instance, priority: int = 0, timeout: float = None):
         self.name = name
         self.llm = llm_instance
         self.priority = priority
         self.is_available = True
         self.failure_count = 0
         self.max_failures = 1
+        # Таймаут одного запроса к провайдеру, например LLM_TIMEOUT_OPENROUTER=20
+        if timeout is None:
+            timeout = float(os.getenv(f"LLM_TIMEOUT_{name.upper()}", os.getenv("LLM_TIMEOUT", "60")))
+        self.timeout = timeout
+        # Ограничение одновременных запросов, например LLM_MAX_CONCURRENCY_CAILA=4
+        self.max_concurrency = int(
+            os.getenv(f"LLM_MAX_CONCURRENCY_{name.upper()}", os.getenv("LLM_MAX_CONCURRENCY", "8"))
+        )
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
     
     def test_connection(self) -> bool:
         try:
@@ -27,6 +51,28 @@ class ModelProvider:
             self.mark_failed()
             return False
     
+    async def atest_connection(self) -> bool:
+        """Асинхронная проверка провайдера, не блокирует event loop"""
+        try:
+            test_messages = [SystemMessage(content="Test"), HumanMessage(content="Hi")]
+            await asyncio.wait_for(self.llm.ainvoke(test_messages), timeout=self.timeout)
+            self.reset_failures()
+            return True
+        except Exception as e:
+            logging.warning(f"Provider {self.name} test failed: {e}")
+            self.mark_failed()
+            return False
+    
+    async def aprobe(self) -> bool:
+        """Фоновая проверка для ProviderHealthManager: только результат, без изменения состояния"""
+        try:
+            test_messages = [SystemMessage(content="Test"), HumanMessage(content="Hi")]
+            await asyncio.wait_for(self.llm.ainvoke(test_messages), timeout=self.timeout)
+            return True
+        except Exception as e:
+            logging.warning(f"Provider {self.name} probe failed: {e!r}")
+            return False
+    
     def mark_failed(self):
         """Отмечает провайдера как неуспешного"""
         self.failure_count += 1
@@ -43,10 +89,34 @@ class ModelProvider:
         logging.info(f"Provider {self.name} restored")
 
 
+class HedgeBudget:
+    """
+    Ограничитель дополнительных (хеджирующих) запросов: каждый обычный запрос
+    добавляет ratio жетона, хедж расходует один жетон, запас не больше burst.
+    """
+    
+    def __init__(self, ratio: float = LLM_HEDGE_MAX_RATIO, burst: float = LLM_HEDGE_BURST):
+        self.ratio = ratio
+        self.burst = burst
+        self.tokens = burst
+    
+    def on_request(self):
+        self.tokens = min(self.burst, self.tokens + self.ratio)
+    
+    def try_acquire(self) -> bool:
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
 class Model:
-    def __init__(self):
+    def __init__(self, hedging: bool = LLM_HEDGING):
         self.providers = []
         self.current_provider = None
+        self.hedging = hedging
+        self.hedge_budget = HedgeBudget()
+        self.hedge_stats = CacheStats()
         self._setup_providers()
     
     def _setup_providers(self):
@@ -83,46 +153,32 @@ class Model:
         
         if not self.providers:
             raise RuntimeError("No API keys configured")
+        
+        # Состояние провайдеров ведется по реальным запросам и фоновым проверкам
+        self.health = ProviderHealthManager(self.providers)
     
     def _get_working_provider(self) -> ModelProvider:
-        """Получает рабочего провайдера, тестируя их по приоритету"""
-        if self.current_provider and self.current_provider.is_available:
-            return self.current_provider
-            
-        for provider in self.providers:
-            if provider.is_available:
-                self.current_provider = provider
-                logging.info(f"Using provider: {provider.name}")
-                return provider
-        
-        for provider in self.providers:
-            if provider.test_connection():
-                self.current_provider = provider
-                logging.info(f"Reconnected to provider: {provider.name}")
-                return provider
-        
-        raise RuntimeError("All providers unavailable")
+        """Получает лучшего провайдера по данным ProviderHealthManager (без тестового запроса)"""
+        provider = self.health.ordered()[0]
+        if provider != self.current_provider:
+            logging.info(f"Using provider: {provider.name}")
+        self.current_provider = provider
+        return provider
     
     def _try_with_fallback(self, operation_func, *args, **kwargs):
-        """Выполняет операцию с автоматическим переключением провайдеров при ошибке"""
-        tried_providers = set()
+        """
+        Выполняет операцию с автоматическим переключением провайдеров при ошибке.
+        Порядок провайдеров задает ProviderHealthManager: сначала исправные,
+        выведенные из ротации пробуются только если остальные не ответили.
+        """
         last_error = None
         
-        while len(tried_providers) < len(self.providers):
+        for provider in self.health.ordered():
             try:
-                available_providers = [p for p in self.providers if p.name not in tried_providers]
-                if not available_providers:
-                    break
-                    
-                provider = min(available_providers, key=lambda x: x.priority)
-                tried_providers.add(provider.name)
-                
-                if not provider.is_available:
-                    if not provider.test_connection():
-                        continue
-                
                 logging.info(f"Trying provider: {provider.name}")
+                started = time.perf_counter()
                 result = operation_func(provider, *args, **kwargs)
+                self.health.record_success(provider, time.perf_counter() - started)
                 
                 self.current_provider = provider
                 return result
@@ -130,7 +186,7 @@ class Model:
             except Exception as e:
                 last_error = e
                 logging.error(f"Provider {provider.name} failed: {e}")
-                provider.mark_failed()
+                self.health.record_failure(provider)
                 
                 if self.current_provider == provider:
                     self.current_provider = None
@@ -139,18 +195,154 @@ class Model:
         
         raise RuntimeError(f"All providers failed. Last error: {last_error}")
     
+    async def _acall(self, provider: ModelProvider, operation_func, *args, **kwargs):
+        """Один вызов провайдера: лимит параллельности, таймаут и учет в ProviderHealthManager"""
+        async with provider.semaphore:
+            started = time.perf_counter()
+            try:
+                result = await asyncio.wait_for(
+                    operation_func(provider, *args, **kwargs),
+                    timeout=provider.timeout
+                )
+                if result is None:
+                    raise ValueError("Provider returned an empty response")
+            except asyncio.CancelledError:
+                # Отмена (проигравший хедж или отключившийся клиент) - не ошибка провайдера
+                raise
+            except Exception:
+                self.health.record_failure(provider)
+                raise
+            self.health.record_success(provider, time.perf_counter() - started)
+            return result
+    
+    async def _atry_with_fallback(self, operation_func, *args, **kwargs):
+        """
+        Асинхронная версия _try_with_fallback: operation_func - корутина.
+        Каждая попытка ограничена таймаутом провайдера, при отмене запроса
+        (CancelledError) текущий вызов LLM тоже отменяется.
+        """
+        self.health.ensure_started()
+        if self.hedging and len(self.providers) > 1:
+            return await self._ahedged(operation_func, *args, **kwargs)
+        
+        last_error = None
+        
+        for provider in self.health.ordered():
+            try:
+                logging.info(f"Trying provider: {provider.name}")
+                result = await self._acall(provider, operation_func, *args, **kwargs)
+                
+                self.current_provider = provider
+                return result
+                
+            except Exception as e:
+                last_error = e
+                logging.error(f"Provider {provider.name} failed: {e!r}")
+                
+                if self.current_provider == provider:
+                    self.current_provider = None
+                
+                continue
+        
+        raise RuntimeError(f"All providers failed. Last error: {last_error!r}")
+    
+    def _hedge_delay(self, provider: ModelProvider) -> float:
+        """Сколько ждать ответа провайдера, прежде чем отправить хедж"""
+        latency = self.health.health[provider.name].latency_percentile(LLM_HEDGE_QUANTILE)
+        if latency is None:
+            latency = LLM_HEDGE_DEFAULT_DELAY
+        return min(max(latency, LLM_HEDGE_MIN_DELAY), provider.timeout)
+    
+    def _can_hedge(self, provider: ModelProvider) -> bool:
+        """Хедж только к исправному провайдеру со свободным слотом и в пределах бюджета"""
+        if not provider.is_available or provider.semaphore.locked():
+            self.hedge_stats.incr("skipped_busy")
+            return False
+        if not self.hedge_budget.try_acquire():
+            self.hedge_stats.incr("skipped_budget")
+            return False
+        return True
+    
+    async def _ahedged(self, operation_func, *args, **kwargs):
+        """
+        _atry_with_fallback с хеджированием: если провайдер не ответил за
+        _hedge_delay, запрос параллельно отправляется следующему (не больше
+        одного хеджа), берется первый успешный ответ, остальные отменяются.
+        Ошибка провайдера, как и раньше, сразу передает запрос следующему.
+        """
+        queue = self.health.ordered()
+        running = {}
+        hedged = False
+        last_error = None
+        self.hedge_budget.on_request()
+        self.hedge_stats.incr("requests")
+        
+        def launch():
+            provider = queue.pop(0)
+            logging.info(f"Trying provider: {provider.name}")
+            task = asyncio.create_task(self._acall(provider, operation_func, *args, **kwargs))
+            running[task] = provider
+        
+        launch()
+        primary = next(iter(running.values()))
+        try:
+            while running:
+                timeout = None
+                if not hedged and queue:
+                    timeout = self._hedge_delay(next(iter(running.values())))
+                
+                done, _ = await asyncio.wait(running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    hedged = True
+                    if self._can_hedge(queue[0]):
+                        self.hedge_stats.incr("hedged")
+                        launch()
+                    continue
+                
+                for task in done:
+                    provider = running.pop(task)
+                    try:
+                        result = task.result()
+                    except Exception as e:
+                        last_error = e
+                        logging.error(f"Provider {provider.name} failed: {e!r}")
+                        if self.current_provider == provider:
+                            self.current_provider = None
+                        continue
+                    
+                    if provider != primary:
+                        self.hedge_stats.incr("won_by_backup")
+                    self.current_provider = provider
+                    return result
+                
+                if not running and queue:
+                    launch()
+        finally:
+            for task in running:
+                task.cancel()
+                self.hedge_stats.incr("cancelled")
+        
+        raise RuntimeError(f"All providers failed. Last error: {last_error!r}")
+    
     def get_provider_status(self):
-        """Возвращает статус всех провайдеров"""
+        """Возвращает статус всех провайдеров вместе со статистикой задержек и ошибок"""
         return {
             provider.name: {
                 "available": provider.is_available,
                 "failures": provider.failure_count,
                 "priority": provider.priority,
-                "is_current": provider == self.current_provider
+                "is_current": provider == self.current_provider,
+                **self.health.get_status(provider)
             }
             for provider in self.providers
         }
     
+    def get_hedging_stats(self):
+        """Счетчики хеджирования: сколько запросов продублировано и сколько выиграл резервный провайдер"""
+        stats = self.hedge_stats.as_dict()
+        stats.pop("hit_ratio", None)
+        return {"enabled": self.hedging, **stats}
+    
     def with_structured_output(self, schema):
         """Создает structured output с автоматическим переключением провайдеров"""
         def create_structured_output(provider, schema):
@@ -164,6 +356,13 @@ class Model:
             return provider.llm.invoke(messages)
         
         return self._try_with_fallback(invoke_operation, messages)
+    
+    async def ainvoke(self, messages):
+        """Асинхронный запрос с автоматическим переключением провайдеров"""
+        async def invoke_operation(provider, messages):
+            return await provider.llm.ainvoke(messages)
+        
+        return await self._atry_with_fallback(invoke_operation, messages)
 
 
 class StructuredOutputWrapper:
@@ -180,4 +379,12 @@ class StructuredOutputWrapper:
             structured_llm = self.create_func(provider, self.schema)
             return structured_llm.invoke(messages)
         
-        return self.model._try_with_fallback(structured_invoke, messages)
\ No newline at end of file
+        return self.model._try_with_fallback(structured_invoke, messages)
+    
+    async def ainvoke(self, messages):
+        """Асинхронный structured output запрос с автоматическим переключением"""
+        async def structured_invoke(provider, messages):
+            structured_llm = self.create_func(provider, self.schema)
+            return await structured_llm.ainvoke(messages)
+        
+        return await self.model._atry_with_fallback(structured_invoke, messages)
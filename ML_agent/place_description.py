@@ -0,0 +1,261 @@
+"""
+Ограниченное по размеру описание места: сводка + последние отзывы.
+
+Раньше каждое совпадение в /compare_location дописывало сообщение в конец
+description, и весь текст целиком снова уходил в LLM, поэтому промпт рос
+вместе с популярностью места. Теперь описание хранится как
+
+    сводка
+    ---
+    отзыв 1
+    ---
+    отзыв N
+
+Новый отзыв добавляется в конец. Когда отзывов больше DESCRIPTION_MAX_REVIEWS
+или описание больше DESCRIPTION_TOKEN_BUDGET, старые отзывы вытесняются из
+начала до DESCRIPTION_KEEP_REVIEWS (половина окна) и половины бюджета и одним
+вызовом LLM сворачиваются в сводку (не длиннее DESCRIPTION_SUMMARY_TOKENS).
+За счет запаса сворачивание происходит раз в несколько сообщений, а не на
+каждом. При PLACE_ENRICHMENT=1 запрос только дописывает отзыв, а сворачивает
+описание фоновый воркер (afold_description).
+Предпочтения, рыба и водоемы извлекаются только из новых отзывов и
+объединяются с уже известными (см. merge_place_state).
+
+Пользователям описание показывается через display_text, без разделителей.
+
+Старые описания без разделителей считаются одним отзывом и сворачиваются
+в сводку при первом переполнении.
+
+Замер размера промптов и задержек по мере накопления отзывов:
+    python place_description.py [число отзывов] [--llm]
+"""
+
+import hashlib
+import os
+import sys
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+from calculate_distance.geocode_cache import normalize_query
+
+
+DESCRIPTION_MAX_REVIEWS = int(os.getenv("DESCRIPTION_MAX_REVIEWS", "5"))
+DESCRIPTION_KEEP_REVIEWS = int(os.getenv("DESCRIPTION_KEEP_REVIEWS", str(max(1, DESCRIPTION_MAX_REVIEWS // 2))))
+DESCRIPTION_TOKEN_BUDGET = int(os.getenv("DESCRIPTION_TOKEN_BUDGET", "1500"))
+DESCRIPTION_SUMMARY_TOKENS = int(os.getenv("DESCRIPTION_SUMMARY_TOKENS", "400"))
+DESCRIPTION_MAX_PREFERENCES = int(os.getenv("DESCRIPTION_MAX_PREFERENCES", "30"))
+
+SEPARATOR = "\n---\n"
+
+
+@lru_cache(maxsize=1)
+def _encoding():
+    """Токенизатор tiktoken, если он установлен и словарь доступен"""
+    try:
+        import tiktoken
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        print(f"tiktoken недоступен, токены считаются приблизительно: {e}")
+        return None
+
+
+def count_tokens(text: str) -> int:
+    encoding = _encoding()
+    if encoding is not None:
+        return len(encoding.encode(text))
+    # Кириллица в cl100k_base - примерно 3 символа на токен
+    return (len(text) + 2) // 3
+
+
+def review_digest(review: str) -> str:
+    return hashlib.sha1(normalize_query(review).encode("utf-8")).hexdigest()[:16]
+
+
+class PlaceDescription:
+    """Разобранное описание места"""
+
+    def __init__(self, summary: str = "", reviews: Optional[List[str]] = None):
+        self.summary = summary
+        self.reviews = list(reviews or [])
+
+    @classmethod
+    def parse(cls, text: Optional[str]) -> "PlaceDescription":
+        parts = [part.strip() for part in (text or "").split(SEPARATOR)]
+        if len(parts) == 1:
+            # Старый формат: склеенные сообщения без сводки
+            return cls("", [parts[0]] if parts[0] else [])
+        return cls(parts[0], [part for part in parts[1:] if part])
+
+    def render(self) -> str:
+        if not self.summary and len(self.reviews) == 1:
+            return self.reviews[0]
+        return SEPARATOR.join([self.summary] + self.reviews)
+
+    def tokens(self) -> int:
+        return count_tokens(self.render())
+
+
+def display_text(description: Optional[str]) -> str:
+    """Описание для пользователя: сводка и отзывы абзацами, без разделителей"""
+    parsed = PlaceDescription.parse(description)
+    return "\n\n".join(part for part in [parsed.summary] + parsed.reviews if part)
+
+
+def _take_overflow(parsed: PlaceDescription) -> List[str]:
+    """При превышении лимитов вытесняет старые отзывы с запасом, до половины окна"""
+    if len(parsed.reviews) <= DESCRIPTION_MAX_REVIEWS and parsed.tokens() <= DESCRIPTION_TOKEN_BUDGET:
+        return []
+    overflow = []
+    # Последний отзыв остается всегда, даже если он один больше бюджета
+    while len(parsed.reviews) > 1 and (
+        len(parsed.reviews) > DESCRIPTION_KEEP_REVIEWS or parsed.tokens() > DESCRIPTION_TOKEN_BUDGET // 2
+    ):
+        overflow.append(parsed.reviews.pop(0))
+    return overflow
+
+
+def add_review(description: Optional[str], review: str) -> str:
+    """Описание с отзывом review в конце, без сворачивания"""
+    parsed = PlaceDescription.parse(description)
+    parsed.reviews.append(review.strip())
+    return parsed.render()
+
+
+def append_review(description: Optional[str], review: str) -> Tuple[PlaceDescription, List[str]]:
+    """
+    Добавляет отзыв и вытесняет старые отзывы сверх лимитов.
+
+    Returns:
+        (новое описание без вытесненных отзывов, вытесненные отзывы для сводки)
+    """
+    parsed = PlaceDescription.parse(add_review(description, review))
+    return parsed, _take_overflow(parsed)
+
+
+async def _afold(analyzer, relax_type, parsed: PlaceDescription, overflow: List[str]) -> str:
+    if overflow:
+        try:
+            parsed.summary = await analyzer.asummarize_place(
+                parsed.summary, overflow, relax_type, max_words=DESCRIPTION_SUMMARY_TOKENS // 2
+            )
+        except Exception as e:
+            # Без сводки отзывы не теряются: остаются в описании до следующей попытки
+            print(f"Ошибка обновления сводки места: {e}")
+            parsed.reviews = overflow + parsed.reviews
+    return parsed.render()
+
+
+async def aupdate_description(analyzer, relax_type, description: Optional[str], review: str) -> str:
+    """Новое описание места с отзывом review; при переполнении обновляет сводку через LLM"""
+    parsed, overflow = append_review(description, review)
+    return await _afold(analyzer, relax_type, parsed, overflow)
+
+
+async def afold_description(analyzer, relax_type, description: Optional[str]) -> str:
+    """Сворачивает старые отзывы в сводку, если описание вышло за лимиты"""
+    parsed = PlaceDescription.parse(description)
+    return await _afold(analyzer, relax_type, parsed, _take_overflow(parsed))
+
+
+def new_reviews(description: str, seen: List[str]) -> List[str]:
+    """Отзывы описания, которые еще не учтены в состоянии места (по review_digests)"""
+    seen = set(seen)
+    return [review for review in PlaceDescription.parse(description).reviews if review_digest(review) not in seen]
+
+
+def _merge_list(old: List[str], new: List[str], limit: Optional[int] = None) -> List[str]:
+    """Объединение без повторов; при переполнении вытесняются самые старые значения"""
+    merged = {}
+    for value in list(old or []) + list(new or []):
+        if not value:
+            continue
+        key = normalize_query(str(value))
+        merged.pop(key, None)
+        merged[key] = value
+    values = list(merged.values())
+    return values[-limit:] if limit else values
+
+
+def merge_place_state(state: Dict, extracted: Dict) -> Dict:
+    """Состояние места после учета полей, извлеченных из новых отзывов"""
+    merged = dict(state)
+    merged["user_preferences"] = _merge_list(
+        state.get("user_preferences"), extracted.get("user_preferences"), DESCRIPTION_MAX_PREFERENCES
+    )
+    for field in ("caught_fishes", "water_space"):
+        if field in state or field in extracted:
+            merged[field] = _merge_list(state.get(field), extracted.get(field))
+    if extracted.get("wish_price"):
+        merged["wish_price"] = extracted["wish_price"]
+    return merged
+
+
+def _benchmark(reviews: int = 100, with_llm: bool = False) -> None:
+    """
+    Размер промпта (и задержка, с --llm) извлечения при накоплении отзывов:
+    прежняя склейка всего описания против нового отзыва + сводки.
+    """
+    import asyncio
+    import time
+
+    corpus = [
+        "Были на Вуоксе у моста, клевала щука на спиннинг, дно песчаное, подъезд хороший.",
+        "Приезжали с палаткой на два дня, место тихое, есть беседка и костровище, парковка рядом.",
+        "Окунь брал с утра, к обеду ветер, от ветра защищает мыс, глубина у берега метра три.",
+        "Въезд платный 300 рублей, туалет есть, мусор вывозят, людей в выходные много.",
+        "Зимой лед держит с декабря, ловили судака на балансир у коряг.",
+    ]
+
+    analyzer = None
+    relax_type = None
+    if with_llm:
+        from analyze_and_compare_fish_places import analyzer
+        from relax_analyzer import RelaxType
+        relax_type = RelaxType.FISHING
+
+    async def run():
+        concatenated = ""
+        rolling = ""
+        folds = 0
+        for i in range(1, reviews + 1):
+            review = f"{corpus[i % len(corpus)]} (отзыв {i})"
+            concatenated = (concatenated + " " + review).strip()
+
+            parsed, overflow = append_review(rolling, review)
+            fold_tokens = 0
+            if overflow:
+                fold_tokens = count_tokens(parsed.summary) + sum(count_tokens(r) for r in overflow)
+                if with_llm:
+                    parsed.summary = await analyzer.asummarize_place(
+                        parsed.summary, overflow, relax_type, max_words=DESCRIPTION_SUMMARY_TOKENS // 2
+                    )
+                else:
+                    # Без LLM: сводка заменяется хвостом текста того же размера
+                    parsed.summary = " ".join([parsed.summary] + overflow)[-DESCRIPTION_SUMMARY_TOKENS * 3:]
+            rolling = parsed.render()
+
+            folds += bool(overflow)
+            line = (
+                f"отзыв {i:>4}: склейка {count_tokens(concatenated):>6} ток. | "
+                f"новый отзыв {count_tokens(review):>4} ток., сводка {fold_tokens:>5} ток., "
+                f"описание {count_tokens(rolling):>5} ток., сворачиваний {folds:>3}"
+            )
+            if with_llm and i % 10 == 0:
+                started = time.perf_counter()
+                await analyzer.aanalyze_existing_place(concatenated, relax_type)
+                old_ms = (time.perf_counter() - started) * 1000
+                started = time.perf_counter()
+                await analyzer.aanalyze_existing_place(review, relax_type)
+                new_ms = (time.perf_counter() - started) * 1000
+                line += f" | LLM {old_ms:7.0f} мс -> {new_ms:7.0f} мс"
+            if i % 10 == 0:
+                print(line)
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    _benchmark(
+        int(sys.argv[1]) if len(sys.argv) > 1 and sys.argv[1].isdigit() else 100,
+        with_llm="--llm" in sys.argv
+    )
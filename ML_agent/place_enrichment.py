@@ -0,0 +1,376 @@
+"""
+Фоновое обогащение существующих мест после /compare_location.
+
+Когда сообщение совпало с известным местом, ответ строится сразу по последнему
+известному состоянию места (предпочтения, рыба, водоемы, embedding), а
+анализ LLM новых отзывов и пересчет preferences_embedding выполняются в фоне:
+
+1. submit кладет задание "место + актуальное описание" в очередь. Повторные
+   сообщения о том же месте, пока задание ждет, заменяют его описание, а не
+   добавляют новое (обрабатывается только последнее состояние).
+2. Воркер передает enrich задание и последнее записанное состояние места
+   (или base из задания, если места еще нет в очереди), а результат
+   записывает, только если он новее уже записанного (по номеру задания seq).
+3. Записанный результат сразу отправляется в БД через write_back
+   (POST /api/Places/enrichment бэкенда). Ответ /compare_location по текущему
+   сообщению бэкенд сохраняет раньше (LLM в воркере отвечает за секунды),
+   поэтому пересчет перезаписывает его предпочтения, а не наоборот.
+   Следующие ответы по этому месту берут записанное состояние из очереди,
+   даже если каталог мест еще не перечитан.
+
+Если процесс перезапустился до пересчета, отзыв уже сохранен в описании
+места, и он будет учтен при следующем сообщении об этом месте (отзывы без
+review_digests в состоянии анализируются заново).
+
+Очередь (PLACE_ENRICHMENT_QUEUE):
+- memory: в памяти процесса
+- redis: Redis Streams, общая для всех воркеров ML сервиса
+"""
+
+import asyncio
+import itertools
+import json
+import os
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from cache_utils import CacheStats, LRUCache
+from calculate_distance.geocode_cache import normalize_query
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:
+    aioredis = None
+
+
+PLACE_ENRICHMENT = os.getenv("PLACE_ENRICHMENT", "1") == "1"
+PLACE_ENRICHMENT_QUEUE = os.getenv("PLACE_ENRICHMENT_QUEUE", "memory")
+PLACE_ENRICHMENT_WORKERS = int(os.getenv("PLACE_ENRICHMENT_WORKERS", "2"))
+PLACE_ENRICHMENT_STATE_SIZE = int(os.getenv("PLACE_ENRICHMENT_STATE_SIZE", "10000"))
+# Через сколько мс задание упавшего воркера забирает другой (Redis XAUTOCLAIM)
+PLACE_ENRICHMENT_CLAIM_IDLE_MS = int(os.getenv("PLACE_ENRICHMENT_CLAIM_IDLE_MS", "300000"))
+PLACE_ENRICHMENT_WRITE_RETRIES = int(os.getenv("PLACE_ENRICHMENT_WRITE_RETRIES", "3"))
+
+KEY_PREFIX = "place_enrichment"
+
+
+def place_key(relax_type: str, name: str) -> str:
+    return f"{relax_type}|{normalize_query(name)}"
+
+
+class MemoryEnrichmentQueue:
+    """Очередь в памяти процесса, одно ожидающее задание на место"""
+
+    def __init__(self, state_size: int = PLACE_ENRICHMENT_STATE_SIZE):
+        self._pending: "OrderedDict[str, dict]" = OrderedDict()
+        self._running: Set[str] = set()
+        self._states = LRUCache(maxsize=state_size)
+        self._seq = itertools.count(1)
+        self._changed: Optional[asyncio.Condition] = None
+
+    def _condition(self) -> asyncio.Condition:
+        if self._changed is None:
+            self._changed = asyncio.Condition()
+        return self._changed
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    async def put(self, key: str, job: dict) -> bool:
+        """Returns: True, если задание заменило уже ожидающее"""
+        async with self._condition():
+            coalesced = key in self._pending
+            # Место в очереди сохраняется, меняется только содержимое задания
+            self._pending[key] = {**job, "seq": next(self._seq)}
+            self._condition().notify()
+            return coalesced
+
+    async def take(self) -> Tuple[str, dict]:
+        """Следующее задание по месту, которое сейчас никто не обрабатывает"""
+        async with self._condition():
+            while True:
+                key = next((k for k in self._pending if k not in self._running), None)
+                if key is not None:
+                    self._running.add(key)
+                    return key, self._pending.pop(key)
+                await self._condition().wait()
+
+    async def done(self, key: str, job: dict) -> None:
+        async with self._condition():
+            self._running.discard(key)
+            self._condition().notify_all()
+
+    async def get_state(self, key: str) -> Optional[dict]:
+        return self._states.get(key)
+
+    async def set_state(self, key: str, state: dict) -> bool:
+        current = self._states.get(key)
+        if current is not None and current["seq"] >= state["seq"]:
+            return False
+        self._states.set(key, state)
+        return True
+
+    async def aclose(self) -> None:
+        pass
+
+
+# Удаляет ожидающее задание, только если его не заменили во время обработки
+_DELETE_IF_SAME = """
+if redis.call('HGET', KEYS[1], ARGV[1]) == ARGV[2] then
+    return redis.call('HDEL', KEYS[1], ARGV[1])
+end
+return 0
+"""
+
+# Записывает состояние, только если оно новее записанного
+_SET_IF_NEWER = """
+local current = redis.call('HGET', KEYS[1], ARGV[1])
+if current and cjson.decode(current)['seq'] >= tonumber(ARGV[3]) then
+    return 0
+end
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+return 1
+"""
+
+
+class RedisEnrichmentQueue:
+    """
+    Очередь на Redis Streams.
+
+    Поток KEY_PREFIX:jobs содержит только ключи мест, а само задание (последнее
+    описание) лежит в hash KEY_PREFIX:pending, поэтому несколько записей потока
+    об одном месте обрабатываются как одно задание. Состояния мест - в hash
+    KEY_PREFIX:state. Если одно место одновременно попало к двум воркерам,
+    записывается только результат с большим seq. Записи, которые воркер
+    прочитал, но не подтвердил (процесс упал), через claim_idle_ms забирает
+    другой воркер.
+    """
+
+    group = "enrichers"
+
+    def __init__(
+        self,
+        consumer: Optional[str] = None,
+        maxlen: int = 100_000,
+        claim_idle_ms: int = PLACE_ENRICHMENT_CLAIM_IDLE_MS
+    ):
+        self.stream = f"{KEY_PREFIX}:jobs"
+        self.pending_key = f"{KEY_PREFIX}:pending"
+        self.state_key = f"{KEY_PREFIX}:state"
+        self.seq_key = f"{KEY_PREFIX}:seq"
+        self.consumer = consumer or f"ml-{os.getpid()}"
+        self.maxlen = maxlen
+        self.claim_idle_ms = claim_idle_ms
+        self._claim_from = "0-0"
+        self._redis = None
+        self._group_ready = False
+        self._buffer: List[Tuple[bytes, str]] = []
+
+    def _redis_client(self):
+        if self._redis is None:
+            self._redis = aioredis.Redis(
+                host="redis",
+                port=int(os.getenv('REDIS_PORT', '6379')),
+                password=os.getenv('REDIS_PASSWORD', '1lomalsteklo'),
+            )
+        return self._redis
+
+    async def _ensure_group(self) -> None:
+        if self._group_ready:
+            return
+        try:
+            await self._redis_client().xgroup_create(self.stream, self.group, id="0", mkstream=True)
+        except aioredis.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+        self._group_ready = True
+
+    async def put(self, key: str, job: dict) -> bool:
+        client = self._redis_client()
+        seq = await client.incr(self.seq_key)
+        pipe = client.pipeline(transaction=True)
+        pipe.hset(self.pending_key, key, json.dumps({**job, "seq": seq}, ensure_ascii=False))
+        pipe.xadd(self.stream, {"key": key}, maxlen=self.maxlen, approximate=True)
+        created, _ = await pipe.execute()
+        return not created
+
+    async def take(self) -> Tuple[str, dict]:
+        await self._ensure_group()
+        client = self._redis_client()
+        while True:
+            if not self._buffer:
+                await self._claim_stale()
+            if not self._buffer:
+                response = await client.xreadgroup(
+                    self.group, self.consumer, {self.stream: ">"}, count=10, block=5000
+                )
+                for _, entries in response or []:
+                    self._buffer += [(entry_id, fields[b"key"].decode()) for entry_id, fields in entries]
+                continue
+
+            entry_id, key = self._buffer.pop(0)
+            raw = await client.hget(self.pending_key, key)
+            if raw is None:
+                # Задание уже выполнено по более ранней записи потока
+                await client.xack(self.stream, self.group, entry_id)
+                continue
+            job = json.loads(raw)
+            job["_entry_id"] = entry_id
+            job["_raw"] = raw
+            return key, job
+
+    async def _claim_stale(self) -> None:
+        """Забирает в буфер записи, не подтвержденные другими воркерами дольше claim_idle_ms"""
+        response = await self._redis_client().xautoclaim(
+            self.stream, self.group, self.consumer, self.claim_idle_ms, start_id=self._claim_from, count=10
+        )
+        # Redis 7 добавляет третьим элементом удаленные из потока записи
+        next_id, entries = response[0], response[1]
+        self._claim_from = next_id
+        self._buffer += [
+            (entry_id, fields[b"key"].decode()) for entry_id, fields in entries if fields
+        ]
+
+    async def done(self, key: str, job: dict) -> None:
+        client = self._redis_client()
+        await client.eval(_DELETE_IF_SAME, 1, self.pending_key, key, job["_raw"])
+        await client.xack(self.stream, self.group, job["_entry_id"])
+
+    async def get_state(self, key: str) -> Optional[dict]:
+        raw = await self._redis_client().hget(self.state_key, key)
+        return json.loads(raw) if raw else None
+
+    async def set_state(self, key: str, state: dict) -> bool:
+        written = await self._redis_client().eval(
+            _SET_IF_NEWER, 1, self.state_key, key, json.dumps(state, ensure_ascii=False), state["seq"]
+        )
+        return bool(written)
+
+    async def aclose(self) -> None:
+        if self._redis is not None:
+            await self._redis.aclose()
+            self._redis = None
+
+
+def create_queue(kind: str = PLACE_ENRICHMENT_QUEUE):
+    if kind == "redis":
+        if aioredis is not None:
+            return RedisEnrichmentQueue()
+        print("Для PLACE_ENRICHMENT_QUEUE=redis нужен пакет redis, используется очередь в памяти")
+    return MemoryEnrichmentQueue()
+
+
+class PlaceEnricher:
+    """Воркеры, пересчитывающие состояние мест по заданиям из очереди"""
+
+    def __init__(
+        self,
+        enrich: Callable[[dict, Optional[dict]], Awaitable[dict]],
+        queue=None,
+        workers: int = PLACE_ENRICHMENT_WORKERS,
+        write_back: Optional[Callable[[dict, dict], Awaitable[None]]] = None
+    ):
+        self.enrich = enrich
+        self.write_back = write_back
+        self.queue = queue if queue is not None else create_queue()
+        self.workers = workers
+        self.stats = CacheStats()
+        self._tasks: List[asyncio.Task] = []
+
+    async def submit(
+        self,
+        relax_type: str,
+        name: str,
+        description: str,
+        base: Optional[dict] = None
+    ) -> None:
+        """
+        Ставит место в очередь на пересчет по актуальному описанию.
+        base - состояние места из каталога, пока в очереди его еще нет.
+        """
+        try:
+            coalesced = await self.queue.put(
+                place_key(relax_type, name),
+                {"relax_type": relax_type, "name": name, "description": description, "base": base}
+            )
+            self.stats.incr("coalesced" if coalesced else "submitted")
+        except Exception as e:
+            self.stats.incr("errors")
+            print(f"Ошибка постановки места {name} в очередь обогащения: {e}")
+
+    async def latest(self, relax_type: str, name: str) -> Optional[dict]:
+        """Последнее записанное состояние места или None"""
+        try:
+            return await self.queue.get_state(place_key(relax_type, name))
+        except Exception as e:
+            self.stats.incr("errors")
+            print(f"Ошибка чтения состояния места {name}: {e}")
+            return None
+
+    async def _worker(self) -> None:
+        while True:
+            try:
+                key, job = await self.queue.take()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.stats.incr("errors")
+                print(f"Ошибка чтения очереди обогащения: {e}")
+                await asyncio.sleep(1)
+                continue
+
+            try:
+                state = await self.enrich(job, await self.queue.get_state(key))
+                state["seq"] = job["seq"]
+                written = await self.queue.set_state(key, state)
+                self.stats.incr("written" if written else "stale")
+                if written:
+                    await self._write_back(key, job, state)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.stats.incr("errors")
+                print(f"Ошибка обогащения места {job.get('name')}: {e}")
+            finally:
+                try:
+                    await self.queue.done(key, job)
+                except Exception as e:
+                    print(f"Ошибка подтверждения задания обогащения: {e}")
+
+    async def _write_back(self, key: str, job: dict, state: dict) -> None:
+        """Сохраняет состояние в БД, если за время пересчета не появилось более новое"""
+        if self.write_back is None:
+            return
+        for attempt in range(PLACE_ENRICHMENT_WRITE_RETRIES):
+            current = await self.queue.get_state(key)
+            if current is not None and current["seq"] > state["seq"]:
+                self.stats.incr("stale")
+                return
+            try:
+                await self.write_back(job, state)
+                self.stats.incr("written_back")
+                return
+            except Exception as e:
+                print(f"Ошибка записи места {job.get('name')} в БД (попытка {attempt + 1}): {e}")
+                await asyncio.sleep(2 ** attempt)
+        self.stats.incr("write_back_errors")
+
+    def start(self) -> None:
+        """Запускает воркеры в текущем event loop"""
+        if not self._tasks:
+            loop = asyncio.get_running_loop()
+            self._tasks = [loop.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await self.queue.aclose()
+
+    def get_stats(self) -> Dict:
+        stats = self.stats.as_dict()
+        stats.pop("hit_ratio", None)
+        if isinstance(self.queue, MemoryEnrichmentQueue):
+            stats["pending"] = len(self.queue)
+        return stats
@@ -0,0 +1,188 @@
+"""
+Компактный бинарный формат кэша мест (ключ all_places:bin).
+
+Вместо JSON-массивов чисел embeddings хранятся одним непрерывным float32
+буфером на каждый вид (name / preferences), а id, координаты и типы отдыха -
+в небольшом JSON-индексе. Чтение делается через np.frombuffer без копирования.
+
+Раскладка (little-endian):
+    magic "FPLB" | uint16 версия формата | uint16 флаги | uint32 count |
+    uint32 dim | uint32 длина индекса | индекс (JSON, выровнен до 4 байт) |
+    name float32[count, dim] | preferences float32[count, dim]
+
+Строки отсортированы по type_of_relax, так что места одного типа занимают
+непрерывный диапазон и матрицы по типу получаются срезами без копий.
+Векторы записываются уже нормализованными.
+
+Бэкенд пишет только JSON (all_places), бинарную копию строит ML сервис
+после разбора JSON (см. RedisManager._load_snapshot).
+"""
+
+import json
+import struct
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from calculate_distance.ranking import (
+    PlaceRanker, NAME_EMBEDDING, PREFERENCES_EMBEDDING, _EMBEDDING_KEYS, _normalize_rows
+)
+
+
+MAGIC = b"FPLB"
+FORMAT_VERSION = 1
+_HEADER = struct.Struct("<4sHHIII")
+
+
+def _get_vector(place: Dict, kind: str) -> Optional[list]:
+    for key in _EMBEDDING_KEYS[kind]:
+        vector = place.get(key)
+        if vector is not None and len(vector):
+            return vector
+    return None
+
+
+def encode_places(places: List[Dict], dim: Optional[int] = None) -> bytes:
+    """
+    Сериализует места из формата all_places в бинарный формат.
+
+    Args:
+        places: Места с полями location_id, coord_location, type_of_relax и embeddings
+        dim: Размерность embeddings (по умолчанию - по первому найденному вектору, иначе 384)
+
+    Returns:
+        Байты для записи в Redis
+    """
+    if dim is None:
+        dim = next(
+            (len(v) for p in places for kind in (NAME_EMBEDDING, PREFERENCES_EMBEDDING)
+             for v in [_get_vector(p, kind)] if v is not None),
+            384
+        )
+    places = sorted(places, key=lambda p: p.get("type_of_relax") or "")
+    count = len(places)
+
+    index = {
+        "ids": [p.get("location_id") for p in places],
+        "coords": [p.get("coord_location") for p in places],
+        "types": {},
+    }
+    buffers = []
+    for kind in (NAME_EMBEDDING, PREFERENCES_EMBEDDING):
+        matrix = np.zeros((count, dim), dtype=np.float32)
+        valid = []
+        for i, place in enumerate(places):
+            vector = _get_vector(place, kind)
+            ok = vector is not None and len(vector) == dim
+            if ok:
+                matrix[i] = vector
+            valid.append(int(ok))
+        index[f"{kind}_valid"] = valid
+        buffers.append(_normalize_rows(matrix).astype("<f4", copy=False).tobytes())
+
+    for i, place in enumerate(places):
+        relax = place.get("type_of_relax")
+        start, _ = index["types"].get(relax, (i, i))
+        index["types"][relax] = (start, i + 1)
+    index["types"] = [[relax, start, end] for relax, (start, end) in index["types"].items()]
+
+    index_bytes = json.dumps(index, ensure_ascii=False).encode("utf-8")
+    index_bytes += b" " * (-(_HEADER.size + len(index_bytes)) % 4)
+
+    header = _HEADER.pack(MAGIC, FORMAT_VERSION, 0, count, dim, len(index_bytes))
+    return b"".join([header, index_bytes] + buffers)
+
+
+def decode_places(buffer: bytes) -> Tuple[List[Dict], Dict[Optional[str], PlaceRanker]]:
+    """
+    Читает бинарный формат без копирования embeddings.
+
+    Returns:
+        (места, PlaceRanker для каждого type_of_relax). Embeddings мест -
+        нормализованные строки float32 (np.ndarray, представления буфера без
+        копирования) под теми же ключами, что и в JSON, или None.
+    """
+    magic, version, _, count, dim, index_len = _HEADER.unpack_from(buffer, 0)
+    if magic != MAGIC or version != FORMAT_VERSION:
+        raise ValueError("Неизвестный формат all_places:bin")
+
+    offset = _HEADER.size
+    index = json.loads(bytes(buffer[offset:offset + index_len]))
+    offset += index_len
+
+    matrices = {}
+    valid = {}
+    for kind in (NAME_EMBEDDING, PREFERENCES_EMBEDDING):
+        matrices[kind] = np.frombuffer(
+            buffer, dtype="<f4", count=count * dim, offset=offset
+        ).reshape(count, dim)
+        valid[kind] = np.asarray(index[f"{kind}_valid"], dtype=bool)
+        offset += count * dim * 4
+
+    places = []
+    for i, (place_id, coords) in enumerate(zip(index["ids"], index["coords"])):
+        place = {"location_id": place_id, "coord_location": coords}
+        for kind in (NAME_EMBEDDING, PREFERENCES_EMBEDDING):
+            # Последний ключ из _EMBEDDING_KEYS - тот, что пишет бэкенд
+            place[_EMBEDDING_KEYS[kind][-1]] = matrices[kind][i] if valid[kind][i] else None
+        places.append(place)
+
+    rankers = {}
+    for relax, start, end in index["types"]:
+        for place in places[start:end]:
+            place["type_of_relax"] = relax
+        rankers[relax] = PlaceRanker(
+            places[start:end],
+            {kind: matrix[start:end] for kind, matrix in matrices.items()},
+            {kind: mask[start:end] for kind, mask in valid.items()},
+        )
+
+    return places, rankers
+
+
+def _benchmark(sizes=(10_000, 100_000), dim: int = 384):
+    """Размер, время загрузки и память для JSON и бинарного формата."""
+    import tracemalloc
+
+    rng = np.random.default_rng(0)
+    types = ["рыбалка", "кемпинг", "кемпинг + рыбалка"]
+    for n in sizes:
+        places = [
+            {
+                "location_id": i,
+                "coord_location": [59.9 + rng.random(), 30.3 + rng.random()],
+                "name_embedding": rng.standard_normal(dim).astype(np.float32).tolist(),
+                "preferences_ebbedding": rng.standard_normal(dim).astype(np.float32).tolist(),
+                "type_of_relax": types[i % len(types)],
+            }
+            for i in range(n)
+        ]
+        raw_json = json.dumps(places)
+        raw_bin = encode_places(places, dim)
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        parsed = json.loads(raw_json)
+        rankers = {t: PlaceRanker.from_places([p for p in parsed if p["type_of_relax"] == t]) for t in types}
+        json_ms = (time.perf_counter() - start) * 1000
+        json_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        del parsed, rankers
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        decode_places(raw_bin)
+        bin_ms = (time.perf_counter() - start) * 1000
+        bin_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        print(
+            f"n={n:>7}: JSON {len(raw_json) / 2**20:7.1f} МБ, загрузка {json_ms:8.1f} мс, "
+            f"пик {json_peak / 2**20:7.1f} МБ | бинарный {len(raw_bin) / 2**20:6.1f} МБ, "
+            f"загрузка {bin_ms:6.1f} мс, пик {bin_peak / 2**20:6.1f} МБ"
+        )
+
+
+if __name__ == "__main__":
+    _benchmark()
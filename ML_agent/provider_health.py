@@ -0,0 +1,240 @@
+"""
+Отслеживание состояния LLM провайдеров вне пути запроса.
+
+Каждый вызов провайдера записывает задержку и исход в скользящее окно.
+Провайдер выводится из ротации после нескольких ошибок подряд или при высокой
+доле ошибок в окне, а фоновая корутина проверяет его с экспоненциальной
+задержкой (HEALTH_BACKOFF_BASE, 2x, ... до HEALTH_BACKOFF_MAX) и возвращает
+в ротацию после успешной проверки.
+
+Порядок исправных провайдеров задает LLM_ROUTING: по умолчанию priority -
+настроенный приоритет (бесплатный OpenRouter первым), latency (включается
+явно) - сначала провайдер с наименьшей задержкой реальных вызовов. Задержка
+проб (короткий запрос "Hi") учитывается отдельно и на маршрутизацию не
+влияет: пробы решают только вывод из ротации и возврат в нее.
+"""
+
+import asyncio
+import logging
+import os
+import time
+import weakref
+from collections import deque
+from typing import Dict, List, Optional
+
+
+HEALTH_WINDOW = int(os.getenv("HEALTH_WINDOW", "20"))
+HEALTH_EJECT_FAILURES = int(os.getenv("HEALTH_EJECT_FAILURES", "2"))
+HEALTH_MAX_ERROR_RATE = float(os.getenv("HEALTH_MAX_ERROR_RATE", "0.5"))
+HEALTH_MIN_SAMPLES = int(os.getenv("HEALTH_MIN_SAMPLES", "5"))
+HEALTH_BACKOFF_BASE = float(os.getenv("HEALTH_BACKOFF_BASE", "5"))
+HEALTH_BACKOFF_MAX = float(os.getenv("HEALTH_BACKOFF_MAX", "300"))
+HEALTH_PROBE_INTERVAL = float(os.getenv("HEALTH_PROBE_INTERVAL", "1"))
+# Как часто перепроверять задержку исправных провайдеров без трафика (0 - никогда)
+HEALTH_REFRESH_INTERVAL = float(os.getenv("HEALTH_REFRESH_INTERVAL", "300"))
+# priority - порядок по приоритету, latency - самый быстрый исправный провайдер
+LLM_ROUTING = os.getenv("LLM_ROUTING", "priority")
+
+_EWMA_ALPHA = 0.3
+
+# Все созданные менеджеры, чтобы остановить их пробы при завершении сервиса
+_managers: "weakref.WeakSet[ProviderHealthManager]" = weakref.WeakSet()
+
+
+class ProviderHealth:
+    """Скользящая статистика одного провайдера"""
+
+    def __init__(self, window: int = HEALTH_WINDOW):
+        self.outcomes = deque(maxlen=window)
+        self.latencies = deque(maxlen=window)
+        self.latency_ewma: Optional[float] = None
+        self.probe_latency_ewma: Optional[float] = None
+        self.consecutive_failures = 0
+        self.healthy = True
+        self.ejections = 0
+        self.backoff = 0.0
+        self.next_probe_at = 0.0
+        self.last_success_at = 0.0
+
+    def record_success(self, latency: float) -> None:
+        self.outcomes.append(True)
+        self.latencies.append(latency)
+        if self.latency_ewma is None:
+            self.latency_ewma = latency
+        else:
+            self.latency_ewma = _EWMA_ALPHA * latency + (1 - _EWMA_ALPHA) * self.latency_ewma
+        self.consecutive_failures = 0
+        self.last_success_at = time.monotonic()
+
+    def record_probe(self, latency: float) -> None:
+        """Успешная проба: подтверждает доступность, но не входит в статистику вызовов"""
+        if self.probe_latency_ewma is None:
+            self.probe_latency_ewma = latency
+        else:
+            self.probe_latency_ewma = _EWMA_ALPHA * latency + (1 - _EWMA_ALPHA) * self.probe_latency_ewma
+        self.consecutive_failures = 0
+        self.last_success_at = time.monotonic()
+
+    def record_failure(self) -> None:
+        self.outcomes.append(False)
+        self.consecutive_failures += 1
+
+    @property
+    def error_rate(self) -> float:
+        if not self.outcomes:
+            return 0.0
+        return 1 - sum(self.outcomes) / len(self.outcomes)
+
+    def should_eject(self) -> bool:
+        if self.consecutive_failures >= HEALTH_EJECT_FAILURES:
+            return True
+        return len(self.outcomes) >= HEALTH_MIN_SAMPLES and self.error_rate > HEALTH_MAX_ERROR_RATE
+
+    def latency_percentile(self, q: float) -> Optional[float]:
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class ProviderHealthManager:
+    """Состояние провайдеров Model и фоновая проверка выведенных из ротации"""
+
+    def __init__(self, providers: List, probe_interval: float = HEALTH_PROBE_INTERVAL):
+        self.providers = providers
+        self.probe_interval = probe_interval
+        self.health: Dict[str, ProviderHealth] = {p.name: ProviderHealth() for p in providers}
+        self._task: Optional[asyncio.Task] = None
+        _managers.add(self)
+
+    def ordered(self) -> List:
+        """
+        Провайдеры в порядке попыток: исправные (по задержке или приоритету),
+        затем выведенные из ротации - как последняя надежда, ближайшая проверка первой.
+        """
+        def healthy_key(provider):
+            if LLM_ROUTING == "priority":
+                return (provider.priority,)
+            latency = self.health[provider.name].latency_ewma
+            # Провайдеры без замеров идут после измеренных, по приоритету
+            return (latency is None, latency or 0.0, provider.priority)
+
+        healthy = [p for p in self.providers if self.health[p.name].healthy]
+        ejected = [p for p in self.providers if not self.health[p.name].healthy]
+        return (
+            sorted(healthy, key=healthy_key)
+            + sorted(ejected, key=lambda p: self.health[p.name].next_probe_at)
+        )
+
+    def record_success(self, provider, latency: float) -> None:
+        health = self.health[provider.name]
+        health.record_success(latency)
+        if not health.healthy:
+            self._readmit(provider)
+
+    def record_failure(self, provider) -> None:
+        health = self.health[provider.name]
+        health.record_failure()
+        if health.healthy and health.should_eject():
+            self._eject(provider)
+        elif not health.healthy:
+            self._schedule_probe(health)
+
+    def _eject(self, provider) -> None:
+        health = self.health[provider.name]
+        health.healthy = False
+        health.ejections += 1
+        # Часто выпадающий провайдер возвращается в ротацию все медленнее
+        health.backoff = min(HEALTH_BACKOFF_BASE * 2 ** (min(health.ejections, 10) - 1), HEALTH_BACKOFF_MAX)
+        health.next_probe_at = time.monotonic() + health.backoff
+        provider.is_available = False
+        provider.failure_count = health.consecutive_failures
+        logging.error(
+            f"Provider {provider.name} removed from rotation "
+            f"(errors {health.error_rate:.0%}), next probe in {health.backoff:.0f}s"
+        )
+
+    def _readmit(self, provider) -> None:
+        health = self.health[provider.name]
+        health.healthy = True
+        health.backoff = 0.0
+        health.outcomes.clear()
+        provider.is_available = True
+        provider.failure_count = 0
+        logging.info(f"Provider {provider.name} restored")
+
+    @staticmethod
+    def _schedule_probe(health: ProviderHealth) -> None:
+        if health.backoff:
+            health.backoff = min(health.backoff * 2, HEALTH_BACKOFF_MAX)
+        else:
+            health.backoff = HEALTH_BACKOFF_BASE
+        health.next_probe_at = time.monotonic() + health.backoff
+
+    async def probe(self, provider) -> bool:
+        """Одна проверка провайдера коротким запросом"""
+        started = time.perf_counter()
+        ok = await provider.aprobe()
+        if ok:
+            health = self.health[provider.name]
+            health.record_probe(time.perf_counter() - started)
+            if not health.healthy:
+                self._readmit(provider)
+        else:
+            self.record_failure(provider)
+        return ok
+
+    def _due_for_probe(self, provider, now: float) -> bool:
+        health = self.health[provider.name]
+        if not health.healthy:
+            return now >= health.next_probe_at
+        if health.latency_ewma is None and health.probe_latency_ewma is None and not health.outcomes:
+            return True
+        return bool(HEALTH_REFRESH_INTERVAL) and now - health.last_success_at > HEALTH_REFRESH_INTERVAL
+
+    async def _probe_loop(self) -> None:
+        while True:
+            now = time.monotonic()
+            due = [p for p in self.providers if self._due_for_probe(p, now)]
+            if due:
+                await asyncio.gather(*(self.probe(p) for p in due), return_exceptions=True)
+            await asyncio.sleep(self.probe_interval)
+
+    def ensure_started(self) -> None:
+        """Запускает фоновые проверки в текущем event loop (повторные вызовы ничего не делают)"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._probe_loop())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def get_status(self, provider) -> Dict:
+        health = self.health[provider.name]
+        p50 = health.latency_percentile(0.5)
+        p90 = health.latency_percentile(0.9)
+        return {
+            "healthy": health.healthy,
+            "error_rate": round(health.error_rate, 3),
+            "samples": len(health.outcomes),
+            "consecutive_failures": health.consecutive_failures,
+            "latency_ewma_ms": round(health.latency_ewma * 1000) if health.latency_ewma is not None else None,
+            "latency_p50_ms": round(p50 * 1000) if p50 is not None else None,
+            "latency_p90_ms": round(p90 * 1000) if p90 is not None else None,
+            "probe_latency_ewma_ms": (
+                round(health.probe_latency_ewma * 1000) if health.probe_latency_ewma is not None else None
+            ),
+            "ejections": health.ejections,
+            "next_probe_in_s": (
+                round(max(0.0, health.next_probe_at - time.monotonic()), 1)
+                if not health.healthy else None
+            ),
+        }
+
+
+async def stop_all_probes() -> None:
+    """Останавливает фоновые проверки всех менеджеров (при завершении сервиса)"""
+    for manager in list(_managers):
+        await manager.stop()
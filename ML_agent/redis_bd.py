@@ -1,51 +1,169 @@
 import redis
 import json
 import os
+import threading
+import zlib
 from typing import List, Dict, Optional
 from dotenv import load_dotenv
+from calculate_distance.ranking import PlaceRanker
+from places_binary import encode_places, decode_places
+
+# Ключ с кэшем всех мест и счетчик версий, который бэкенд (CacheService)
+# увеличивает при каждой перезаписи или удалении кэша
+PLACES_KEY = 'all_places'
+PLACES_VERSION_KEY = 'all_places:version'
+# Тот же кэш в бинарном формате (см. places_binary). Его пишет ML сервис после
+# разбора JSON вместе с номером версии all_places, из которой он построен
+PLACES_BINARY_KEY = 'all_places:bin'
+PLACES_BINARY_VERSION_KEY = 'all_places:bin:version'
+
+
+class PlacesSnapshot:
+    """Разобранная копия all_places, заранее разбитая по type_of_relax"""
+
+    def __init__(
+        self,
+        version: Optional[str],
+        places: List[Dict],
+        rankers: Optional[Dict[Optional[str], PlaceRanker]] = None
+    ):
+        self.version = version
+        self.places = places
+        self.by_type: Dict[Optional[str], List[Dict]] = {}
+        for place in places:
+            self.by_type.setdefault(place.get('type_of_relax'), []).append(place)
+        self._rankers: Dict[Optional[str], PlaceRanker] = dict(rankers or {})
+        self._lock = threading.Lock()
+
+    def get_places(self, type_of_relax: Optional[str] = None) -> List[Dict]:
+        if type_of_relax is None:
+            return self.places
+        return self.by_type.get(type_of_relax, [])
+
+    def get_ranker(self, type_of_relax: Optional[str]) -> PlaceRanker:
+        """Матрицы embeddings строятся один раз на версию снимка и тип отдыха"""
+        with self._lock:
+            ranker = self._rankers.get(type_of_relax)
+            if ranker is None:
+                ranker = PlaceRanker.from_places(self.get_places(type_of_relax))
+                self._rankers[type_of_relax] = ranker
+            return ranker
+
+
 class RedisManager:
     """Менеджер для работы с Redis"""
-    
+
     def __init__(self):
-        
 
-        self.client = redis.Redis(
+
+        connection = dict(
             host="redis",
             port=int(os.getenv('REDIS_PORT', '6379')),
             password=os.getenv('REDIS_PASSWORD', '1lomalsteklo'),
-            decode_responses=True
         )
-    
+        self.client = redis.Redis(**connection, decode_responses=True)
+        # Для all_places:bin нужны сырые байты
+        self.binary_client = redis.Redis(**connection, decode_responses=False)
+        self._snapshot = PlacesSnapshot(None, [])
+        self._snapshot_lock = threading.Lock()
+
+    def _load_snapshot(self) -> PlacesSnapshot:
+        """
+        Возвращает актуальный снимок all_places.
+
+        Сначала проверяется дешевый счетчик версий PLACES_VERSION_KEY: если он не
+        изменился и ключ с местами еще существует, значение не читается и не парсится.
+        Если бэкенд не пишет версию, версией служит crc32 сырого значения,
+        что все равно избавляет от повторного разбора.
+
+        Бинарный ключ PLACES_BINARY_KEY читается, только если он построен из
+        текущей версии (PLACES_BINARY_VERSION_KEY == PLACES_VERSION_KEY): бэкенд
+        обновляет только JSON, и устаревшая бинарная копия не используется.
+        После разбора JSON бинарная копия перезаписывается, чтобы остальные
+        процессы ML сервиса (и этот после перезапуска) не разбирали JSON заново.
+        """
+        with self._snapshot_lock:
+            pipe = self.client.pipeline(transaction=False)
+            pipe.get(PLACES_VERSION_KEY)
+            pipe.get(PLACES_BINARY_VERSION_KEY)
+            pipe.exists(PLACES_KEY)
+            version, binary_version, json_exists = pipe.execute()
+
+            if not json_exists:
+                if self._snapshot.places:
+                    self._snapshot = PlacesSnapshot(None, [])
+                return self._snapshot
+
+            if version is not None and self._snapshot.version == f"v:{version}":
+                return self._snapshot
+
+            if version is not None and binary_version == version:
+                cached = self.binary_client.get(PLACES_BINARY_KEY)
+                if cached:
+                    places, rankers = decode_places(cached)
+                    self._snapshot = PlacesSnapshot(f"v:{version}", places, rankers)
+                    return self._snapshot
+
+            cached = self.client.get(PLACES_KEY)
+            if not cached:
+                self._snapshot = PlacesSnapshot(None, [])
+                return self._snapshot
+
+            if version is not None:
+                snapshot_version = f"v:{version}"
+            else:
+                snapshot_version = f"crc:{zlib.crc32(cached.encode('utf-8'))}"
+
+            if self._snapshot.version != snapshot_version:
+                places = json.loads(cached)
+                self._snapshot = PlacesSnapshot(snapshot_version, places)
+                if version is not None:
+                    self.write_binary_places(places, version)
+            return self._snapshot
+
+    def write_binary_places(self, places: List[Dict], version: str, ttl_hours: int = 10) -> None:
+        """
+        Записывает места в бинарном формате с номером версии all_places, из которой они получены.
+        Если бэкенд тем временем обновил JSON, версии не совпадут и копия не будет прочитана.
+
+        Args:
+            places: Места в формате all_places (location_id, coord_location, embeddings, type_of_relax)
+            version: Значение PLACES_VERSION_KEY, при котором прочитан JSON
+            ttl_hours: Время жизни ключа, как у all_places в CacheService
+        """
+        try:
+            pipe = self.binary_client.pipeline(transaction=True)
+            pipe.set(PLACES_BINARY_KEY, encode_places(places), ex=ttl_hours * 3600)
+            pipe.set(PLACES_BINARY_VERSION_KEY, version, ex=ttl_hours * 3600)
+            pipe.execute()
+        except redis.RedisError as e:
+            print(f"Ошибка записи бинарного кэша мест: {e}")
+
     def get_all_places(self, type_of_relax: Optional[str] = None) -> List[Dict]:
         """
         Получает все места из Redis кэша с опциональной фильтрацией по типу отдыха.
-        
+
         Args:
             type_of_relax: Тип отдыха для фильтрации. Если None, возвращает все места.
-        
+
         Returns:
-            Список мест с embeddings и координатами
+            Список мест с embeddings и координатами. Список общий для всех
+            запросов текущей версии кэша, изменять его нельзя.
         """
-        
-        
+
+
         try:
-            cached = self.client.get('all_places')
-            if cached:
-                all_places = json.loads(cached)
-                
-                # Если type_of_relax не указан, возвращаем все места
-                if type_of_relax is None:
-                    return all_places
-                
-                # Фильтруем места по type_of_relax
-                filtered_places = [
-                    place for place in all_places 
-                    if place.get('type_of_relax') == type_of_relax
-                ]
-                
-                return filtered_places
-            return []
+            return self._load_snapshot().get_places(type_of_relax)
         except redis.RedisError as e:
             print(f"Ошибка Redis при получении мест: {e}")
             return []
-    
\ No newline at end of file
+
+    def get_ranker(self, type_of_relax: Optional[str]) -> PlaceRanker:
+        """
+        Возвращает PlaceRanker по местам указанного типа отдыха из текущей версии кэша.
+        """
+        try:
+            return self._load_snapshot().get_ranker(type_of_relax)
+        except redis.RedisError as e:
+            print(f"Ошибка Redis при получении мест: {e}")
+            return PlaceRanker.from_places([])
@@ -1,9 +1,15 @@
 from enum import Enum
 from langchain.schema import HumanMessage, SystemMessage
 from pydantic import BaseModel
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Tuple
 import logging
+import os
 from model_provider import Model
+from extraction_cache import ExtractionCache
+from relax_type_rules import relax_type_rules
+
+# Извлекать тип отдыха и поля запроса одним вызовом LLM вместо двух
+COMBINED_EXTRACTION = os.getenv("LLM_COMBINED_EXTRACTION", "1") == "1"
 
 
 class RelaxType(Enum):
@@ -64,9 +70,28 @@ class RelaxTypeClassifier(BaseModel):
     relax_type: str  # "рыбалка", "кемпинг" или "кемпинг + рыбалка"
 
 
+class SearchQueryExtraction(BaseModel):
+    """Тип отдыха и поля запроса пользователя за один вызов LLM"""
+    relax_type: str  # "рыбалка", "кемпинг" или "кемпинг + рыбалка"
+    wish_location: Optional[List[str]] = []
+    location_user: Optional[str] = None
+    user_preferences: Optional[List[str]] = []
+    user_coordinates: Optional[List[float]] = []
+    caught_fishes: Optional[List[str]] = []
+    water_space: Optional[List[str]] = []
+    wish_price: Optional[float] = None
+
+
+class PlaceSummary(BaseModel):
+    """Сжатое описание места по отзывам"""
+    summary: str
+
+
 class RelaxAnalyzer:
-    def __init__(self, model: Model):
+    def __init__(self, model: Model, cache: Optional[ExtractionCache] = None):
         self.model = model
+        # Кэш ответов LLM для асинхронных методов (None - без кэша)
+        self.cache = cache
         
         # Контекст для определения типа отдыха
         self.relax_type_context = """
@@ -167,6 +192,31 @@ class RelaxAnalyzer:
             """
         }
         
+        # Контекст для совмещенного определения типа отдыха и извлечения полей запроса
+        self.search_query_context = self.relax_type_context + """
+Также извлеки информацию о планируемой поездке из сообщения пользователя:
+- relax_type: тип отдыха, определенный по правилам выше
+- wish_location: место, куда пользователь хочет поехать, или рядом с каким-то местом, например ['Карелия'] или ['побережье Финского залива'] или ['Станция метро Автово']
+- location_user: название места откуда выезжает пользователь, если указано, например "Станция метро Автово"
+- user_preferences: общие предпочтения и пожелания пользователя, например ['хочу тихое место', 'нужна парковка', 'можно с ночевкой', 'нужен душ', 'есть пляж']
+- user_coordinates: координаты места откуда человек планирует выехать (город, район), например [59.861234, 30.154855]
+- caught_fishes: только для рыбалки - рыбы, которых пользователь хочет поймать, например ['щука', 'окунь']
+- water_space: только для рыбалки - вид водоема где человек хочет рыбачить, например ['озеро'] или ['река']
+- wish_price: желаемая цена или бюджет (в рублях), если указан
+"""
+        
+    
+        # Контекст для сжатия старых отзывов о месте в сводку
+        self.place_summary_context = """
+Ты ведешь краткую сводку о месте отдыха ({relax_type}) по отзывам пользователей.
+Дана текущая сводка (может быть пустой) и новые отзывы. Верни обновленную сводку:
+- сохрани все факты из текущей сводки, если новые отзывы им не противоречат
+- добавь новые факты: условия, инфраструктура, подъезд, улов, цены, сезонность
+- при противоречии оставь более свежие сведения из отзывов
+- без повторов, без оценок от себя, НЕ ПРИДУМЫВАЙ НИЧЕГО, чего нет в тексте
+- не длиннее {max_words} слов
+"""
+        
     
     def _get_schema_and_context(self, relax_type: RelaxType, request_type: RequestType):
         """Возвращает нужную схему и контекст в зависимости от типа отдыха и типа запроса"""
@@ -185,6 +235,44 @@ class RelaxAnalyzer:
             
         raise ValueError(f"Неподдерживаемый тип отдыха: {relax_type}")
     
+    def _build_messages(self, message: str, relax_type: RelaxType, request_type: RequestType):
+        """Возвращает схему и сообщения для извлечения информации"""
+        schema, context = self._get_schema_and_context(relax_type, request_type)
+        messages = [
+            SystemMessage(content=context),
+            HumanMessage(content=message)
+        ]
+        return schema, messages
+    
+    def _format_result(self, result, relax_type: RelaxType, request_type: RequestType) -> dict:
+        """Формирует результат в зависимости от типа запроса и отдыха"""
+        if request_type == RequestType.EXISTING_PLACES:
+            # Для существующих мест
+            output = {
+                "type_of_relax": relax_type.value,
+                "name_location": result.name_location,
+                "user_preferences": result.user_preferences,
+                "place_coordinates": result.place_coordinates,
+                "wish_price": result.wish_price
+            }
+        else:
+            # Для запросов пользователей
+            output = {
+                "type_of_relax": relax_type.value,
+                "wish_location": result.wish_location,
+                "location_user": result.location_user,
+                "user_preferences": result.user_preferences,
+                "user_coordinates": result.user_coordinates,
+                "wish_price": result.wish_price
+            }
+        
+        # Добавляем специфичные для рыбалки поля
+        if relax_type in [RelaxType.FISHING, RelaxType.FISHING_AND_CAMPING]:
+            output["caught_fishes"] = result.caught_fishes
+            output["water_space"] = result.water_space
+        
+        return output
+    
     def analyze_message(self, message: str, relax_type: RelaxType, request_type: RequestType) -> dict:
         """
         Анализирует сообщение пользователя и извлекает информацию
@@ -198,53 +286,49 @@ class RelaxAnalyzer:
             dict: словарь с извлеченной информацией
         """
         try:
-            schema, context = self._get_schema_and_context(relax_type, request_type)
+            schema, messages = self._build_messages(message, relax_type, request_type)
             structured_llm = self.model.with_structured_output(schema)
-            
-            messages = [
-                SystemMessage(content=context),
-                HumanMessage(content=message)
-            ]
-            
             result = structured_llm.invoke(messages)
+            return self._format_result(result, relax_type, request_type)
             
-            # Формируем результат в зависимости от типа запроса и отдыха
-            if request_type == RequestType.EXISTING_PLACES:
-                # Для существующих мест
-                output = {
-                    "type_of_relax": relax_type.value,
-                    "name_location": result.name_location,
-                    "user_preferences": result.user_preferences,
-                    "place_coordinates": result.place_coordinates,
-                    "wish_price": result.wish_price
-                }
-                
-                # Добавляем специфичные для рыбалки поля
-                if relax_type in [RelaxType.FISHING, RelaxType.FISHING_AND_CAMPING]:
-                    output["caught_fishes"] = result.caught_fishes
-                    output["water_space"] = result.water_space
-            else:
-                # Для запросов пользователей
-                output = {
-                    "type_of_relax": relax_type.value,
-                    "wish_location": result.wish_location,
-                    "location_user": result.location_user,
-                    "user_preferences": result.user_preferences,
-                    "user_coordinates": result.user_coordinates,
-                    "wish_price": result.wish_price
-                }
-                
-                # Добавляем специфичные для рыбалки поля
-                if relax_type in [RelaxType.FISHING, RelaxType.FISHING_AND_CAMPING]:
-                    output["caught_fishes"] = result.caught_fishes
-                    output["water_space"] = result.water_space
-            
+        except Exception as e:
+            logging.error(f"Failed to analyze message: {e}")
+            raise
+    
+    async def aanalyze_message(self, message: str, relax_type: RelaxType, request_type: RequestType) -> dict:
+        """Асинхронная версия analyze_message (не блокирует event loop), с кэшем ответов"""
+        if self.cache is not None:
+            cached = await self.cache.get(message, relax_type, request_type)
+            if cached is not None:
+                return cached
+        try:
+            schema, messages = self._build_messages(message, relax_type, request_type)
+            structured_llm = self.model.with_structured_output(schema)
+            result = await structured_llm.ainvoke(messages)
+            output = self._format_result(result, relax_type, request_type)
+            if self.cache is not None:
+                await self.cache.set(message, relax_type, request_type, output)
             return output
             
         except Exception as e:
             logging.error(f"Failed to analyze message: {e}")
             raise
     
+    def _parse_relax_type(self, result: RelaxTypeClassifier) -> RelaxType:
+        """Преобразует ответ классификатора в RelaxType"""
+        relax_type_str = result.relax_type.lower().strip()
+        
+        if "рыбалка" in relax_type_str and "кемпинг" in relax_type_str:
+            return RelaxType.FISHING_AND_CAMPING
+        elif "рыбалка" in relax_type_str:
+            return RelaxType.FISHING
+        elif "кемпинг" in relax_type_str:
+            return RelaxType.CAMPING
+        else:
+            # По умолчанию рыбалка, если не удалось определить
+            logging.warning(f"Не удалось точно определить тип отдыха из '{relax_type_str}', используем FISHING")
+            return RelaxType.FISHING
+    
     def determine_relax_type(self, message: str) -> RelaxType:
         """
         Определяет тип отдыха на основе запроса пользователя
@@ -255,6 +339,12 @@ class RelaxAnalyzer:
         Returns:
             RelaxType: определенный тип отдыха
         """
+        # Уверенно классифицируемые запросы определяются без LLM
+        rule_type = relax_type_rules.predict(message)
+        if rule_type is not None:
+            relax_type_rules.stats.incr("llm_calls_saved")
+            return RelaxType(rule_type)
+        
         try:
             structured_llm = self.model.with_structured_output(RelaxTypeClassifier)
             
@@ -264,30 +354,112 @@ class RelaxAnalyzer:
             ]
             
             result = structured_llm.invoke(messages)
+            return self._parse_relax_type(result)
+                
+        except Exception as e:
+            logging.error(f"Failed to determine relax type: {e}")
+            # В случае ошибки возвращаем рыбалку как наиболее вероятный вариант
+            return RelaxType.FISHING
+    
+    async def adetermine_relax_type(self, message: str) -> RelaxType:
+        """Асинхронная версия determine_relax_type"""
+        rule_type = relax_type_rules.predict(message)
+        if rule_type is not None:
+            relax_type_rules.stats.incr("llm_calls_saved")
+            return RelaxType(rule_type)
+        return await self._allm_determine_relax_type(message)
+    
+    async def _allm_determine_relax_type(self, message: str) -> RelaxType:
+        """Определение типа отдыха через LLM (без правил)"""
+        try:
+            structured_llm = self.model.with_structured_output(RelaxTypeClassifier)
             
-            # Преобразуем строку в enum
-            relax_type_str = result.relax_type.lower().strip()
+            messages = [
+                SystemMessage(content=self.relax_type_context),
+                HumanMessage(content=message)
+            ]
             
-            if "рыбалка" in relax_type_str and "кемпинг" in relax_type_str:
-                return RelaxType.FISHING_AND_CAMPING
-            elif "рыбалка" in relax_type_str:
-                return RelaxType.FISHING
-            elif "кемпинг" in relax_type_str:
-                return RelaxType.CAMPING
-            else:
-                # По умолчанию рыбалка, если не удалось определить
-                logging.warning(f"Не удалось точно определить тип отдыха из '{relax_type_str}', используем FISHING")
-                return RelaxType.FISHING
+            result = await structured_llm.ainvoke(messages)
+            return self._parse_relax_type(result)
                 
         except Exception as e:
             logging.error(f"Failed to determine relax type: {e}")
-            # В случае ошибки возвращаем рыбалку как наиболее вероятный вариант
             return RelaxType.FISHING
     
+    async def aanalyze_search_query(self, message: str) -> Tuple[RelaxType, dict]:
+        """
+        Определяет тип отдыха и извлекает поля запроса пользователя.
+        
+        Если тип отдыха уверенно определен правилами (relax_type_rules), остается
+        только извлечение полей. Иначе при LLM_COMBINED_EXTRACTION=1 это один вызов
+        LLM со схемой SearchQueryExtraction, а при его ошибке - прежние два шага:
+        определение типа через LLM и aanalyze_user_query.
+        
+        Returns:
+            (тип отдыха, словарь в формате aanalyze_user_query)
+        """
+        if self.cache is not None:
+            # Тип отдыха еще неизвестен, поэтому отдельная область кэша
+            cached = await self.cache.get(message, None, RequestType.QUERY_USERS)
+            if cached is not None:
+                return RelaxType(cached["type_of_relax"]), cached
+        
+        relax_type, output = None, None
+        rule_type = relax_type_rules.predict(message)
+        if rule_type is not None:
+            # Тип известен по правилам - остается только извлечение полей
+            relax_type = RelaxType(rule_type)
+            output = await self.aanalyze_user_query(message, relax_type)
+        elif COMBINED_EXTRACTION:
+            try:
+                relax_type, output = await self._aanalyze_search_query_combined(message)
+            except Exception as e:
+                logging.warning(f"Совмещенное извлечение не удалось, используем два шага: {e}")
+        
+        if output is None:
+            relax_type, output = await self._aanalyze_search_query_two_step(message)
+        
+        if self.cache is not None:
+            await self.cache.set(message, None, RequestType.QUERY_USERS, output)
+        return relax_type, output
+    
+    async def _aanalyze_search_query_combined(self, message: str) -> Tuple[RelaxType, dict]:
+        structured_llm = self.model.with_structured_output(SearchQueryExtraction)
+        messages = [
+            SystemMessage(content=self.search_query_context),
+            HumanMessage(content=message)
+        ]
+        result = await structured_llm.ainvoke(messages)
+        relax_type = self._parse_relax_type(result)
+        return relax_type, self._format_result(result, relax_type, RequestType.QUERY_USERS)
+    
+    async def _aanalyze_search_query_two_step(self, message: str) -> Tuple[RelaxType, dict]:
+        relax_type = await self._allm_determine_relax_type(message)
+        return relax_type, await self.aanalyze_user_query(message, relax_type)
+    
+    async def asummarize_place(self, summary: str, reviews: List[str], relax_type: RelaxType, max_words: int) -> str:
+        """Дополняет сводку о месте старыми отзывами, вытесненными из описания"""
+        structured_llm = self.model.with_structured_output(PlaceSummary)
+        reviews_text = "\n\n".join(f"Отзыв {i}: {review}" for i, review in enumerate(reviews, 1))
+        messages = [
+            SystemMessage(content=self.place_summary_context.format(relax_type=relax_type.value, max_words=max_words)),
+            HumanMessage(content=f"Текущая сводка: {summary or '(пусто)'}\n\nНовые отзывы:\n{reviews_text}")
+        ]
+        result = await structured_llm.ainvoke(messages)
+        return result.summary.strip()
+    
     def analyze_existing_place(self, message: str, relax_type: RelaxType) -> dict:
         """Анализирует сообщение о существующем месте отдыха"""
         return self.analyze_message(message, relax_type, RequestType.EXISTING_PLACES)
     
     def analyze_user_query(self, message: str, relax_type: RelaxType) -> dict:
         """Анализирует запрос пользователя о планируемом отдыхе"""
-        return self.analyze_message(message, relax_type, RequestType.QUERY_USERS)
\ No newline at end of file
+        return self.analyze_message(message, relax_type, RequestType.QUERY_USERS)
+    
+    async def aanalyze_existing_place(self, message: str, relax_type: RelaxType) -> dict:
+        """Асинхронно анализирует сообщение о существующем месте отдыха"""
+        return await self.aanalyze_message(message, relax_type, RequestType.EXISTING_PLACES)
+    
+    async def aanalyze_user_query(self, message: str, relax_type: RelaxType) -> dict:
+        """Асинхронно анализирует запрос пользователя о планируемом отдыхе"""
+        return await self.aanalyze_message(message, relax_type, RequestType.QUERY_USERS)
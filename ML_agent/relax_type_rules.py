@@ -0,0 +1,210 @@
+"""
+Быстрое определение типа отдыха по ключевым словам без вызова LLM.
+
+Слова запроса приводятся к начальной форме (pymorphy3) и сверяются со
+списками из relax_type_context. Уверенно классифицированные запросы
+отвечаются локально, неоднозначные (нет ключевых слов, только косвенные
+признаки, оба типа сразу, отрицания "без рыбалки", "не хочу рыбачить")
+передаются в LLM.
+
+Проверка согласованности с LLM на отложенном наборе запросов:
+    python relax_type_rules.py queries.txt
+"""
+
+import os
+import re
+from functools import lru_cache
+from typing import Dict, Optional, Tuple
+
+from cache_utils import CacheStats
+
+try:
+    import pymorphy3
+except ImportError:
+    pymorphy3 = None
+
+
+RELAX_RULES_ENABLED = os.getenv("RELAX_RULES", "1") == "1"
+RELAX_RULES_MIN_CONFIDENCE = float(os.getenv("RELAX_RULES_MIN_CONFIDENCE", "0.75"))
+
+# Вес 1.0 - однозначный признак, 0.5 - косвенный
+FISHING_LEMMAS: Dict[str, float] = {
+    **dict.fromkeys((
+        "рыбалка", "рыбачить", "порыбачить", "рыбак", "рыболов", "рыболовный",
+        "рыба", "ловить", "поймать", "наловить", "улов", "клев", "клевать",
+        "поклевка", "спиннинг", "удочка", "блесна", "наживка",
+        "прикормка", "снасть", "фидер", "поплавок", "мормышка", "воблер",
+        "джиг", "донка", "жерлица", "щука", "окунь", "судак", "карась", "лещ",
+        "плотва", "форель", "сом", "карп", "налим", "язь", "голавль", "жерех",
+        "хариус", "ряпушка", "корюшка", "ерш", "краснопёрка", "красноперка",
+        "линь", "уклейка", "густера", "сиг", "лосось", "толстолобик",
+    ), 1.0),
+    # "амур" - и рыба, и река
+    **dict.fromkeys(("пирс", "мостки", "лодка", "водоем", "плес", "амур"), 0.5),
+}
+
+CAMPING_LEMMAS: Dict[str, float] = {
+    **dict.fromkeys((
+        "кемпинг", "глэмпинг", "палатка", "палаточный", "ночевка", "ночевать",
+        "переночевать", "заночевать", "пикник", "костер", "костровище",
+        "мангал", "шашлык", "поход", "турбаза", "автокемпинг",
+    ), 1.0),
+    **dict.fromkeys((
+        "душ", "туалет", "беседка", "домик", "ребенок", "дети", "семья",
+        "отдых", "отдохнуть", "купаться", "пляж", "баня", "сауна",
+    ), 0.5),
+}
+
+NEGATIONS = {"не", "без", "кроме", "нельзя"}
+# Отрицание действует на столько следующих слов в пределах части фразы:
+# "не хочу рыбачить" - отрицание, "не хочу ехать далеко, рыбачить" - нет
+NEGATION_WINDOW = 3
+# Без однозначных признаков косвенные дают не больше этого веса (уверенность 0.5)
+WEAK_ONLY_MAX_WEIGHT = 0.5
+
+_TOKEN_RE = re.compile(r"[a-zа-яё]+|[.,;:!?()]")
+
+
+@lru_cache(maxsize=1)
+def _get_morph():
+    if pymorphy3 is None:
+        print("pymorphy3 не установлен, тип отдыха всегда определяется через LLM")
+        return None
+    return pymorphy3.MorphAnalyzer()
+
+
+@lru_cache(maxsize=50000)
+def lemmatize(word: str) -> str:
+    morph = _get_morph()
+    lemma = morph.parse(word)[0].normal_form if morph is not None else word
+    return lemma.replace("ё", "е")
+
+
+class RelaxTypeRules:
+    """Классификатор типа отдыха по леммам ключевых слов"""
+
+    def __init__(self, min_confidence: float = RELAX_RULES_MIN_CONFIDENCE):
+        self.min_confidence = min_confidence
+        self.fishing = {k.replace("ё", "е"): v for k, v in FISHING_LEMMAS.items()}
+        self.camping = {k.replace("ё", "е"): v for k, v in CAMPING_LEMMAS.items()}
+        # hits_rules - ответ без LLM, misses - запрос ушел в LLM
+        self.stats = CacheStats()
+
+    def _weight(self, strong: float, weak: float) -> float:
+        """Косвенные признаки усиливают однозначные, но сами по себе ниже порога уверенности"""
+        return strong + weak if strong else min(weak, WEAK_ONLY_MAX_WEIGHT)
+
+    def score(self, message: str) -> Tuple[float, float, bool]:
+        """
+        Returns:
+            (вес признаков рыбалки, вес признаков кемпинга, есть ли отрицание перед признаком)
+        """
+        totals = {"fishing": [0.0, 0.0], "camping": [0.0, 0.0]}
+        negated = False
+        negation_left = 0
+        for token in _TOKEN_RE.findall(message.lower()):
+            if not token[0].isalpha():
+                # Граница части фразы: отрицание дальше не действует
+                negation_left = 0
+                continue
+            lemma = lemmatize(token)
+            if lemma in NEGATIONS:
+                negation_left = NEGATION_WINDOW
+                continue
+            matched = False
+            for kind, lemmas in (("fishing", self.fishing), ("camping", self.camping)):
+                weight = lemmas.get(lemma, 0.0)
+                if weight:
+                    matched = True
+                    totals[kind][0 if weight >= 1.0 else 1] += weight
+            if matched and negation_left:
+                negated = True
+            negation_left = max(negation_left - 1, 0)
+        return self._weight(*totals["fishing"]), self._weight(*totals["camping"]), negated
+
+    def classify(self, message: str) -> Tuple[Optional[str], float]:
+        """
+        Определяет тип отдыха по ключевым словам.
+
+        Returns:
+            (значение RelaxType или None, уверенность от 0 до 1).
+            None означает, что запрос нужно отправить в LLM.
+        """
+        if not RELAX_RULES_ENABLED or _get_morph() is None:
+            return None, 0.0
+
+        fishing, camping, negated = self.score(message)
+        if negated:
+            return None, 0.0
+
+        # Каждый однозначный признак уменьшает вероятность ошибки в 4 раза
+        if fishing and camping:
+            relax_type, weight = "кемпинг + рыбалка", min(fishing, camping)
+        elif fishing:
+            relax_type, weight = "рыбалка", fishing
+        elif camping:
+            relax_type, weight = "кемпинг", camping
+        else:
+            return None, 0.0
+        return relax_type, round(1 - 0.25 ** weight, 4)
+
+    def predict(self, message: str) -> Optional[str]:
+        """
+        Значение RelaxType, если уверенность достаточна, иначе None (и учет в статистике).
+        "кемпинг + рыбалка" не возвращается: для него нет схемы извлечения,
+        такие запросы LLM сводит к одному типу.
+        """
+        relax_type, confidence = self.classify(message)
+        if relax_type is not None and relax_type != "кемпинг + рыбалка" and confidence >= self.min_confidence:
+            self.stats.incr("hits_rules")
+            return relax_type
+        self.stats.incr("misses")
+        return None
+
+
+relax_type_rules = RelaxTypeRules()
+
+
+async def _evaluate(path: str) -> None:
+    """Сравнение правил с LLM на отложенном наборе запросов"""
+    import time
+    from model_provider import Model
+    from relax_analyzer import RelaxAnalyzer
+    from evaluate_extraction import load_queries
+
+    analyzer = RelaxAnalyzer(Model())
+    queries = load_queries(path)
+    covered = agreed = 0
+    buckets: Dict[float, list] = {}
+    rules_time = 0.0
+    for query in queries:
+        start = time.perf_counter()
+        relax_type, confidence = relax_type_rules.classify(query)
+        rules_time += time.perf_counter() - start
+        llm_type = (await analyzer._allm_determine_relax_type(query)).value
+        if relax_type is None:
+            continue
+        bucket = buckets.setdefault(round(confidence, 2), [0, 0])
+        bucket[0] += 1
+        bucket[1] += relax_type == llm_type
+        if confidence >= relax_type_rules.min_confidence:
+            covered += 1
+            agreed += relax_type == llm_type
+        else:
+            print(f"  [{confidence:.2f}] {relax_type:<18} LLM: {llm_type:<18} {query[:60]}")
+
+    print(f"\nЗапросов: {len(queries)}")
+    print(f"Без LLM (уверенность >= {relax_type_rules.min_confidence}): {covered} ({covered / max(len(queries), 1):.1%})")
+    print(f"Согласованность с LLM на них: {agreed / max(covered, 1):.1%}")
+    print(f"Среднее время правил: {rules_time / max(len(queries), 1) * 1e6:.0f} мкс")
+    for confidence, (total, same) in sorted(buckets.items()):
+        print(f"  уверенность {confidence:.2f}: {total} запросов, согласие {same / total:.1%}")
+
+
+if __name__ == "__main__":
+    import asyncio
+    import sys
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    asyncio.run(_evaluate(sys.argv[1]))
@@ -0,0 +1,114 @@
+"""
+Прогрев моделей при старте сервиса.
+
+Каждый шаг загружает модель и прогоняет пробный инференс в отдельном потоке,
+/health отвечает 503, пока все шаги не завершены, поэтому первый запрос
+после деплоя не ждет загрузку весов. Неудачный шаг повторяется в фоне
+с экспоненциальной задержкой (WARMUP_RETRY_BASE, 2x, ... до WARMUP_RETRY_MAX),
+а /health тем временем отвечает 503 со статусом "degraded" и ошибкой шага.
+
+WARMUP_STEPS задает состав и порядок шагов (names, semantic, yolo),
+WARMUP_PARALLEL=1 запускает их одновременно, 0 - по очереди.
+LLM провайдеры прогреваются фоновыми проверками ProviderHealthManager.
+"""
+
+import asyncio
+import os
+import time
+from typing import Callable, Dict, List, Optional
+
+from calculate_distance.encoder import warmup_name_model, warmup_semantic_model
+from CV_for_person_detect.YOLO_predict import warmup as warmup_yolo
+
+
+WARMUP_STEPS = [s.strip() for s in os.getenv("WARMUP_STEPS", "names,semantic,yolo").split(",") if s.strip()]
+WARMUP_PARALLEL = os.getenv("WARMUP_PARALLEL", "1") == "1"
+WARMUP_RETRY_BASE = float(os.getenv("WARMUP_RETRY_BASE", "5"))
+WARMUP_RETRY_MAX = float(os.getenv("WARMUP_RETRY_MAX", "300"))
+
+STEPS: Dict[str, Callable[[], None]] = {
+    "names": warmup_name_model,
+    "semantic": warmup_semantic_model,
+    "yolo": warmup_yolo,
+}
+
+
+class ModelWarmup:
+    """Фоновый прогрев моделей и состояние готовности сервиса"""
+
+    def __init__(self, steps: List[str] = WARMUP_STEPS, parallel: bool = WARMUP_PARALLEL):
+        unknown = [name for name in steps if name not in STEPS]
+        if unknown:
+            print(f"Неизвестные шаги прогрева пропущены: {unknown}")
+        self.steps = [name for name in steps if name in STEPS]
+        self.parallel = parallel
+        self.status: Dict[str, dict] = {name: {"state": "pending"} for name in self.steps}
+        self.attempted = False
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def ready(self) -> bool:
+        return all(step["state"] == "ready" for step in self.status.values())
+
+    @property
+    def state(self) -> str:
+        """warming_up - первая попытка не завершена, degraded - есть упавшие шаги, ready - все готово"""
+        if not self.attempted:
+            return "warming_up"
+        return "ready" if self.ready else "degraded"
+
+    async def _run_step(self, name: str, attempt: int = 1) -> bool:
+        self.status[name] = {"state": "loading", "attempt": attempt}
+        started = time.perf_counter()
+        try:
+            await asyncio.to_thread(STEPS[name])
+            self.status[name] = {
+                "state": "ready", "seconds": round(time.perf_counter() - started, 2), "attempt": attempt
+            }
+            return True
+        except Exception as e:
+            print(f"Ошибка прогрева {name} (попытка {attempt}): {e}")
+            self.status[name] = {"state": "failed", "error": str(e), "attempt": attempt}
+            return False
+
+    async def _retry_step(self, name: str) -> None:
+        """Повторяет упавший шаг, пока он не выполнится"""
+        delay = WARMUP_RETRY_BASE
+        attempt = self.status[name].get("attempt", 1)
+        while True:
+            self.status[name]["retry_in_s"] = delay
+            await asyncio.sleep(delay)
+            attempt += 1
+            if await self._run_step(name, attempt):
+                return
+            delay = min(delay * 2, WARMUP_RETRY_MAX)
+
+    async def run(self) -> None:
+        started = time.perf_counter()
+        if self.parallel:
+            results = await asyncio.gather(*(self._run_step(name) for name in self.steps))
+        else:
+            results = [await self._run_step(name) for name in self.steps]
+        self.attempted = True
+        print(f"Прогрев моделей за {time.perf_counter() - started:.1f} с: {self.status}")
+
+        failed = [name for name, ok in zip(self.steps, results) if not ok]
+        if failed:
+            await asyncio.gather(*(self._retry_step(name) for name in failed))
+            print(f"Прогрев моделей завершен после повторов: {self.status}")
+
+    def start(self) -> None:
+        """Запускает прогрев в текущем event loop, не блокируя прием запросов"""
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self) -> None:
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    def get_status(self) -> dict:
+        return {"state": self.state, "ready": self.ready, "steps": self.status}
+
+
+model_warmup = ModelWarmup()
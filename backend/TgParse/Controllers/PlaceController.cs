@@ -7,6 +7,8 @@ using TgParse.Services;
 using TL.Methods;
 using Minio.DataModel;
 using TgParse.Data;
+using System.Data;
+using System.Text.Json.Serialization;
 
 
 namespace TgParse.Controllers
@@ -73,6 +75,121 @@ namespace TgParse.Controllers
             return Ok(placeDtos);
         }
 
+        // Результат фонового пересчета места в ML-сервисе (place_enrichment.py)
+        [HttpPost("enrichment")]
+        public async Task<IActionResult> ApplyEnrichment([FromBody] PlaceEnrichmentRequest request)
+        {
+            if (string.IsNullOrEmpty(request?.NameLocation))
+            {
+                return BadRequest(new { Message = "name_location cannot be empty" });
+            }
+
+            if (string.IsNullOrEmpty(request.TypeOfRelax))
+            {
+                return BadRequest(new { Message = "type_of_relax cannot be empty" });
+            }
+
+            // Проверка и запись в одной serializable транзакции: параллельное сохранение
+            // нового отзыва (MessageComparor) не перезапишется устаревшим пересчетом
+            using var transaction = await _context.Database.BeginTransactionAsync(IsolationLevel.Serializable);
+            try
+            {
+                // Названия не уникальны между типами отдыха
+                var place = await _context.Places
+                    .Include(p => p.PlaceVectors)
+                    .FirstOrDefaultAsync(p => p.PlaceName == request.NameLocation && p.PlaceType == request.TypeOfRelax);
+                if (place == null)
+                {
+                    return NotFound(new { Message = $"Place {request.NameLocation} ({request.TypeOfRelax}) not found" });
+                }
+
+                // Пересчет применяется целиком, только если описание не менялось с момента
+                // постановки задания: иначе результат устарел, и место пересчитает следующее задание
+                if (place.PlaceDescription != request.PreviousDescription)
+                {
+                    return Conflict(new { Message = $"Place {request.NameLocation} changed since enrichment was queued" });
+                }
+
+                if (request.UserPreferences != null)
+                {
+                    place.UserPreferences = request.UserPreferences;
+                }
+                if (request.Description != null)
+                {
+                    place.PlaceDescription = request.Description;
+                }
+                if (request.PreferencesEmbedding?.Count > 0)
+                {
+                    if (place.PlaceVectors == null)
+                    {
+                        place.PlaceVectors = new PlaceVectors
+                        {
+                            IdPlace = place.IdPlace,
+                            NameEmbedding = new List<float>(),
+                            PreferencesEmbedding = request.PreferencesEmbedding
+                        };
+                        _context.PlaceVectors.Add(place.PlaceVectors);
+                    }
+                    else
+                    {
+                        place.PlaceVectors.PreferencesEmbedding = request.PreferencesEmbedding;
+                    }
+                }
+
+                if (request.CaughtFishes != null)
+                {
+                    _context.FishingPlaceFish.RemoveRange(
+                        await _context.FishingPlaceFish.Where(fpf => fpf.IdFishingPlace == place.IdPlace).ToListAsync());
+                    foreach (var fishName in request.CaughtFishes.Where(n => !string.IsNullOrEmpty(n)).Distinct())
+                    {
+                        var fishType = await _context.FishType.FirstOrDefaultAsync(ft => ft.FishName == fishName);
+                        if (fishType == null)
+                        {
+                            fishType = new FishType { FishName = fishName };
+                            _context.FishType.Add(fishType);
+                            await _context.SaveChangesAsync();
+                        }
+                        _context.FishingPlaceFish.Add(new FishingPlaceFish
+                        {
+                            IdFishingPlace = place.IdPlace,
+                            IdFishType = fishType.IdFishType
+                        });
+                    }
+                }
+
+                if (request.WaterSpace != null)
+                {
+                    _context.FishingPlaceWater.RemoveRange(
+                        await _context.FishingPlaceWater.Where(fpw => fpw.IdFishingPlace == place.IdPlace).ToListAsync());
+                    foreach (var waterName in request.WaterSpace.Where(n => !string.IsNullOrEmpty(n)).Distinct())
+                    {
+                        var waterType = await _context.WaterType.FirstOrDefaultAsync(wt => wt.WaterName == waterName);
+                        if (waterType == null)
+                        {
+                            waterType = new WaterType { WaterName = waterName };
+                            _context.WaterType.Add(waterType);
+                            await _context.SaveChangesAsync();
+                        }
+                        _context.FishingPlaceWater.Add(new FishingPlaceWater
+                        {
+                            IdFishingPlace = place.IdPlace,
+                            IdWaterType = waterType.IdWaterType
+                        });
+                    }
+                }
+
+                await _context.SaveChangesAsync();
+                await transaction.CommitAsync();
+                return Ok();
+            }
+            catch (Exception ex)
+            {
+                await transaction.RollbackAsync();
+                Console.WriteLine($"Ошибка сохранения пересчета места {request.NameLocation}: {ex.Message}");
+                return StatusCode(500, new { Message = "Enrichment save failed", Error = ex.Message });
+            }
+        }
+
         [HttpPost("pars")]
         public async Task<IActionResult> Parse([FromBody] ParseRequestDto request)
         {
@@ -102,6 +219,12 @@ namespace TgParse.Controllers
             }
         }
 
+        public class PlaceEnrichmentRequest : PlaceResponse
+        {
+            [JsonPropertyName("previous_description")]
+            public string? PreviousDescription { get; set; }
+        }
+
         public class ParseRequestDto
         {
             public string? Message { get; set; }
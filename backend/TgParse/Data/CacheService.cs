@@ -39,11 +39,14 @@ namespace TgParse.Data
                 .ToListAsync(); ; 
             string json = JsonSerializer.Serialize(places);
             await _db.StringSetAsync("all_places", json, TimeSpan.FromHours(10)); 
+            // ML-сервис перечитывает all_places только при смене версии
+            await _db.StringIncrementAsync("all_places:version");
         }
 
         public async Task InvalidateCacheAsync()
         {
             await _db.KeyDeleteAsync("all_places");
+            await _db.StringIncrementAsync("all_places:version");
         }
         public class PlaceWithEmbeddings
         {